@@ -3,42 +3,188 @@
 ##### Uniqname: chchwang@umich.edu
 #################################
 
-from bs4 import BeautifulSoup
-import requests
+import argparse
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import difflib
+import functools
+import hashlib
+import http.server
+import importlib
+import importlib.util
+import io
+import itertools
 import json
+import math
+import os
+import queue
+import re
 import sqlite3
 import sys
+import threading
 import time
+import urllib.parse
 import secrets 
-import plotly
-import plotly.graph_objects as go 
-import plotly.figure_factory as ff
+import requests
 
 CACHE_FILENAME = "yelp.json"
-CACHE_DICT = {}
-CACHE_URL = {}
-BASIC_URL='https://api.yelp.com'
+CACHE_DB_FILENAME = "yelp_cache.sqlite"
+CACHE_BACKEND = "sqlite"
+BASIC_URL=os.environ.get('YELP_API_URL', 'https://api.yelp.com')
 SEARCH_PATH ='/v3/businesses/search'
 API_KEY=secrets.API_KEY
 MAPBOX_TOKEN=secrets.MAPBOX_TOKEN
 headers = {"Authorization": "Bearer " + API_KEY}
 DBNAME = 'final.db'
+FETCH_WORKERS = 8
+YELP_QPS = 5
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 10
+BACKOFF_SECONDS = 0.5
+RETRY_STATUS = (429, 502, 503, 504)
+YELP_PAGE_LIMIT = 50
+YELP_MAX_RESULTS = 1000
+# restaurant rows written per transaction, and pages fetched ahead of
+# the writer, by sync_restaurants
+INGEST_BATCH_SIZE = 500
+INGEST_QUEUE_SIZE = 2 * FETCH_WORKERS
+# seconds a cached entry stays fresh, per cache table; older entries are
+# revalidated with the server before they are used
+CACHE_TTL = {'responses': 24 * 3600, 'pages': 7 * 24 * 3600}
+# the most bytes of cached values kept per cache table
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# cache hits whose access time is kept in memory before it is written
+CACHE_ACCESS_FLUSH = 256
+# cache table columns added after the first release of yelp_cache.sqlite
+cache_entry_columns = {
+    'fetched_at': 'REAL',
+    'accessed_at': 'REAL',
+    'etag': 'TEXT',
+    'last_modified': 'TEXT',
+    'ttl': 'REAL',
+    'size': 'INTEGER',
+}
+
+###TRACING###
+class Tracer:
+    '''thread-safe running totals of every traced stage: calls, wall
+    time, rows, bytes written and cache hits and misses. Nested stages
+    are counted inclusively, e.g. 'http' time is also part of 'cache'.
+
+    Instance Attributes
+    -------------------
+    stages: dict
+        stage name: dict of calls, seconds, rows, bytes, hits, misses
+    '''
+    fields = ('calls', 'seconds', 'rows', 'bytes', 'hits', 'misses')
+
+    def __init__(self):
+        self.stages={}
+        self._lock=threading.Lock()
+        self._local=threading.local()
+
+    def record(self, stage, **counts):
+        with self._lock:
+            totals=self.stages.setdefault(stage, dict.fromkeys(self.fields, 0))
+            for name, value in counts.items():
+                totals[name]+=value
+
+    def note(self, **counts):
+        ''' add rows, bytes, hits or misses to the innermost open stage
+        of the calling thread '''
+        spans=getattr(self._local, 'spans', None)
+        if spans:
+            for name, value in counts.items():
+                spans[-1].counts[name]=spans[-1].counts.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: dict(totals) for stage, totals in self.stages.items()}
+
+    def write_json(self, filename, **extra):
+        ''' append the stage totals as one JSON line to filename '''
+        with open(filename, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(dict(extra, time=time.time(), stages=self.snapshot())) + "\n")
+
+    def prometheus(self):
+        ''' the stage totals in the Prometheus text format '''
+        lines=[]
+        for field in self.fields:
+            name=f"final_project_stage_{field}_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, totals in sorted(self.snapshot().items()):
+                lines.append(f'{name}{{stage="{stage}"}} {totals[field]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename):
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus())
+
 
-def open_cache():
+TRACER = Tracer()
+
+class trace:
+    '''time a stage into TRACER, as a decorator (@trace('sql')) or a
+    context manager (with trace('ingest') as span: span.counts['rows']=n).
+    A decorated function returning a list counts its length as rows.
+
+    Instance Attributes
+    -------------------
+    stage: string
+        the stage name (e.g. 'http')
+
+    counts: dict
+        rows, bytes, hits and misses of the current call
+    '''
+    def __init__(self, stage):
+        self.stage=stage
+        self.counts={}
+
+    def __enter__(self):
+        span=trace(self.stage)
+        span._start=time.perf_counter()
+        spans=TRACER._local.__dict__.setdefault('spans', [])
+        spans.append(span)
+        return span
+
+    def __exit__(self, *exc_info):
+        span=TRACER._local.spans.pop()
+        TRACER.record(self.stage, calls=1, seconds=time.perf_counter() - span._start, **span.counts)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            with self as span:
+                result=function(*args, **kwargs)
+                if isinstance(result, list):
+                    span.counts['rows']=span.counts.get('rows', 0) + len(result)
+                return result
+        return traced
+
+
+def load_json_cache(filename=CACHE_FILENAME):
     ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+    a dictionary.
+    if the cache file doesn't exist, returns a new cache dictionary
     
     Parameters
     ----------
-    None
+    filename: string
+        The JSON cache file to read
     
     Returns
     -------
     The opened cache: dict
     '''
     try:
-        cache_file = open(CACHE_FILENAME, 'r')
+        cache_file = open(filename, 'r')
         cache_contents = cache_file.read()
         cache_dict = json.loads(cache_contents)
         cache_file.close()
@@ -47,23 +193,434 @@ def open_cache():
     return cache_dict
 
 
-def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
+@trace('cache_write')
+def save_cache(cache_dict, filename=CACHE_FILENAME):
+    ''' Saves the current state of a JSON cache to disk
     
     Parameters
     ----------
     cache_dict: dict
         The dictionary to save
+    filename: string
+        The JSON cache file to write
     
     Returns
     -------
     None
     '''
     dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
+    TRACER.note(bytes=len(dumped_json_cache))
+    fw = open(filename,"w")
     fw.write(dumped_json_cache)
     fw.close() 
 
+
+CacheEntry = collections.namedtuple('CacheEntry', ['value', 'fetched_at', 'etag', 'last_modified', 'ttl'])
+
+
+class JSONFileCache(dict):
+    '''the original whole-file JSON cache backend.
+    Every new entry rewrites the whole file, so it is only kept for
+    small caches and for reading old yelp.json files. Entries keep
+    their fetch time and validators like the SQLite backend, but the
+    file is not size-bounded.
+
+    Instance Attributes
+    -------------------
+    filename: string
+        the JSON file backing the cache (e.g. 'yelp.json')
+
+    counters: Counter
+        hits, misses, stale, revalidated, served stale and evicted lookups
+    '''
+    def __init__(self, filename=CACHE_FILENAME):
+        super().__init__(load_json_cache(filename))
+        self.filename=filename
+        self.counters=collections.Counter()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        save_cache(self, self.filename)
+
+    def lookup(self, key):
+        record=dict.get(self, key)
+        if record is None:
+            return None
+        if isinstance(record, dict) and record.get('_cache_entry'):
+            return CacheEntry(record['value'], record['fetched_at'], record['etag'],
+                              record['last_modified'], record['ttl'])
+        # entries written before fetch times were kept
+        return CacheEntry(record, os.path.getmtime(self.filename), None, None, None)
+
+    def store(self, key, value, etag=None, last_modified=None, ttl=None):
+        self[key]={'_cache_entry': 1, 'value': value, 'fetched_at': time.time(),
+                   'etag': etag, 'last_modified': last_modified, 'ttl': ttl}
+
+    def touch(self, key):
+        record=dict.get(self, key)
+        if isinstance(record, dict) and record.get('_cache_entry'):
+            record['fetched_at']=time.time()
+            save_cache(self, self.filename)
+
+
+class SQLiteCache:
+    '''a dict-like cache backend stored in a SQLite table.
+    Setting a key writes only that entry, and reading a key looks up a
+    single row through the primary key, so the cache is never loaded
+    into memory as a whole. The connection is opened on first use.
+    Every entry keeps its fetch time, ETag / Last-Modified and TTL for
+    cached_fetch, and the least recently used entries are evicted once
+    the values take more than max_bytes. The file is in WAL mode with
+    synchronous=NORMAL, and the access times of hits are written in
+    batches (see flush) rather than one commit per hit.
+
+    Instance Attributes
+    -------------------
+    filename: string
+        the SQLite file backing the cache (e.g. 'yelp_cache.sqlite')
+
+    table: string
+        the table holding the entries (e.g. 'responses')
+
+    migrate_from: string
+        a legacy JSON cache file imported the first time the table
+        is created (e.g. 'yelp.json'), or None
+
+    max_bytes: int
+        the most bytes of values kept before evicting (e.g. 268435456)
+
+    counters: Counter
+        hits, misses, stale, revalidated, served stale and evicted lookups
+    '''
+    def __init__(self, filename=CACHE_DB_FILENAME, table='responses', migrate_from=None,
+                 max_bytes=CACHE_MAX_BYTES):
+        self.filename=filename
+        self.table=table
+        self.migrate_from=migrate_from
+        self.max_bytes=max_bytes
+        self.counters=collections.Counter()
+        self._conn=None
+        self._size=0
+        self._accessed={}
+        self._lock=threading.RLock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn=sqlite3.connect(self.filename, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            exists=conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                                (self.table,)).fetchone()
+            with conn:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS '{self.table}' ("
+                             "'key' TEXT PRIMARY KEY, 'value' TEXT NOT NULL)")
+                columns=[row[1] for row in conn.execute(f"PRAGMA table_info('{self.table}')")]
+                for column, column_type in cache_entry_columns.items():
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE '{self.table}' ADD COLUMN '{column}' {column_type}")
+                # entries from before fetch times were kept count as fetched now
+                now=time.time()
+                conn.execute(f"UPDATE '{self.table}' SET fetched_at=?, accessed_at=?, size=LENGTH(value)"
+                             " WHERE fetched_at IS NULL", (now, now))
+                conn.execute(f"CREATE INDEX IF NOT EXISTS '{self.table}_accessed_at'"
+                             f" ON '{self.table}' (accessed_at)")
+            self._size=conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM '{self.table}'").fetchone()[0]
+            self._conn=conn
+            atexit.register(self.close)
+            if exists is None and self.migrate_from is not None:
+                migrate_json_cache(self.migrate_from, {self.table: self})
+        return self._conn
+
+    def __contains__(self, key):
+        with self._lock:
+            row=self._connect().execute(f"SELECT 1 FROM '{self.table}' WHERE key=?", (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            row=self._connect().execute(f"SELECT value FROM '{self.table}' WHERE key=?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute(f"SELECT COUNT(*) FROM '{self.table}'").fetchone()[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self._lock:
+            rows=self._connect().execute(f"SELECT key FROM '{self.table}'").fetchall()
+        return [row[0] for row in rows]
+
+    def lookup(self, key):
+        ''' Reads an entry with its fetch time and validators, and marks
+        it as recently used; the access time is written by the next flush
+
+        Parameters
+        ----------
+        key: string
+            the cache key
+
+        Returns
+        -------
+        CacheEntry
+            the entry, or None when the key is not cached
+        '''
+        with self._lock:
+            conn=self._connect()
+            row=conn.execute(f"SELECT value, fetched_at, etag, last_modified, ttl FROM '{self.table}'"
+                             " WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._accessed[key]=time.time()
+            if len(self._accessed) >= CACHE_ACCESS_FLUSH:
+                self.flush()
+        return CacheEntry(json.loads(row[0]), *row[1:])
+
+    def flush(self):
+        ''' Writes the access times of the hits since the last flush in
+        one transaction
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        with self._lock:
+            if self._conn is None or not self._accessed:
+                return
+            with self._conn:
+                self._write_accessed(self._conn)
+
+    def _write_accessed(self, conn):
+        conn.executemany(f"UPDATE '{self.table}' SET accessed_at=? WHERE key=?",
+                         ((accessed_at, key) for key, accessed_at in self._accessed.items()))
+        self._accessed.clear()
+
+    def store(self, key, value, etag=None, last_modified=None, ttl=None):
+        ''' Writes an entry with its validators, then evicts the least
+        recently used entries while the cache is over max_bytes
+
+        Parameters
+        ----------
+        key: string
+            the cache key
+        value: object
+            the value, must be JSON serializable
+        etag: string
+            the ETag header of the response, or None
+        last_modified: string
+            the Last-Modified header of the response, or None
+        ttl: float
+            seconds the entry stays fresh, None for the store's default
+
+        Returns
+        -------
+        None
+        '''
+        self.update([(key, value)], etag, last_modified, ttl)
+
+    def touch(self, key):
+        ''' Marks an entry as fetched now, after the server confirmed
+        it has not changed
+
+        Parameters
+        ----------
+        key: string
+            the cache key
+
+        Returns
+        -------
+        None
+        '''
+        with self._lock:
+            conn=self._connect()
+            with conn:
+                now=time.time()
+                self._accessed.pop(key, None)
+                conn.execute(f"UPDATE '{self.table}' SET fetched_at=?, accessed_at=? WHERE key=?",
+                             (now, now, key))
+
+    def update(self, items, etag=None, last_modified=None, ttl=None):
+        ''' Writes several entries in one transaction
+
+        Parameters
+        ----------
+        items: iterable
+            (key, value) pairs, values must be JSON serializable
+        etag, last_modified, ttl:
+            validators and TTL stored with every entry, see store
+
+        Returns
+        -------
+        None
+        '''
+        now=time.time()
+        with self._lock, trace('cache_write'):
+            conn=self._connect()
+            with conn:
+                for key, value in items:
+                    text=json.dumps(value)
+                    TRACER.note(bytes=len(text))
+                    old=conn.execute(f"SELECT size FROM '{self.table}' WHERE key=?", (key,)).fetchone()
+                    conn.execute(f"INSERT OR REPLACE INTO '{self.table}'"
+                                 " (key, value, fetched_at, accessed_at, etag, last_modified, ttl, size)"
+                                 " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (key, text, now, now, etag, last_modified, ttl, len(text)))
+                    self._size+=len(text) - (old[0] if old else 0)
+                    self._accessed.pop(key, None)
+                self._write_accessed(conn)
+                self._evict(conn)
+
+    def _evict(self, conn):
+        while self._size > self.max_bytes:
+            rows=conn.execute(f"SELECT key, size FROM '{self.table}' ORDER BY accessed_at LIMIT 64").fetchall()
+            if len(rows) <= 1:
+                break
+            for key, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                conn.execute(f"DELETE FROM '{self.table}' WHERE key=?", (key,))
+                self._size-=size
+                self.counters['evicted']+=1
+
+    def stats(self):
+        ''' Summarizes the cache
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            entries, bytes and stale entries (older than the default
+            TTL of the table), plus the counters of this process
+        '''
+        self.flush()
+        with self._lock:
+            conn=self._connect()
+            entries, size=conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM '{self.table}'").fetchone()
+            stale=conn.execute(f"SELECT COUNT(*) FROM '{self.table}' WHERE fetched_at + COALESCE(ttl, ?) < ?",
+                               (CACHE_TTL.get(self.table, 0), time.time())).fetchone()[0]
+        return dict({'entries': entries, 'bytes': size, 'stale entries': stale}, **self.counters)
+
+    def purge_stale(self):
+        ''' Deletes the entries older than their TTL
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        int
+            the number of entries deleted
+        '''
+        with self._lock:
+            conn=self._connect()
+            with conn:
+                deleted=conn.execute(f"DELETE FROM '{self.table}' WHERE fetched_at + COALESCE(ttl, ?) < ?",
+                                     (CACHE_TTL.get(self.table, 0), time.time())).rowcount
+            self._size=conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM '{self.table}'").fetchone()[0]
+        return deleted
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self.flush()
+                self._conn.close()
+                self._conn=None
+
+
+def migrate_json_cache(json_filename, stores):
+    ''' Copies the entries of an old whole-file JSON cache into cache stores.
+    API responses (dicts) go to the 'responses' store and scraped pages
+    (strings) go to the 'pages' store, because the old code wrote both
+    kinds into the same yelp.json.
+
+    Parameters
+    ----------
+    json_filename: string
+        The legacy JSON cache file
+    stores: dict
+        A dictionary of table name: cache store pairs
+
+    Returns
+    -------
+    int
+        the number of entries migrated
+    '''
+    if not os.path.exists(json_filename):
+        return 0
+    legacy=load_json_cache(json_filename)
+    count=0
+    for table, store in stores.items():
+        if table == 'pages':
+            items=[(k, v) for k, v in legacy.items() if isinstance(v, str)]
+        else:
+            items=[(k, v) for k, v in legacy.items() if not isinstance(v, str)]
+        store.update(items)
+        count+=len(items)
+    if count:
+        print(f"Migrated {count} entries from {json_filename}")
+    return count
+
+
+def open_cache(table='responses', backend=CACHE_BACKEND):
+    ''' Opens a cache store.
+    The SQLite backend imports the old yelp.json the first time its
+    table is created; the JSON backend loads the whole file like before.
+    
+    Parameters
+    ----------
+    table: string
+        The kind of entries kept in the cache ('responses' or 'pages')
+    backend: string
+        'sqlite' or 'json'
+    
+    Returns
+    -------
+    The opened cache: a dict-like store
+    '''
+    if backend == 'json':
+        return JSONFileCache(CACHE_FILENAME if table == 'responses' else f"{table}.json")
+    return SQLiteCache(CACHE_DB_FILENAME, table, migrate_from=CACHE_FILENAME)
+
+
+CACHE_DICT = open_cache('responses')
+CACHE_URL = open_cache('pages')
+
+def print_cache_stats(purge_stale=False):
+    ''' Prints the size and the counters of both caches
+
+    Parameters
+    ----------
+    purge_stale: bool
+        delete the entries older than their TTL first (SQLite backend)
+
+    Returns
+    -------
+    None
+    '''
+    for name, cache in (('responses', CACHE_DICT), ('pages', CACHE_URL)):
+        if purge_stale and hasattr(cache, 'purge_stale'):
+            print(f"{name}: {cache.purge_stale()} stale entries deleted")
+        stats=cache.stats() if hasattr(cache, 'stats') else dict(cache.counters, entries=len(cache))
+        print(f"{name}: " + ", ".join(f"{value} {key}" for key, value in stats.items()))
+
 def construct_unique_key(baseurl, params):
     ''' constructs a key that is guaranteed to uniquely and 
     repeatably identify an API request by its baseurl and params
@@ -88,8 +645,150 @@ def construct_unique_key(baseurl, params):
     unique_key = baseurl + connector + connector.join(param_strings)
     return unique_key
 
+class RateLimiter:
+    '''a thread-safe limiter that spaces out calls so that no more
+    than qps of them start in any second
+
+    Instance Attributes
+    -------------------
+    qps: float
+        the number of calls allowed per second (e.g. 5)
+    '''
+    def __init__(self, qps):
+        self.qps=qps
+        self.interval=1.0 / qps
+        self._next=0.0
+        self._lock=threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now=time.monotonic()
+            delay=self._next - now
+            self._next=max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+RATE_LIMITER = RateLimiter(YELP_QPS)
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session():
+    ''' Returns the HTTP session shared by every request, so that
+    connections to the API are pooled and reused across threads
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    requests.Session
+        the shared session
+    '''
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session=requests.Session()
+            adapter=requests.adapters.HTTPAdapter(pool_connections=FETCH_WORKERS,
+                                                  pool_maxsize=FETCH_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSION=session
+    return _SESSION
+
+def retry_delay(response, attempt):
+    ''' Works out how long to wait before retrying a throttled request.
+    The Retry-After header is used when the API sends one, otherwise the
+    wait doubles with every attempt.
+
+    Parameters
+    ----------
+    response: requests.Response
+        the throttled response, None when the request failed to connect
+        or timed out
+    attempt: int
+        the number of attempts made so far, starting at 0
+
+    Returns
+    -------
+    float
+        the delay in seconds
+    '''
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, ValueError):
+        return BACKOFF_SECONDS * (2 ** attempt)
+
+def get_with_retries(url, params=None, request_headers=None, limiter=None):
+    ''' GET url through the shared session, giving up on a silent server
+    after REQUEST_TIMEOUT seconds. Throttled and unavailable answers,
+    connection errors and timeouts are retried with the same backoff,
+    up to MAX_RETRIES times.
+
+    Parameters
+    ----------
+    url: string
+        the URL to get
+    params: dictionary
+        A dictionary of param:value pairs
+    request_headers: dictionary
+        the headers to send
+    limiter: RateLimiter
+        waited on before every attempt, None for no limit
+
+    Returns
+    -------
+    requests.Response
+        the last response
+
+    Raises
+    ------
+    requests.RequestException
+        when the last attempt still fails to connect or times out
+    '''
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            response = get_session().get(url, params=params, headers=request_headers,
+                                         timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+            return response
+        time.sleep(retry_delay(response, attempt))
+
+@trace('http')
+def send_request(baseurl, params, extra_headers=None):
+    '''Send a request to the Web API using the baseurl and params.
+    Requests go through the shared session and the rate limiter, and
+    are retried with backoff when the API answers 429 or is unavailable,
+    or cannot be reached in time (see get_with_retries).
+
+    Parameters
+    ----------
+    baseurl: string
+        The URL for the API endpoint
+    params: dictionary
+        A dictionary of param:value pairs
+    extra_headers: dictionary
+        headers sent along with the API key, e.g. If-None-Match
+
+    Returns
+    -------
+    requests.Response
+        the last response
+    '''
+    response = get_with_retries(baseurl, params, dict(headers, **(extra_headers or {})), RATE_LIMITER)
+    TRACER.note(bytes=len(response.content))
+    return response
+
 def make_request(baseurl, params):
-    '''Make a request to the Web API using the baseurl and params
+    '''Make a request to the Web API using the baseurl and params.
     
     Parameters
     ----------
@@ -104,15 +803,80 @@ def make_request(baseurl, params):
         the data returned from making the request in the form of 
         a dictionary
     '''
-    response = requests.get(baseurl, 
-                        params=params, 
-                        headers=headers)
-    return response.json()
+    return send_request(baseurl, params).json()
+
+@trace('cache')
+def cached_fetch(cache, key, fetch, parse, ttl):
+    '''The cache layer of every request. A fresh entry is returned as
+    it is; a stale one is revalidated with If-None-Match /
+    If-Modified-Since when the server sent validators, and only
+    downloaded again when it changed. When a stale entry cannot be
+    fetched again (the request fails, or the server still answers with
+    an error after the retries), the stale entry is returned and counted
+    as 'served stale'.
+
+    Parameters
+    ----------
+    cache: SQLiteCache or JSONFileCache
+        the cache store
+    key: string
+        the cache key of the request
+    fetch: function
+        sends the request with the conditional headers it is given and
+        returns the requests.Response
+    parse: function
+        turns a 200 response into the value to cache and return; the
+        value is not cached when it is a dict with an 'error'
+    ttl: float
+        seconds an entry stays fresh
+
+    Returns
+    -------
+    object
+        the cached or parsed value
+    '''
+    entry=cache.lookup(key)
+    conditional={}
+    if entry is not None:
+        if time.time() - entry.fetched_at < (entry.ttl if entry.ttl is not None else ttl):
+            cache.counters['hits']+=1
+            TRACER.note(hits=1)
+            print("Using CACHE")
+            return entry.value
+        cache.counters['stale']+=1
+        if entry.etag:
+            conditional['If-None-Match']=entry.etag
+        if entry.last_modified:
+            conditional['If-Modified-Since']=entry.last_modified
+    else:
+        cache.counters['misses']+=1
+    TRACER.note(misses=1)
+    print("Fetching")
+    try:
+        response=fetch(conditional)
+    except requests.RequestException as error:
+        if entry is None:
+            raise
+        print(f"Fetching failed ({error}), using the stale CACHE")
+        cache.counters['served stale']+=1
+        return entry.value
+    if response.status_code == 304 and entry is not None:
+        cache.counters['revalidated']+=1
+        cache.touch(key)
+        return entry.value
+    if not response.ok and entry is not None:
+        print(f"Fetching failed (HTTP {response.status_code}), using the stale CACHE")
+        cache.counters['served stale']+=1
+        return entry.value
+    value=parse(response)
+    if response.ok and not (isinstance(value, dict) and 'error' in value):
+        cache.store(key, value, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return value
 
 def make_request_with_cache(baseurl, params):
     '''Check the cache for a saved result for this baseurl+params:values
-    combo. If the result is found, return it. Otherwise send a new 
-    request, save it, then return it.
+    combo. A fresh result is returned from the cache; otherwise it is
+    revalidated or fetched again (see cached_fetch) and saved.
 
     Parameters
     ----------
@@ -128,19 +892,14 @@ def make_request_with_cache(baseurl, params):
         JSON
     '''
     request_url=construct_unique_key(baseurl, params)
-    if request_url in CACHE_DICT.keys():
-        print("Using CACHE")
-        return CACHE_DICT[request_url]
-    else:
-        print("Fetching")
-        CACHE_DICT[request_url]=make_request(baseurl, params)
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[request_url]
+    return cached_fetch(CACHE_DICT, request_url,
+                        lambda conditional: send_request(baseurl, params, conditional),
+                        lambda response: response.json(), CACHE_TTL['responses'])
 
 def make_request_with_cache_url(request_url):
-    '''Check the cache for a saved result for this request_url:values
-    combo. If the result is found, return it. Otherwise send a new 
-    request, save it, then return it.
+    '''Check the cache for a saved page of this request_url.
+    A fresh page is returned from the cache; otherwise it is
+    revalidated or fetched again (see cached_fetch) and saved.
 
     Parameters
     ----------
@@ -149,93 +908,170 @@ def make_request_with_cache_url(request_url):
     
     Returns
     -------
-    dict
-        the results of the query as a dictionary loaded from cache
-        JSON
+    str
+        the page, from the cache while it is fresh
     '''
-    if request_url in CACHE_DICT.keys():
-        print("Using CACHE")
-        return CACHE_URL[request_url]
-    else:
-        response=requests.get(request_url)
-        CACHE_URL[request_url]=response.text
-        save_cache(CACHE_URL)
-        return CACHE_URL[request_url]
-
+    return cached_fetch(CACHE_URL, request_url,
+                        lambda conditional: get_with_retries(request_url, request_headers=conditional),
+                        lambda response: response.text, CACHE_TTL['pages'])
 
 
-conn = sqlite3.connect(DBNAME)
-cur = conn.cursor()
 
 ##scrape the wikipedia page
-def build_city_information_list():
-    ''' Make a list of city information from "https://en.wikipedia.org/wiki/List_of_United_States_cities_by_population"
+WIKI_CITIES_URL = os.environ.get('WIKI_CITIES_URL',
+                                 'https://en.wikipedia.org/wiki/List_of_United_States_cities_by_population')
+# bump when parse_city_table changes, so stored results are parsed again
+CITY_PARSER_VERSION = 2
+
+def parse_coordinates(cell):
+    ''' read the full-precision coordinates of a table cell
 
     Parameters
     ----------
-    None
+    cell: Tag
+        the table cell with the coordinates
+
+    Returns
+    -------
+    tuple
+        (latitude, longitude) as floats, or (None, None)
+    '''
+    geo = cell.find("span", class_="geo")
+    if geo is not None:
+        numbers = re.findall(r'-?\d+(?:\.\d+)?', geo.get_text())
+        if len(numbers) >= 2:
+            return float(numbers[0]), float(numbers[1])
+    geo_dec = cell.find("span", class_="geo-dec")
+    match = geo_dec and re.search(r'([\d.]+)°\s*([NS])\W+([\d.]+)°\s*([EW])', geo_dec.get_text())
+    if not match:
+        return None, None
+    latitude = float(match.group(1)) * (1 if match.group(2) == 'N' else -1)
+    longitude = float(match.group(3)) * (1 if match.group(4) == 'E' else -1)
+    return latitude, longitude
+
+@trace('parse')
+def parse_city_table(html):
+    ''' parse every city of the Wikipedia list. Only the first
+        "wikitable sortable" table is read; SoupStrainer keeps everything
+        outside the tables of the page from being parsed at all, and
+        lxml is used when it is installed.
+
+    Parameters
+    ----------
+    html: str
+        the Wikipedia page
 
     Returns
     -------
     list
-        the city list that contains all the information
+        (rank, city name, state, latitude, longitude) of every city,
+        in the order of the table
     '''
-    basic_URL="https://en.wikipedia.org/wiki/List_of_United_States_cities_by_population"
-    response=make_request_with_cache_url(basic_URL)
-    soup=BeautifulSoup(response, 'html.parser')
-
-    listing_parent=soup.find_all("table", class_="wikitable sortable")[0]
-    city_listing_parent=listing_parent.find_all("tr")
-    city_url_dict={}
-    city_name_list=[]
-    state_list=[]
-    latitude_list=[]
-    longitude_list=[]
-    for i in range(100):
-        city_listing=city_listing_parent[i+1].find_all('td')
-        city_name_list.append(city_listing[1].find('a').text.strip())
-        try:
-            state_list.append(city_listing[2].find('a').text)
-        except:
-            state_list.append(city_listing[2].text[1:-1])
-        latitude_list.append((city_listing[-1].find("span",class_="geo-dec").text.split()[0][:2]))    
-        longitude_list.append((city_listing[-1].find("span",class_="geo-dec").text.split()[0][:2])) 
-        time.sleep(0.1)
-    city_list=[]  
-    for i in range(len(city_name_list)):
-        city_list.append((int(i+1),city_name_list[i],state_list[i],latitude_list[i],longitude_list[i]))
-    # for i in city_list:
-    #     print (i)
+    from bs4 import BeautifulSoup, SoupStrainer
 
-    
+    parser = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+    soup = BeautifulSoup(html, parser, parse_only=SoupStrainer("table"))
+    listing_parent = soup.select_one("table.wikitable.sortable")
+    if listing_parent is None:
+        raise ValueError("The city table was not found on the page.")
+    city_list = []
+    for row in listing_parent.find_all("tr"):
+        cells = row.find_all(["td", "th"])
+        if not row.find("td") or len(cells) < 3:
+            continue
+        # older versions of the page start each row with a rank cell
+        if cells[0].get_text(strip=True).isdigit():
+            cells = cells[1:]
+        city = cells[0].find('a') or cells[0]
+        state = cells[1].find('a') or cells[1]
+        latitude, longitude = parse_coordinates(cells[-1])
+        if latitude is None:
+            continue
+        city_list.append((len(city_list) + 1, re.sub(r'\[.*?\]', '', city.get_text()).strip(),
+                          state.get_text(strip=True), latitude, longitude))
     return city_list
 
+def build_city_information_list(n=100, conn=None):
+    ''' Make a list of city information from "https://en.wikipedia.org/wiki/List_of_United_States_cities_by_population"
+
+    Parameters
+    ----------
+    n: int
+        how many of the most populous cities to return
+    conn: sqlite3.Connection
+        a writable connection to a migrated database. The parsed cities
+        are stored in its city_pages table with the hash of the page,
+        and are reused as long as the page does not change.
+
+    Returns
+    -------
+    list
+        the city list that contains all the information
+    '''
+    response=make_request_with_cache_url(WIKI_CITIES_URL)
+    if conn is None:
+        return parse_city_table(response)[:n]
+    content_hash=hashlib.sha1(response.encode()).hexdigest()
+    stored=conn.execute("SELECT content_hash, parser_version, cities FROM city_pages WHERE url=?",
+                        (WIKI_CITIES_URL,)).fetchone()
+    if stored is not None and stored[0] == content_hash and stored[1] == CITY_PARSER_VERSION:
+        print("The city page has not changed, using the stored cities")
+        return [tuple(city) for city in json.loads(stored[2])[:n]]
+    city_list=parse_city_table(response)
+    with conn:
+        conn.execute(upsert_city_pages, (WIKI_CITIES_URL, content_hash, CITY_PARSER_VERSION,
+                                         time.time(), json.dumps(city_list)))
+    return city_list[:n]
+
 
 #Create city database
 drop_cities = '''
     DROP TABLE IF EXISTS 'cities';
 '''
+# id is a stable surrogate key the restaurants point at; rank is the
+# population rank on the last scraped page, NULL for a city that has
+# dropped out of the list (its row stays for the restaurants linked to it)
 create_cities = '''
     CREATE TABLE IF NOT EXISTS 'cities' (
         'id' INTEGER PRIMARY KEY,
         'CityName'  TEXT NOT NULL,
         'StateName' TEXT NOT NULL,
         'Latitude'  REAL NOT NULL,
-        'Longitude'  REAL NOT NULL
+        'Longitude'  REAL NOT NULL,
+        'rank'  INTEGER
+    );
+'''
+create_city_indexes = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_cities_name ON cities (CityName, StateName)",
+    "CREATE INDEX IF NOT EXISTS idx_cities_rank ON cities (rank)",
+]
+# takes the (rank, CityName, StateName, Latitude, Longitude) rows of
+# parse_city_table; a city keeps its id whatever its rank
+upsert_cities = '''
+    INSERT INTO cities (rank, CityName, StateName, Latitude, Longitude)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(CityName, StateName) DO UPDATE SET
+        rank=excluded.rank, Latitude=excluded.Latitude, Longitude=excluded.Longitude
+'''
+# the parsed city list of a scraped page, with the hash of the page it came from
+create_city_pages = '''
+    CREATE TABLE IF NOT EXISTS 'city_pages' (
+        'url' TEXT PRIMARY KEY,
+        'content_hash' TEXT NOT NULL,
+        'parser_version' INTEGER NOT NULL,
+        'parsed_at' REAL NOT NULL,
+        'cities' TEXT NOT NULL
     );
 '''
-cur.execute(drop_cities)
-cur.execute(create_cities)
-insert_cities = '''
-    INSERT INTO cities
+upsert_city_pages = '''
+    INSERT OR REPLACE INTO city_pages
     VALUES (?, ?, ?, ?, ?)
 '''
-for i in build_city_information_list():
-    cur.execute(insert_cities,i)
-conn.commit()
 
 
 ###Get restaurants information from YELP FUSION API###
+weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
 class restaurant:
     '''a restaurant
 
@@ -289,28 +1125,116 @@ class restaurant:
     def info(self):
         return self.name + self.categories+ self.rating + self.latitude+  self.longitude + self.state + self.city
 
-def get_restaurants(city_name, term='food'):
+# the sort orders of the search API; best_match is its default
+search_sorts = ('best_match', 'rating', 'review_count', 'distance')
+# the widest radius the search API accepts, in meters
+YELP_MAX_RADIUS = 40000
+CRAWL_TERM = 'food'
+
+def normalize_search(term=None, location=None, latitude=None, longitude=None, categories=None,
+                     price=None, radius=None, sort_by=None, offset=0, limit=YELP_PAGE_LIMIT):
+    ''' turn the filters of a search into the params of one API request,
+        written the same way however they were given, so equal searches
+        share one cache entry and one stored result list
+
+    Parameters
+    ----------
+    term: str
+        search term, e.g. 'food' or 'Thai' (case and spacing are ignored)
+    location: str
+        place to search, e.g. 'Chicago' or 'Hyde Park, Chicago' (case
+        and spacing are ignored)
+    latitude, longitude: float
+        point to search around instead of (or as well as) location,
+        rounded to 4 decimals (about 10 m)
+    categories: str or list
+        category aliases, e.g. 'pizza,sushi' or ['sushi', 'Pizza']
+    price: str, int or list
+        price levels 1 to 4, e.g. '1,2', '$$' or [2, 1]
+    radius: int
+        meters around the location (at most 40000)
+    sort_by: str
+        one of search_sorts
+    offset: int
+        position of the first business
+    limit: int
+        number of businesses (at most 50)
+
+    Returns
+    -------
+    dict
+        the API params, leaving out the ones not set
+    '''
+    params = {}
+    if term and term.strip():
+        params['term'] = " ".join(term.split()).casefold()
+    if location and location.strip():
+        params['location'] = " ".join(location.split()).casefold()
+    if (latitude is None) != (longitude is None):
+        raise ValueError("latitude and longitude go together")
+    if latitude is not None:
+        latitude, longitude = round(float(latitude), 4), round(float(longitude), 4)
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError(f"No such point: {latitude}, {longitude}")
+        params['latitude'], params['longitude'] = latitude, longitude
+    if 'location' not in params and 'latitude' not in params:
+        raise ValueError("A search needs a location or a latitude and longitude")
+    if categories:
+        if isinstance(categories, str):
+            categories = categories.split(',')
+        aliases = sorted({alias.strip().casefold() for alias in categories if alias.strip()})
+        if aliases:
+            params['categories'] = ",".join(aliases)
+    if price:
+        if isinstance(price, str):
+            price = [len(level) if set(level) == {'$'} else level
+                     for level in price.replace(' ', '').split(',') if level]
+        elif isinstance(price, int):
+            price = [price]
+        levels = sorted({int(level) for level in price})
+        if not levels or levels[0] < 1 or levels[-1] > 4:
+            raise ValueError(f"Price levels go from 1 to 4: {price}")
+        params['price'] = ",".join(str(level) for level in levels)
+    if radius is not None:
+        radius = int(radius)
+        if not 0 < radius <= YELP_MAX_RADIUS:
+            raise ValueError(f"The radius goes up to {YELP_MAX_RADIUS} meters: {radius}")
+        params['radius'] = radius
+    if sort_by and sort_by != 'best_match':
+        if sort_by not in search_sorts:
+            raise ValueError(f"Unknown sort_by: {sort_by}, use one of {', '.join(search_sorts)}")
+        params['sort_by'] = sort_by
+    if offset:
+        params['offset'] = int(offset)
+    params['limit'] = int(limit)
+    return params
+
+def get_restaurants(location=None, term=CRAWL_TERM, offset=0, limit=YELP_PAGE_LIMIT, **filters):
     '''make a request to the Yelp Fusion API 
        and generates a restaurant dict with cache
 
     Parameters
     ----------
-    city_name: str
-        name of a city
+    location: str
+        name of a city, or any other place
     term: str
-        term='food'
+        search term, 'food' by default
+    offset: int
+        position of the first business of the page
+    limit: int
+        number of businesses in the page (at most 50)
+    filters: dict
+        latitude, longitude, categories, price, radius or sort_by,
+        see normalize_search
 
     Returns
     -------
     dict:
         the API dict
     '''
-    yelp_url = 'https://api.yelp.com/v3/businesses/search'
-    yelp_dict = make_request_with_cache(yelp_url, {
-        'location': city_name,
-        'term': term,
-        'limit': 50
-    })
+    yelp_url = BASIC_URL + SEARCH_PATH
+    params = normalize_search(term, location, offset=offset, limit=limit, **filters)
+    yelp_dict = make_request_with_cache(yelp_url, params)
     return yelp_dict
 
 def get_restaurant_list(city_name):
@@ -320,7 +1244,7 @@ def get_restaurant_list(city_name):
 
     Parameters
     ----------
-    city_name2: str
+    city_name: str
         name of a city
 
     Returns
@@ -328,34 +1252,53 @@ def get_restaurant_list(city_name):
     list
         A list of all the restaurant information
     '''
-    restaurant_dict=get_restaurants(city_name, term='food')
-    restaurant_list=[]
-    id_list=[]
-    #count=0
-    for i in restaurant_dict["businesses"]:
-        #count+=1
-        businesses_list=[]
-        if i['id'] not in id_list:
-            id_list.append(i['id'])
-            #businesses_list.append(i['id'])
-        else:
-            continue
-        #businesses_list.append(count)
-        businesses_list.append(i['name'])
-        businesses_list.append(i['categories'][0]['title'])
-        businesses_list.append(i['rating'])
-        #businesses_list.append(i['coordinates']['latitude'])
-        #businesses_list.append(i['coordinates']['longitude'])
-        restaurant_list.append(tuple(businesses_list))
-    restaurant_list=sorted(restaurant_list,key=lambda bu:bu[2],reverse=True) 
-    k=0
-    # for i in restaurant_list:
-    #     k+=1
-    #     print(k,i)
-    return restaurant_list
+    return get_info_form_database(['name', 'categories', 'rating'], {'CityName': city_name},
+                                  order_by=['-rating', 'name'])
+
+# the fields of a restaurant detail, in the order of detail_query
+detail_fields = ('id', 'name', 'categories', 'rating', 'Phone', 'review_count', 'Latitude', 'Longitude',
+                 'address', 'CityName', 'StateName', 'zipcode', 'price', 'url', 'transactions', 'hours')
+detail_query = ("SELECT b.id, b.name, b.categories, b.rating, b.Phone, b.review_count, b.Latitude,"
+                " b.Longitude, b.address, b.CityName, b.StateName, b.zipcode,"
+                " d.price, d.url, d.transactions, d.hours"
+                " FROM known_restaurants AS b LEFT JOIN business_details AS d ON d.id = b.id"
+                " WHERE b.id IS NOT NULL")
+
+def find_restaurant_detail(res_name=None, city_name=None, business_id=None):
+    ''' look up the detailed information of a restaurant with one
+        indexed query on the restaurants and business_details tables
+
+    Parameters
+    ----------
+    res_name: str
+        name of a restaurant
+    city_name: str
+        name of a city
+    business_id: str
+        the Yelp id of the restaurant; when given, res_name and
+        city_name are not needed
 
-def get_restaurant_detail(res_name,city_name1):
-    ''' get the detailed information of a restaurant
+    Returns
+    -------
+    dict
+        detail_fields: value, with 'categories' as the list of all
+        category titles, or None when there is no such restaurant
+    '''
+    if business_id is not None:
+        row = get_read_connection().execute(detail_query + " AND b.id = ?", (business_id,)).fetchone()
+    else:
+        row = get_read_connection().execute(detail_query + " AND b.name = ? AND b.CityName = ?",
+                                            (res_name, city_name)).fetchone()
+    if row is None:
+        return None
+    detail = dict(zip(detail_fields, row))
+    detail['categories'] = get_restaurant_categories(detail['id']) or [detail['categories']]
+    if isinstance(detail['zipcode'], (int, float)):
+        detail['zipcode'] = f"{int(detail['zipcode']):05d}"
+    return detail
+
+def get_restaurant_detail(res_name,city_name1,business_id=None):
+    ''' print the detailed information of a restaurant
 
     Parameters
     ----------
@@ -363,322 +1306,4299 @@ def get_restaurant_detail(res_name,city_name1):
         name of a restaurant
     city_name1: str
         name of a city
+    business_id: str
+        the Yelp id of the restaurant, e.g. from search_restaurants;
+        when given, res_name and city_name1 are not needed
 
     Returns
     -------
-    str
+    dict
         Detailed information of a restaurant
     '''
-    restaurant_dict=get_restaurants(city_name1, term='food')
-    name_list=[]
-    for i in restaurant_dict["businesses"]:
-        name_list.append(i['name'])
-    detail_list=[]
-   
-    if res_name in name_list:
-        for i in range(len(name_list)):
-            if restaurant_dict["businesses"][i]['name']==res_name:
-                name=restaurant_dict["businesses"][i]['name']
-                rating=restaurant_dict["businesses"][i]['rating']
-                phone=restaurant_dict["businesses"][i]['phone']
-                latitude=restaurant_dict["businesses"][i]['coordinates']['latitude']
-                longitude=restaurant_dict["businesses"][i]['coordinates']['longitude']
-                categories=restaurant_dict["businesses"][i]['categories']
-                review_count=restaurant_dict["businesses"][i]['review_count']
-                city=restaurant_dict["businesses"][i]['location']['city']
-                state=restaurant_dict["businesses"][i]['location']['state']
-                address=restaurant_dict["businesses"][i]['location']['address1']
-                zipcode=restaurant_dict["businesses"][i]['location']['zip_code']
-                print(" ")
-                print('name:',name)
-                print('categories:',categories)
-                print('rating:',rating)
-                print('phone:',phone)
-                print('review_count:',review_count)
-                print('coordinates:','[',latitude,longitude,']')
-                print('address:',address)
-                print('city:',city)
-                print('state:',state)
-                print('zipcode:',zipcode)
-            else:
-                continue
-    else:
+    detail = find_restaurant_detail(res_name, city_name1, business_id)
+    if detail is None:
         print('Sorry,no such restaurant in this city. Please choose another restaurant.')
+        return None
+    print(" ")
+    print('name:',detail['name'])
+    print('categories:',detail['categories'])
+    print('rating:',detail['rating'])
+    print('price:',detail['price'])
+    print('phone:',detail['Phone'])
+    print('review_count:',detail['review_count'])
+    print('coordinates:','[',detail['Latitude'],detail['Longitude'],']')
+    print('address:',detail['address'])
+    print('city:',detail['CityName'])
+    print('state:',detail['StateName'])
+    print('zipcode:',detail['zipcode'])
+    if detail['transactions']:
+        print('transactions:',detail['transactions'])
+    if detail['hours']:
+        print('hours:',detail['hours'])
+    if detail['url']:
+        print('url:',detail['url'])
+    return detail
 
 
-def get_all_restaurant(city_name2):
-    ''' get all restaurant information of a city
+def business_reject_reason(business):
+    ''' tell why a business of an API dict cannot be stored
 
     Parameters
     ----------
-    city_name2: str
-        name of a city
+    business: dict
+        a business of an API dict
+
+    Returns
+    -------
+    str
+        the reason, or None when the business is valid
+    '''
+    if not isinstance(business, dict):
+        return 'not a business'
+    if not business.get('id'):
+        return 'no id'
+    if not business.get('name'):
+        return 'no name'
+    categories = business.get('categories')
+    if not categories or not isinstance(categories[0], dict) or not categories[0].get('title'):
+        return 'no category'
+    rating = business.get('rating')
+    if not isinstance(rating, (int, float)) or not 0 <= rating <= 5:
+        return 'bad rating'
+    coordinates = business.get('coordinates') or {}
+    latitude, longitude = coordinates.get('latitude'), coordinates.get('longitude')
+    if latitude is not None or longitude is not None:
+        if not isinstance(latitude, (int, float)) or not isinstance(longitude, (int, float)) \
+                or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            return 'bad coordinates'
+    if not isinstance(business.get('location'), dict):
+        return 'no location'
+    return None
+
+def restaurant_row(business, city_id):
+    ''' turn a valid business into a restaurant row
+
+    Parameters
+    ----------
+    business: dict
+        a business of an API dict that passed business_reject_reason
+    city_id: int
+        the id in the cities table of the city it was fetched for
+
+    Returns
+    -------
+    tuple
+        the restaurant_row_columns values of the restaurants table, then
+        the tuple of (alias, title) pairs of all its categories (for
+        restaurant_categories) and its business_details row
+    '''
+    location = business['location']
+    coordinates = business.get('coordinates') or {}
+    return (
+        business['id'],
+        city_id,
+        business['name'],
+        business['categories'][0]['title'],
+        business['rating'],
+        business.get('phone'),
+        coordinates.get('latitude'),
+        coordinates.get('longitude'),
+        business.get('review_count'),
+        location.get('city'),
+        location.get('state'),
+        location.get('zip_code'),
+        location.get('address1'),
+        tuple((category.get('alias'), category['title']) for category in business['categories']),
+        business_details(business),
+    )
+
+def restaurant_rows(pages, rejects):
+    ''' validate and normalize the businesses of fetched pages, one
+        at a time, counting what is left out instead of dropping it
+
+    Parameters
+    ----------
+    pages: iterable
+        (city id, location, offset, total, businesses) tuples, as made
+        by fetch_pages
+    rejects: collections.Counter
+        updated in place: reason: number of businesses rejected for it,
+        and 'failed pages' for the pages that could not be fetched
+
+    Yields
+    -------
+    tuple
+        a restaurant row as made by restaurant_row
+    '''
+    for city_id, location, offset, total, businesses in pages:
+        if businesses is None:
+            rejects['failed pages'] += 1
+            continue
+        for business in businesses:
+            reason = business_reject_reason(business)
+            if reason is None:
+                try:
+                    row = restaurant_row(business, city_id)
+                except (KeyError, IndexError, TypeError, ValueError) as error:
+                    reason = f"malformed ({type(error).__name__}: {error})"
+            if reason is not None:
+                rejects[reason] += 1
+                continue
+            yield row
+
+def get_all_restaurant(city_name2):
+    ''' get all restaurant information of a city from the database
+
+    Parameters
+    ----------
+    city_name2: str
+        name of a city
 
     Returns
     -------
     list
         A list of all the restaurant information
     '''
-    restaurant_dict=get_restaurants(city_name2, term='food')
-    restaurant_list=[]
-    id_list=[]
-    count=0
-    for i in restaurant_dict["businesses"]:
-        count+=1
-        all_list=[]
-        try:
-            if i['id'] not in id_list:
-                id_list.append(i['id'])
-                all_list.append(i['id'])
-            else:
-                continue
-            all_list.append(count)
-            all_list.append(i['name'])
-            all_list.append(i['categories'][0]['title'])
-            all_list.append(i['rating'])
-            all_list.append(i['phone'])
-            all_list.append(i['coordinates']['latitude'])
-            all_list.append(i['coordinates']['longitude'])
-            all_list.append(i['review_count'])
-            all_list.append(i['location']['city'])
-            all_list.append(i['location']['state'])
-            all_list.append(i['location']['zip_code'])
-            restaurant_list.append(tuple(all_list))
-            #print(restaurant_list[1])
-        except:
-            continue
-    return restaurant_list
+    return get_info_form_database(list(restaurant_columns[:restaurant_row_columns]), {'CityName': city_name2})
+
+def format_hours(hours):
+    ''' format the opening hours of an API business, e.g.
+        'Mon 11:00-22:00, Tue 11:00-22:00'. Periods without a valid day,
+        start and end are left out, so a partial entry only loses them.
+
+    Parameters
+    ----------
+    hours: list
+        the hours field of an API business
+
+    Returns
+    -------
+    str
+        the opening periods, '' when there are none
+    '''
+    if not isinstance(hours, list) or not hours or not isinstance(hours[0], dict):
+        return ''
+    periods = hours[0].get('open')
+    formatted = []
+    for period in periods if isinstance(periods, list) else []:
+        if not isinstance(period, dict):
+            continue
+        day, start, end = period.get('day'), period.get('start'), period.get('end')
+        if not isinstance(day, int) or not 0 <= day < len(weekdays) \
+                or not all(isinstance(time_of_day, str) and len(time_of_day) == 4 and time_of_day.isdigit()
+                           for time_of_day in (start, end)):
+            continue
+        formatted.append(f"{weekdays[day]} {start[:2]}:{start[2:]}-{end[:2]}:{end[2:]}")
+    return ", ".join(formatted)
+
+def business_details(business):
+    ''' pick the fields of an API business that only the detail view
+        needs, flattened into a business_details row
+
+    Parameters
+    ----------
+    business: dict
+        a business of an API dict
+
+    Returns
+    -------
+    tuple
+        the business_details row
+    '''
+    location = business.get('location') or {}
+    return (
+        business['id'],
+        business.get('alias'),
+        business.get('url'),
+        business.get('image_url'),
+        business.get('price'),
+        business.get('display_phone'),
+        location.get('address2'),
+        location.get('address3'),
+        ", ".join(location.get('display_address') or []),
+        location.get('country'),
+        ", ".join(business.get('transactions') or []),
+        format_hours(business.get('hours')),
+        int(bool(business.get('is_closed'))),
+    )
+
+def fetch_pages(cities, max_workers=FETCH_WORKERS, max_results=YELP_PAGE_LIMIT, queue_size=INGEST_QUEUE_SIZE):
+    ''' fetch the restaurants of many cities at once on a bounded
+        thread pool, printing progress as each city finishes.
+        Every request shares one pooled session and the Yelp rate limit.
+        When max_results is above one page, the first page of a city
+        tells how many businesses it has, and the remaining offset
+        pages of that city are queued on the same pool.
+        At most queue_size pages are requested or waiting to be
+        consumed at any time, so a slow consumer holds the fetchers
+        back instead of the pages piling up in memory.
+
+    Parameters
+    ----------
+    cities: list
+        (city id, location) pairs of the cities to fetch
+    max_workers: int
+        the number of requests in flight at the same time
+    max_results: int
+        the most businesses to fetch for each city (at most 1000)
+    queue_size: int
+        the most pages fetched ahead of the consumer
+
+    Yields
+    -------
+    tuple
+        (city id, location, offset, total, businesses) for every page,
+        in the order the pages finish, the first page of a city before
+        its other pages; businesses is None when the page could not be
+        fetched
+    '''
+    max_results=min(max_results, YELP_MAX_RESULTS)
+    queue_size=max(queue_size, max_workers)
+    waiting=collections.deque((city_id, location, 0, min(YELP_PAGE_LIMIT, max_results))
+                              for city_id, location in cities)
+    pages_left={location: 1 for _, location in cities}
+    fetched=dict.fromkeys(pages_left, 0)
+    total=len(pages_left)
+    done=0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending={}
+        while waiting or pending:
+            while waiting and len(pending) < queue_size:
+                city_id, location, offset, limit=waiting.popleft()
+                pending[executor.submit(get_restaurants, location, CRAWL_TERM, offset, limit)]=(city_id, location, offset)
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                city_id, location, offset=pending.pop(future)
+                pages_left[location]-=1
+                try:
+                    result=future.result()
+                    businesses=result["businesses"]
+                except Exception as error:
+                    print(f"{location} (offset {offset}): failed ({error})")
+                    businesses=None
+                    result={}
+                if offset == 0:
+                    city_total=min(result.get("total", 0), max_results)
+                    for page in range(YELP_PAGE_LIMIT, city_total, YELP_PAGE_LIMIT):
+                        waiting.append((city_id, location, page, min(YELP_PAGE_LIMIT, city_total - page)))
+                        pages_left[location]+=1
+                fetched[location]+=len(businesses or ())
+                if pages_left[location] == 0:
+                    done+=1
+                    print(f"[{done}/{total}] {location}: {fetched[location]} restaurants")
+                yield city_id, location, offset, result.get("total", 0), businesses
+
+###CREATE restaurant DATABASE###
+drop_restaurants = '''
+    DROP TABLE IF EXISTS 'restaurants';
+'''
+create_restaurants = '''
+    CREATE TABLE IF NOT EXISTS 'restaurants' (
+        'id' TEXT PRIMARY KEY,
+        'cityid' INTEGER NOT NULL,
+        'name'  TEXT NOT NULL,
+        'categories'  TEXT,
+        'rating'  REAL,
+        'Phone' TEXT,
+        'Latitude'  REAL,
+        'Longitude'  REAL,
+        'review_count'  INTEGER,
+        'CityName'  TEXT,
+        'StateName'  TEXT,
+        'zipcode'  REAL,
+        'content_hash'  TEXT,
+        'fetched_at'  REAL,
+        'removed_at'  REAL,
+        'address'  TEXT,
+        FOREIGN KEY (cityid) REFERENCES cities (id)
+    );
+'''
+create_meta = '''
+    CREATE TABLE IF NOT EXISTS 'meta' (
+        'key' TEXT PRIMARY KEY,
+        'value' TEXT
+    );
+'''
+# the searches whose results are stored, keyed by their normalized params
+# (see search_key), and the business at each position of their results;
+# business_id is NULL for a position whose business had no id
+create_searches = [
+    '''CREATE TABLE IF NOT EXISTS 'searches' (
+        'key' TEXT PRIMARY KEY,
+        'total' INTEGER NOT NULL,
+        'fetched_at' REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS 'search_results' (
+        'search_key' TEXT NOT NULL,
+        'position' INTEGER NOT NULL,
+        'business_id' TEXT,
+        PRIMARY KEY (search_key, position)
+    ) WITHOUT ROWID''',
+]
+upsert_searches = '''
+    INSERT INTO searches VALUES (?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET total=excluded.total
+'''
+# the businesses found by a search that are not active restaurants: they
+# answer later searches and detail lookups without showing up in the
+# city charts, and a crawl that finds one moves it to restaurants
+create_searched_restaurants = '''
+    CREATE TABLE IF NOT EXISTS 'searched_restaurants' (
+        'id' TEXT PRIMARY KEY,
+        'cityid' INTEGER NOT NULL,
+        'name'  TEXT NOT NULL,
+        'categories'  TEXT,
+        'rating'  REAL,
+        'Phone' TEXT,
+        'Latitude'  REAL,
+        'Longitude'  REAL,
+        'review_count'  INTEGER,
+        'CityName'  TEXT,
+        'StateName'  TEXT,
+        'zipcode'  REAL,
+        'address'  TEXT,
+        'fetched_at'  REAL,
+        FOREIGN KEY (cityid) REFERENCES cities (id)
+    );
+'''
+create_searched_index = "CREATE INDEX IF NOT EXISTS idx_searched_restaurants_city ON searched_restaurants (CityName, name)"
+searched_columns = ("id, cityid, name, categories, rating, Phone, Latitude, Longitude,"
+                    " review_count, CityName, StateName, zipcode, address")
+insert_searched_restaurants = f'''
+    INSERT OR REPLACE INTO searched_restaurants ({searched_columns}, fetched_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# every restaurant a lookup by id can return: the active crawled ones,
+# then the ones only found by searches
+create_known_restaurants = f'''
+    CREATE VIEW IF NOT EXISTS known_restaurants AS
+    SELECT {searched_columns} FROM restaurants WHERE removed_at IS NULL
+    UNION ALL
+    SELECT {searched_columns} FROM searched_restaurants
+'''
+# moves the rows that earlier versions stored in restaurants for searches
+# (with removed_at set at insert time and no content hash) to their table
+move_searched_restaurants = [
+    f'''INSERT OR IGNORE INTO searched_restaurants ({searched_columns}, fetched_at)
+        SELECT {searched_columns}, fetched_at FROM restaurants
+        WHERE content_hash IS NULL AND removed_at IS NOT NULL AND removed_at = fetched_at''',
+    "DELETE FROM restaurants WHERE content_hash IS NULL AND removed_at IS NOT NULL AND removed_at = fetched_at",
+]
+# the city of the same name, or else the nearest one, for a searched business
+nearest_city = '''
+    SELECT COALESCE(
+        (SELECT id FROM cities WHERE CityName = :city COLLATE NOCASE),
+        (SELECT id FROM cities WHERE :lat IS NOT NULL
+         ORDER BY (Latitude - :lat) * (Latitude - :lat) + (Longitude - :lon) * (Longitude - :lon)
+         LIMIT 1),
+        0)
+'''
+# the ids sync_restaurants has seen so far in a refresh; a table of the
+# database rather than a TEMP one, so it does not grow in memory
+create_sync_seen = '''
+    CREATE TABLE IF NOT EXISTS 'sync_seen' (
+        'id' TEXT PRIMARY KEY
+    ) WITHOUT ROWID
+'''
+# the city crawl and position each business was last returned at; only
+# businesses at positions a sync fetched again can be marked as removed
+create_crawl_positions = '''
+    CREATE TABLE IF NOT EXISTS 'crawl_positions' (
+        'business_id' TEXT PRIMARY KEY,
+        'search_key' TEXT NOT NULL,
+        'position' INTEGER NOT NULL
+    ) WITHOUT ROWID
+'''
+# the cities whose restaurants changed since their statistics were last
+# computed; written with each batch, so a sync that is interrupted leaves
+# them for the next one to recompute
+create_sync_dirty = '''
+    CREATE TABLE IF NOT EXISTS 'sync_dirty' (
+        'CityName' TEXT PRIMARY KEY
+    ) WITHOUT ROWID
+'''
+bump_data_version = '''
+    INSERT INTO meta VALUES ('data_version', 1) ON CONFLICT(key)
+    DO UPDATE SET value=CAST(value AS INTEGER) + 1
+'''
+# sets cityid from the cities table: the city of the same name, or else
+# the nearest city; restaurants fetched before cityid was the city id
+# carried their position in the search results there. Only run by
+# relink_cities, once the cities have coordinates to compare with
+relink_city_ids = '''
+    UPDATE restaurants SET cityid = COALESCE(
+        (SELECT c.id FROM cities AS c WHERE c.CityName = restaurants.CityName COLLATE NOCASE),
+        (SELECT c.id FROM cities AS c,
+                (SELECT restaurants.Latitude AS lat, restaurants.Longitude AS lon) AS r
+         WHERE r.lat IS NOT NULL
+         ORDER BY (c.Latitude - r.lat) * (c.Latitude - r.lat) + (c.Longitude - r.lon) * (c.Longitude - r.lon)
+         LIMIT 1),
+        cityid)
+'''
+# the restaurants whose cityid points at no city, e.g. after earlier
+# versions deleted the cities that dropped out of the list
+relink_orphan_city_ids = relink_city_ids + "    WHERE cityid NOT IN (SELECT id FROM cities)\n"
+upsert_restaurants = '''
+    INSERT INTO restaurants
+        (id, cityid, name, categories, rating, Phone, Latitude, Longitude,
+         review_count, CityName, StateName, zipcode, address, content_hash, fetched_at, removed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)
+    ON CONFLICT(id) DO UPDATE SET
+        cityid=excluded.cityid, name=excluded.name, categories=excluded.categories,
+        rating=excluded.rating, Phone=excluded.Phone, Latitude=excluded.Latitude,
+        Longitude=excluded.Longitude, review_count=excluded.review_count,
+        CityName=excluded.CityName, StateName=excluded.StateName, zipcode=excluded.zipcode,
+        address=excluded.address, content_hash=excluded.content_hash, fetched_at=excluded.fetched_at, removed_at=NULL
+'''
+create_city_stats = '''
+    CREATE TABLE IF NOT EXISTS 'city_stats' (
+        'CityName' TEXT PRIMARY KEY,
+        'count' INTEGER NOT NULL,
+        'mean' REAL,
+        'variance' REAL,
+        'rating_histogram' TEXT,
+        'review_quantiles' TEXT,
+        'top_categories' TEXT
+    );
+'''
+upsert_city_stats = '''
+    INSERT OR REPLACE INTO city_stats
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+# R*Tree over the coordinates of the active restaurants, kept in step
+# with the restaurants table by the triggers below
+create_spatial_index = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS restaurants_rtree
+        USING rtree(id, minLat, maxLat, minLon, maxLon, +business_id)''',
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_rtree_insert AFTER INSERT ON restaurants
+        WHEN NEW.removed_at IS NULL AND NEW.Latitude IS NOT NULL AND NEW.Longitude IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO restaurants_rtree
+            VALUES (NEW.rowid, NEW.Latitude, NEW.Latitude, NEW.Longitude, NEW.Longitude, NEW.id);
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_rtree_update AFTER UPDATE ON restaurants
+        BEGIN
+            DELETE FROM restaurants_rtree WHERE id = OLD.rowid;
+            INSERT INTO restaurants_rtree
+            SELECT NEW.rowid, NEW.Latitude, NEW.Latitude, NEW.Longitude, NEW.Longitude, NEW.id
+            WHERE NEW.removed_at IS NULL AND NEW.Latitude IS NOT NULL AND NEW.Longitude IS NOT NULL;
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_rtree_delete AFTER DELETE ON restaurants
+        BEGIN
+            DELETE FROM restaurants_rtree WHERE id = OLD.rowid;
+        END''',
+]
+# full-text index over name, categories, city and zip code of the active
+# restaurants, kept in step by triggers like the R*Tree; the vocabulary
+# table lists the indexed terms for typo correction
+create_search_index = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS restaurants_fts
+        USING fts5(name, categories, CityName, zipcode, business_id UNINDEXED,
+                   tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')''',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS restaurants_fts_terms USING fts5vocab(restaurants_fts, 'row')",
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_fts_insert AFTER INSERT ON restaurants
+        WHEN NEW.removed_at IS NULL
+        BEGIN
+            INSERT INTO restaurants_fts (rowid, name, categories, CityName, zipcode, business_id)
+            VALUES (NEW.rowid, NEW.name, NEW.categories, NEW.CityName,
+                    printf('%05d', NEW.zipcode), NEW.id);
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_fts_update AFTER UPDATE ON restaurants
+        BEGIN
+            DELETE FROM restaurants_fts WHERE rowid = OLD.rowid;
+            INSERT INTO restaurants_fts (rowid, name, categories, CityName, zipcode, business_id)
+            SELECT NEW.rowid, NEW.name, NEW.categories, NEW.CityName,
+                   printf('%05d', NEW.zipcode), NEW.id
+            WHERE NEW.removed_at IS NULL;
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS restaurants_fts_delete AFTER DELETE ON restaurants
+        BEGIN
+            DELETE FROM restaurants_fts WHERE rowid = OLD.rowid;
+        END''',
+]
+create_categories = [
+    '''CREATE TABLE IF NOT EXISTS 'categories' (
+        'id' INTEGER PRIMARY KEY,
+        'title' TEXT NOT NULL UNIQUE,
+        'alias' TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS 'restaurant_categories' (
+        'restaurant_id' TEXT NOT NULL,
+        'category_id' INTEGER NOT NULL,
+        PRIMARY KEY (restaurant_id, category_id),
+        FOREIGN KEY (restaurant_id) REFERENCES restaurants (id),
+        FOREIGN KEY (category_id) REFERENCES categories (id)
+    ) WITHOUT ROWID''',
+    '''CREATE INDEX IF NOT EXISTS idx_restaurant_categories_category
+        ON restaurant_categories (category_id, restaurant_id)''',
+    '''CREATE TABLE IF NOT EXISTS 'category_city_counts' (
+        'category_id' INTEGER NOT NULL,
+        'CityName' TEXT NOT NULL,
+        'count' INTEGER NOT NULL,
+        'mean_rating' REAL,
+        PRIMARY KEY (category_id, CityName)
+    ) WITHOUT ROWID''',
+    '''CREATE INDEX IF NOT EXISTS idx_category_city_counts_city
+        ON category_city_counts (CityName)''',
+]
+# secondary indexes; the CityName one also holds removed_at and every
+# column the charts read, so per-city chart queries are answered from
+# the index alone
+create_indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_restaurants_cityid ON restaurants (cityid)",
+    "CREATE INDEX IF NOT EXISTS idx_restaurants_rating ON restaurants (rating)",
+    "CREATE INDEX IF NOT EXISTS idx_restaurants_categories ON restaurants (categories)",
+    '''CREATE INDEX IF NOT EXISTS idx_restaurants_city_chart
+        ON restaurants (CityName, removed_at, rating, review_count, name, categories, Latitude, Longitude)''',
+]
+# the fields of the Yelp payload kept for the detail view, one row per business
+create_business_details = '''
+    CREATE TABLE IF NOT EXISTS 'business_details' (
+        'id' TEXT PRIMARY KEY,
+        'alias' TEXT,
+        'url' TEXT,
+        'image_url' TEXT,
+        'price' TEXT,
+        'display_phone' TEXT,
+        'address2' TEXT,
+        'address3' TEXT,
+        'display_address' TEXT,
+        'country' TEXT,
+        'transactions' TEXT,
+        'hours' TEXT,
+        'is_closed' INTEGER,
+        FOREIGN KEY (id) REFERENCES restaurants (id)
+    ) WITHOUT ROWID
+'''
+upsert_business_details = '''
+    INSERT OR REPLACE INTO business_details
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# the number of restaurants columns at the start of a restaurant_row row
+restaurant_row_columns = 13
+# bumped whenever migrate_database learns a new step; the read-only
+# commands refuse a database migrated by an older version
+SCHEMA_VERSION = 3
+# columns added after the first release of final.db, with their types
+added_restaurant_columns = {
+    'content_hash': 'TEXT',
+    'fetched_at': 'REAL',
+    'removed_at': 'REAL',
+    'address': 'TEXT',
+}
+
+# pragmas set on every connection to the project database; WAL lets
+# readers keep reading while a refresh writes
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+READ_POOL_SIZE = 8
+
+class ConnectionManager:
+    '''the connections of one database: a single writable connection
+    shared behind a lock, and a thread-safe pool of read-only ones.
+    Every connection gets SQLITE_PRAGMAS, and the database is switched
+    to WAL the first time it is opened for writing, so readers in this
+    or other processes are not blocked by a running refresh.
+
+    Instance Attributes
+    -------------------
+    dbname: string
+        the database file (e.g. 'final.db')
+
+    pool_size: int
+        the most read-only connections opened by reader() (e.g. 8)
+    '''
+    def __init__(self, dbname, pool_size=READ_POOL_SIZE):
+        self.dbname=dbname
+        self.pool_size=pool_size
+        self._idle=queue.LifoQueue()
+        self._opened=0
+        self._pool_lock=threading.Lock()
+        self._writer=None
+        self._writer_lock=threading.RLock()
+
+    def connect(self, readonly=False):
+        ''' open a new configured connection, closed by the caller
+
+        Parameters
+        ----------
+        readonly: bool
+            open the existing database read-only
+
+        Returns
+        -------
+        sqlite3.Connection
+            the open connection
+        '''
+        if readonly:
+            conn=sqlite3.connect(f'file:{self.dbname}?mode=ro', uri=True, cached_statements=256,
+                                 check_same_thread=False)
+        else:
+            conn=sqlite3.connect(self.dbname, cached_statements=256, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+        for name, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    @contextlib.contextmanager
+    def writer(self):
+        ''' use the single writable connection; other threads wanting
+        it wait until the block ends '''
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer=self.connect()
+            yield self._writer
+
+    @contextlib.contextmanager
+    def reader(self):
+        ''' borrow a read-only connection from the pool, opening one
+        while fewer than pool_size exist and waiting otherwise. While
+        it is borrowed, get_read_connection returns it in this thread.
+        '''
+        try:
+            conn=self._idle.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                opened=self._opened < self.pool_size
+                if opened:
+                    self._opened+=1
+            conn=self.connect(readonly=True) if opened else self._idle.get()
+        previous=getattr(_local, 'conn', None), getattr(_local, 'dbname', None)
+        _local.conn, _local.dbname=conn, self.dbname
+        try:
+            yield conn
+        finally:
+            _local.conn, _local.dbname=previous
+            self._idle.put(conn)
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer=None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._pool_lock:
+            self._opened=0
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_manager():
+    ''' the ConnectionManager of DBNAME
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    ConnectionManager
+        the manager, created on first use
+    '''
+    with _managers_lock:
+        if DBNAME not in _managers:
+            _managers[DBNAME]=ConnectionManager(DBNAME)
+        return _managers[DBNAME]
+
+def get_connection(readonly=False):
+    ''' open a new configured connection to the project database; the
+        caller closes it. Writers should prefer get_manager().writer().
+
+    Parameters
+    ----------
+    readonly: bool
+        open the existing database read-only, which is what every
+        query and chart uses; building the database needs False
+
+    Returns
+    -------
+    sqlite3.Connection
+        the open connection
+    '''
+    return get_manager().connect(readonly)
+
+def migrate_database(conn):
+    ''' bring the schema of an existing database up to date.
+        Every step checks what is already there, so it is safe to
+        run on new, old and already migrated databases.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+
+    Returns
+    -------
+    None
+    '''
+    with conn:
+        conn.execute(create_cities)
+        if 'rank' not in [row[1] for row in conn.execute("PRAGMA table_info('cities')")]:
+            # the ids of earlier versions were the population ranks
+            conn.execute("ALTER TABLE cities ADD COLUMN 'rank' INTEGER")
+            conn.execute("UPDATE cities SET rank=id")
+        for statement in create_city_indexes:
+            conn.execute(statement)
+        conn.execute(create_city_pages)
+        conn.execute(create_restaurants)
+        conn.execute(create_meta)
+        conn.execute(create_city_stats)
+        conn.execute(create_business_details)
+        columns=[row[1] for row in conn.execute("PRAGMA table_info('restaurants')")]
+        for column, column_type in added_restaurant_columns.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE restaurants ADD COLUMN '{column}' {column_type}")
+        # a prefix of idx_restaurants_city_chart, so it only slowed down writes
+        conn.execute("DROP INDEX IF EXISTS idx_restaurants_city")
+        for statement in create_indexes + create_spatial_index + create_search_index + create_categories \
+                + create_searches + [create_searched_restaurants, create_searched_index, create_known_restaurants]:
+            conn.execute(statement)
+        if get_schema_version(conn) < 2:
+            for statement in move_searched_restaurants:
+                conn.execute(statement)
+        if conn.execute("SELECT 1 FROM restaurant_categories LIMIT 1").fetchone() is None \
+                and conn.execute("SELECT 1 FROM restaurants LIMIT 1").fetchone() is not None:
+            backfill_categories(conn)
+        indexed=conn.execute("SELECT COUNT(*) FROM restaurants_rtree").fetchone()[0]
+        active=conn.execute("SELECT COUNT(*) FROM restaurants WHERE removed_at IS NULL"
+                            " AND Latitude IS NOT NULL AND Longitude IS NOT NULL").fetchone()[0]
+        if indexed != active:
+            rebuild_spatial_index(conn)
+        if conn.execute("SELECT COUNT(*) FROM restaurants_fts").fetchone()[0] \
+                != conn.execute("SELECT COUNT(*) FROM restaurants WHERE removed_at IS NULL").fetchone()[0]:
+            rebuild_search_index(conn)
+        if conn.execute("SELECT 1 FROM city_stats LIMIT 1").fetchone() is None:
+            refresh_city_stats(conn)
+        relink_cities(conn)
+        conn.execute(relink_orphan_city_ids)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (SCHEMA_VERSION,))
+        conn.execute("PRAGMA optimize")
+
+def relink_cities(conn):
+    ''' set the cityid of the restaurants of an older database to the
+        id of their city, once. The cities must have been scraped by
+        the current parser first: earlier databases stored truncated
+        coordinates, which would send restaurants to the wrong city.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection, inside a transaction
+
+    Returns
+    -------
+    bool
+        True when the restaurants were relinked
+    '''
+    if conn.execute("SELECT 1 FROM meta WHERE key='city_ids'").fetchone() is not None \
+            or conn.execute("SELECT 1 FROM city_pages WHERE parser_version=?",
+                            (CITY_PARSER_VERSION,)).fetchone() is None:
+        return False
+    conn.execute(relink_city_ids)
+    conn.execute("INSERT INTO meta VALUES ('city_ids', 1)")
+    return True
+
+def get_schema_version(conn):
+    ''' get the SCHEMA_VERSION the database was last migrated to
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        an open connection
+
+    Returns
+    -------
+    int
+        the schema version (0 for a database never migrated)
+    '''
+    try:
+        row=conn.execute("SELECT value FROM meta WHERE key='schema_version'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+def get_data_version(conn):
+    ''' get the data version of the database, which goes up every
+        time a refresh changes any restaurant
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        an open connection
+
+    Returns
+    -------
+    int
+        the data version (0 for a database never synced)
+    '''
+    try:
+        row=conn.execute("SELECT value FROM meta WHERE key='data_version'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+def restaurant_hash(row):
+    ''' content hash of a restaurant row, used to tell which
+        businesses changed since the last refresh
+
+    Parameters
+    ----------
+    row: tuple
+        a restaurant row as made by restaurant_row
+
+    Returns
+    -------
+    str
+        hex digest of the row
+    '''
+    return hashlib.sha1(json.dumps(row).encode()).hexdigest()
+
+@trace('ingest')
+def sync_restaurants(conn, cities, max_workers=FETCH_WORKERS, max_results=YELP_PAGE_LIMIT,
+                     batch_size=INGEST_BATCH_SIZE):
+    ''' fetch every city concurrently and write only what changed.
+        The businesses stream through fetch_pages and restaurant_rows
+        into batches of batch_size rows (the result list of every page
+        is stored as well, see record_search_pages); each batch looks
+        up the stored content hashes of just its own ids, upserts the
+        new and changed rows with executemany and commits, so memory
+        stays the same however many cities and pages are crawled.
+        Unchanged rows are not written at all. A batch that changes
+        anything also records its cities in sync_dirty and bumps the
+        data version in the same transaction. Once every page is in,
+        the businesses last returned by the crawl of a city fetched
+        this time, at a position below max_results, and not returned
+        again, get removed_at set (also when the list of the city got
+        shorter than their position), and the statistics of the dirty cities are
+        recomputed; after an interrupted sync, the next one does that.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection to a migrated database
+    cities: list
+        (city id, location) pairs: the id in the cities table and the
+        location to search, e.g. the CityName of that row
+    max_workers: int
+        the number of requests in flight at the same time
+    max_results: int
+        the most businesses to fetch for each city, 50 is one page
+        and 1000 is the deepest crawl the API allows
+    batch_size: int
+        restaurant rows written per transaction
+
+    Returns
+    -------
+    dict
+        counts of 'inserted', 'updated', 'unchanged', 'removed' and
+        'rejected' rows
+    '''
+    counts={'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'rejected': 0}
+    rejects=collections.Counter()
+    fetched_at=time.time()
+    with conn:
+        conn.execute(create_sync_seen)
+        conn.execute(create_sync_dirty)
+        conn.execute(create_crawl_positions)
+        conn.execute("DELETE FROM sync_seen")
+    pages=record_search_pages(conn, fetch_pages(cities, max_workers, max_results), fetched_at)
+    rows=restaurant_rows(pages, rejects)
+    while True:
+        batch={}
+        for row in itertools.islice(rows, batch_size):
+            batch.setdefault(row[0], row)
+        if not batch:
+            break
+        with conn:
+            ids=json.dumps(list(batch))
+            for (business_id,) in conn.execute("SELECT value FROM json_each(?)"
+                                               " WHERE value IN (SELECT id FROM sync_seen)", (ids,)):
+                del batch[business_id]
+            conn.executemany("INSERT INTO sync_seen VALUES (?)", ((business_id,) for business_id in batch))
+            stored={row[0]: row[1:] for row in conn.execute(
+                "SELECT id, content_hash, removed_at, CityName FROM restaurants"
+                " WHERE id IN (SELECT value FROM json_each(?))", (ids,))}
+            changed=[]
+            changed_cities=set()
+            for business_id, row in batch.items():
+                content_hash=restaurant_hash(row)
+                old=stored.get(business_id)
+                if old is None:
+                    counts['inserted']+=1
+                elif old[0] != content_hash or old[1] is not None:
+                    counts['updated']+=1
+                    changed_cities.add(old[2])
+                else:
+                    counts['unchanged']+=1
+                    continue
+                changed_cities.add(row[9])
+                changed.append((row, content_hash))
+            if changed:
+                conn.executemany("INSERT OR IGNORE INTO sync_dirty VALUES (?)",
+                                 ((city,) for city in changed_cities))
+                conn.execute(bump_data_version)
+            conn.executemany(upsert_restaurants, [row[:restaurant_row_columns] + (content_hash, fetched_at)
+                                                  for row, content_hash in changed])
+            conn.execute("DELETE FROM searched_restaurants WHERE id IN (SELECT value FROM json_each(?))",
+                         (json.dumps([row[0] for row, _ in changed]),))
+            write_restaurant_categories(conn, [(row[0], row[restaurant_row_columns]) for row, _ in changed])
+            conn.executemany(upsert_business_details, [row[restaurant_row_columns + 1] for row, _ in changed])
+    failed_pages=rejects.pop('failed pages', 0)
+    counts['rejected']=sum(rejects.values())
+    if rejects:
+        print(f"{counts['rejected']} businesses rejected: "
+              + ", ".join(f"{count} {reason}" for reason, count in rejects.most_common()))
+    with conn:
+        if not failed_pages:
+            counts['removed']=conn.execute(
+                "UPDATE restaurants SET removed_at=? WHERE removed_at IS NULL"
+                " AND id NOT IN (SELECT id FROM sync_seen)"
+                " AND id IN (SELECT p.business_id FROM crawl_positions AS p"
+                " JOIN searches AS s ON s.key = p.search_key"
+                " WHERE s.fetched_at = ? AND p.position < ?)",
+                (fetched_at, fetched_at, min(max_results, YELP_MAX_RESULTS))).rowcount
+            conn.execute("DELETE FROM crawl_positions WHERE business_id IN"
+                         " (SELECT id FROM restaurants WHERE removed_at=?)", (fetched_at,))
+            conn.execute("INSERT OR IGNORE INTO sync_dirty"
+                         " SELECT DISTINCT CityName FROM restaurants WHERE removed_at=?", (fetched_at,))
+        else:
+            print(f"{failed_pages} pages failed, so no restaurant is marked as removed this time.")
+        dirty_cities=[row[0] for row in conn.execute("SELECT CityName FROM sync_dirty")]
+        if dirty_cities:
+            refresh_city_stats(conn, dirty_cities)
+            conn.execute(bump_data_version)
+        conn.execute("DELETE FROM sync_dirty")
+        conn.execute("DELETE FROM sync_seen")
+    TRACER.note(rows=counts['inserted'] + counts['updated'])
+    return counts
+
+###CITY STATISTICS###
+# rating buckets of the city_stats histogram, Yelp ratings go in steps of 0.5
+rating_buckets = [1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+review_quantiles = [0.25, 0.5, 0.75, 0.9]
+top_category_count = 5
+
+def compute_city_stats(conn, city_name):
+    ''' compute the statistics of the restaurants of one city
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        an open connection
+    city_name: str
+        name of a city (the CityName of its restaurants)
+
+    Returns
+    -------
+    tuple
+        a city_stats row, or None when the city has no restaurants
+    '''
+    count, mean, mean_square = conn.execute(
+        "SELECT COUNT(*), AVG(rating), AVG(rating * rating) FROM restaurants"
+        " WHERE CityName=? AND removed_at IS NULL", (city_name,)).fetchone()
+    if count == 0:
+        return None
+    histogram = [0] * len(rating_buckets)
+    for rating, rating_count in conn.execute(
+            "SELECT rating, COUNT(*) FROM restaurants WHERE CityName=? AND removed_at IS NULL"
+            " GROUP BY rating", (city_name,)):
+        bucket = min(max(round((rating - rating_buckets[0]) * 2), 0), len(rating_buckets) - 1)
+        histogram[bucket] += rating_count
+    reviews = [row[0] for row in conn.execute(
+        "SELECT review_count FROM restaurants WHERE CityName=? AND removed_at IS NULL"
+        " ORDER BY review_count", (city_name,))]
+    quantiles = [reviews[min(int(q * count), count - 1)] for q in review_quantiles]
+    top_categories = conn.execute(
+        "SELECT categories, COUNT(*) AS n FROM restaurants WHERE CityName=? AND removed_at IS NULL"
+        " GROUP BY categories ORDER BY n DESC, categories LIMIT ?",
+        (city_name, top_category_count)).fetchall()
+    return (city_name, count, mean, max(mean_square - mean * mean, 0.0),
+            json.dumps(histogram), json.dumps(quantiles), json.dumps(top_categories))
+
+def refresh_city_stats(conn, city_names=None):
+    ''' recompute the city_stats and category_city_counts rows of some
+        cities, or of every city.
+        Called by sync_restaurants inside its transaction, so the
+        statistics always match the restaurants they describe.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    city_names: iterable
+        names of the cities to recompute, None for all of them
+
+    Returns
+    -------
+    int
+        the number of cities recomputed
+    '''
+    if city_names is None:
+        conn.execute("DELETE FROM city_stats")
+        conn.execute("DELETE FROM category_city_counts")
+        city_names = [row[0] for row in conn.execute(
+            "SELECT DISTINCT CityName FROM restaurants WHERE removed_at IS NULL")]
+    count = 0
+    for city_name in city_names:
+        row = compute_city_stats(conn, city_name)
+        if row is None:
+            conn.execute("DELETE FROM city_stats WHERE CityName=?", (city_name,))
+        else:
+            conn.execute(upsert_city_stats, row)
+        conn.execute("DELETE FROM category_city_counts WHERE CityName=?", (city_name,))
+        conn.execute(
+            "INSERT INTO category_city_counts"
+            " SELECT rc.category_id, b.CityName, COUNT(*), AVG(b.rating)"
+            " FROM restaurants AS b JOIN restaurant_categories AS rc ON rc.restaurant_id = b.id"
+            " WHERE b.CityName=? AND b.removed_at IS NULL GROUP BY rc.category_id", (city_name,))
+        count += 1
+    return count
+
+def get_city_stats(city_name):
+    ''' look up the precomputed statistics of a city
+
+    Parameters
+    ----------
+    city_name: str
+        name of a city
+
+    Returns
+    -------
+    dict
+        count, mean, variance, rating_histogram (a count for each of
+        rating_buckets), review_quantiles (review counts at the
+        review_quantiles) and top_categories ([category, count] pairs),
+        or None when the city has no restaurants
+    '''
+    row = get_read_connection().execute(
+        "SELECT count, mean, variance, rating_histogram, review_quantiles, top_categories"
+        " FROM city_stats WHERE CityName=?", (city_name,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'count': row[0],
+        'mean': row[1],
+        'variance': row[2],
+        'rating_histogram': json.loads(row[3]),
+        'review_quantiles': json.loads(row[4]),
+        'top_categories': json.loads(row[5]),
+    }
+
+###CATEGORIES###
+def category_ids(conn, categories):
+    ''' get the ids of categories, adding the ones not seen before
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    categories: iterable
+        (alias, title) pairs, alias may be None
+
+    Returns
+    -------
+    dict
+        title: category id
+    '''
+    categories = dict((title, alias) for alias, title in categories)
+    conn.executemany(
+        "INSERT INTO categories (title, alias) VALUES (?, ?)"
+        " ON CONFLICT(title) DO UPDATE SET alias=coalesce(excluded.alias, alias)",
+        categories.items())
+    ids = {}
+    titles = list(categories)
+    for start in range(0, len(titles), 500):
+        chunk = titles[start:start + 500]
+        ids.update(conn.execute(
+            f"SELECT title, id FROM categories WHERE title IN ({', '.join('?' * len(chunk))})", chunk))
+    return ids
+
+def write_restaurant_categories(conn, restaurant_categories):
+    ''' replace the categories of some restaurants
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    restaurant_categories: list
+        (restaurant id, tuple of (alias, title) pairs) tuples
+
+    Returns
+    -------
+    None
+    '''
+    ids = category_ids(conn, [pair for _, pairs in restaurant_categories for pair in pairs])
+    conn.executemany("DELETE FROM restaurant_categories WHERE restaurant_id=?",
+                     ((restaurant_id,) for restaurant_id, _ in restaurant_categories))
+    conn.executemany("INSERT OR IGNORE INTO restaurant_categories VALUES (?, ?)",
+                     ((restaurant_id, ids[title]) for restaurant_id, pairs in restaurant_categories
+                      for _, title in pairs))
+
+def backfill_categories(conn):
+    ''' fill restaurant_categories for a database built before the
+        categories tables existed. Only the first category of each
+        restaurant was stored then; the others arrive with the next
+        refresh.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+
+    Returns
+    -------
+    None
+    '''
+    rows = conn.execute("SELECT id, categories FROM restaurants WHERE categories IS NOT NULL").fetchall()
+    write_restaurant_categories(conn, [(business_id, ((None, title),)) for business_id, title in rows])
+    refresh_city_stats(conn)
+
+def find_category(category):
+    ''' look up a category by title or alias, ignoring case
+
+    Parameters
+    ----------
+    category: str
+        a category title (e.g. 'Pizza') or alias (e.g. 'pizza')
+
+    Returns
+    -------
+    tuple
+        (id, title), or None when there is no such category
+    '''
+    return get_read_connection().execute(
+        "SELECT id, title FROM categories WHERE title = ? COLLATE NOCASE OR alias = ? LIMIT 1",
+        (category, category.lower())).fetchone()
+
+def top_cities_for_category(category, n=10):
+    ''' the cities with the most restaurants of a category, read from
+        the precomputed category_city_counts
+
+    Parameters
+    ----------
+    category: str
+        a category title or alias
+    n: int
+        how many cities to return
+
+    Returns
+    -------
+    list
+        (CityName, count, mean rating) tuples, most restaurants first
+    '''
+    found = find_category(category)
+    if found is None:
+        return []
+    return get_read_connection().execute(
+        "SELECT CityName, count, mean_rating FROM category_city_counts WHERE category_id=?"
+        " ORDER BY count DESC, mean_rating DESC LIMIT ?", (found[0], n)).fetchall()
+
+def top_restaurants_for_category(category, n=10, city_name=None):
+    ''' the best rated restaurants of a category, in one city or in all
+
+    Parameters
+    ----------
+    category: str
+        a category title or alias
+    n: int
+        how many restaurants to return
+    city_name: str
+        only look in this city, None for every city
+
+    Returns
+    -------
+    list
+        (name, CityName, rating, review_count, id) tuples, best first
+    '''
+    found = find_category(category)
+    if found is None:
+        return []
+    command = ("SELECT b.name, b.CityName, b.rating, b.review_count, b.id"
+               " FROM restaurant_categories AS rc JOIN restaurants AS b ON b.id = rc.restaurant_id"
+               " WHERE rc.category_id=? AND b.removed_at IS NULL")
+    values = [found[0]]
+    if city_name is not None:
+        command += " AND b.CityName=?"
+        values.append(city_name)
+    command += " ORDER BY b.rating DESC, b.review_count DESC LIMIT ?"
+    return get_read_connection().execute(command, values + [n]).fetchall()
+
+def get_restaurant_categories(business_id):
+    ''' all category titles of a restaurant
+
+    Parameters
+    ----------
+    business_id: str
+        the Yelp id of the restaurant
+
+    Returns
+    -------
+    list
+        the category titles
+    '''
+    return [row[0] for row in get_read_connection().execute(
+        "SELECT c.title FROM restaurant_categories AS rc JOIN categories AS c ON c.id = rc.category_id"
+        " WHERE rc.restaurant_id=? ORDER BY c.title", (business_id,))]
+
+###SPATIAL INDEX###
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+def rebuild_spatial_index(conn):
+    ''' fill restaurants_rtree again from the active restaurants
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+
+    Returns
+    -------
+    None
+    '''
+    conn.execute("DELETE FROM restaurants_rtree")
+    conn.execute(
+        "INSERT INTO restaurants_rtree SELECT rowid, Latitude, Latitude, Longitude, Longitude, id"
+        " FROM restaurants WHERE removed_at IS NULL AND Latitude IS NOT NULL AND Longitude IS NOT NULL")
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    ''' great-circle distance between two points
+
+    Parameters
+    ----------
+    lat1, lon1, lat2, lon2: float
+        coordinates of the two points in degrees
+
+    Returns
+    -------
+    float
+        the distance in kilometers
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def restaurants_in_radius(latitude, longitude, radius_km):
+    ''' find the restaurants within radius_km of a point. The R*Tree
+        returns the restaurants inside the bounding box of the circle
+        and only those get an exact haversine distance.
+
+    Parameters
+    ----------
+    latitude: float
+        latitude of the point
+    longitude: float
+        longitude of the point
+    radius_km: float
+        the search radius in kilometers
+
+    Returns
+    -------
+    list
+        (distance in km, name, CityName, rating, Latitude, Longitude, id)
+        tuples sorted by distance
+    '''
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+    candidates = get_read_connection().execute(
+        "SELECT b.name, b.CityName, b.rating, b.Latitude, b.Longitude, b.id"
+        " FROM restaurants_rtree AS t JOIN restaurants AS b ON b.id = t.business_id"
+        " WHERE t.maxLat >= ? AND t.minLat <= ? AND t.maxLon >= ? AND t.minLon <= ?",
+        (latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon)).fetchall()
+    found = []
+    for name, city_name, rating, lat, lon, business_id in candidates:
+        distance = haversine_km(latitude, longitude, lat, lon)
+        if distance <= radius_km:
+            found.append((distance, name, city_name, rating, lat, lon, business_id))
+    found.sort()
+    return found
+
+def restaurants_near(latitude, longitude, k=10, radius_km=None):
+    ''' find the k restaurants nearest to a point, across all cities.
+        Without a radius the search box starts at 1 km and doubles until
+        it holds k restaurants, so only nearby rows are ever read.
+
+    Parameters
+    ----------
+    latitude: float
+        latitude of the point
+    longitude: float
+        longitude of the point
+    k: int
+        the most restaurants to return, None for all within the radius
+        (which then must be given)
+    radius_km: float
+        only return restaurants within this distance, None for no limit
+
+    Returns
+    -------
+    list
+        (distance in km, name, CityName, rating, Latitude, Longitude, id)
+        tuples sorted by distance
+
+    Raises
+    ------
+    ValueError
+        when neither k nor radius_km is given
+    '''
+    if k is None and radius_km is None:
+        raise ValueError("Give k or a radius: without either every restaurant would be returned")
+    if radius_km is not None:
+        found = restaurants_in_radius(latitude, longitude, radius_km)
+        return found if k is None else found[:k]
+    search_km = 1.0
+    while True:
+        found = restaurants_in_radius(latitude, longitude, search_km)
+        if len(found) >= k or search_km >= math.pi * EARTH_RADIUS_KM:
+            return found[:k]
+        search_km *= 2
+
+def print_restaurants_near(latitude, longitude, k=10, radius_km=None):
+    ''' print the restaurants nearest to a point
+
+    Parameters
+    ----------
+    latitude: float
+        latitude of the point
+    longitude: float
+        longitude of the point
+    k: int
+        the most restaurants to print
+    radius_km: float
+        only print restaurants within this distance, None for no limit
+
+    Returns
+    -------
+    None
+    '''
+    found = restaurants_near(latitude, longitude, k, radius_km)
+    if not found:
+        print('No restaurants found.')
+    for number, (distance, name, city_name, rating, lat, lon, business_id) in enumerate(found, start=1):
+        print(number, (name, city_name, rating, f"{distance:.2f} km"))
+    print('-' * 47)
+
+###RESTAURANT SEARCH###
+_search_terms = {}
+
+def rebuild_search_index(conn):
+    ''' fill restaurants_fts again from the active restaurants
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+
+    Returns
+    -------
+    None
+    '''
+    conn.execute("DELETE FROM restaurants_fts")
+    conn.execute(
+        "INSERT INTO restaurants_fts (rowid, name, categories, CityName, zipcode, business_id)"
+        " SELECT rowid, name, categories, CityName, printf('%05d', zipcode), id"
+        " FROM restaurants WHERE removed_at IS NULL")
+
+def search_terms(first_letter):
+    ''' the indexed search terms starting with a letter, read from the
+        FTS vocabulary and cached until the data version changes
+
+    Parameters
+    ----------
+    first_letter: str
+        the first letter of the terms
+
+    Returns
+    -------
+    list
+        the terms
+    '''
+    conn = get_read_connection()
+    key = (DBNAME, get_data_version(conn), first_letter)
+    if key not in _search_terms:
+        if len(_search_terms) > 64:
+            _search_terms.clear()
+        _search_terms[key] = [row[0] for row in conn.execute(
+            "SELECT term FROM restaurants_fts_terms WHERE term >= ? AND term < ?",
+            (first_letter, first_letter + '\U0010ffff'))]
+    return _search_terms[key]
+
+def search_restaurants(query, city_name=None, limit=10):
+    ''' search restaurants by name, category, city or zip code.
+        Every word of the query matches as a prefix ("pizz" finds
+        "Pizzeria"), results are ranked by bm25 with the name weighted
+        most, and when nothing matches, misspelled words are replaced by
+        the closest indexed terms ("piza" finds "pizza").
+
+    Parameters
+    ----------
+    query: str
+        the words to search for
+    city_name: str
+        only search restaurants of this city, None for every city
+    limit: int
+        the most restaurants to return
+
+    Returns
+    -------
+    list
+        (name, CityName, categories, rating, id) tuples, best match first
+    '''
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return []
+    command = ("SELECT b.name, b.CityName, b.categories, b.rating, b.id"
+               " FROM restaurants_fts JOIN restaurants AS b ON b.id = restaurants_fts.business_id"
+               " WHERE restaurants_fts MATCH ?")
+    values = []
+    if city_name is not None:
+        command += " AND b.CityName = ?"
+        values.append(city_name)
+    command += " ORDER BY bm25(restaurants_fts, 10.0, 2.0, 1.0, 1.0) LIMIT ?"
+    conn = get_read_connection()
+    expression = " AND ".join(f'"{word}"*' for word in words)
+    results = conn.execute(command, [expression] + values + [limit]).fetchall()
+    if results:
+        return results
+    terms = []
+    for word in words:
+        close = difflib.get_close_matches(word, search_terms(word[0]), n=3, cutoff=0.7)
+        terms.append("(" + " OR ".join([f'"{word}"*'] + [f'"{term}"' for term in close]) + ")")
+    return conn.execute(command, [" AND ".join(terms)] + values + [limit]).fetchall()
+
+###RESTAURANT QUERIES###
+# the fields of a find_restaurants result
+found_fields = ('id', 'name', 'categories', 'rating', 'price', 'review_count', 'Latitude', 'Longitude',
+                'address', 'CityName', 'StateName')
+
+def search_key(params):
+    ''' the key of a search in the searches table: its normalized
+        params without offset and limit, as sorted JSON
+
+    Parameters
+    ----------
+    params: dict
+        params made by normalize_search
+
+    Returns
+    -------
+    str
+        the key
+    '''
+    return json.dumps({name: value for name, value in params.items() if name not in ('offset', 'limit')},
+                      sort_keys=True)
+
+def store_search_page(conn, params, offset, total, businesses, fetched_at):
+    ''' store the result list of one page of a search. The first page
+        of a search starts its result list over.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    params: dict
+        params made by normalize_search
+    offset: int
+        position of the first business of the page
+    total: int
+        the total the API reported for the search
+    businesses: list
+        the "businesses" list of the page
+    fetched_at: float
+        time of the fetch
+
+    Returns
+    -------
+    None
+    '''
+    key = search_key(params)
+    if offset == 0:
+        conn.execute("DELETE FROM search_results WHERE search_key=?", (key,))
+        conn.execute("DELETE FROM searches WHERE key=?", (key,))
+    conn.execute(upsert_searches, (key, total, fetched_at))
+    conn.executemany("INSERT OR REPLACE INTO search_results VALUES (?, ?, ?)",
+                     ((key, offset + position, business.get('id') if isinstance(business, dict) else None)
+                      for position, business in enumerate(businesses)))
+
+def record_search_pages(conn, pages, fetched_at):
+    ''' store the result list of every crawled page as it goes by, so
+        later searches of a city can be answered from the database, and
+        the crawl position of each business (see crawl_positions)
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    pages: iterable
+        (city id, location, offset, total, businesses) tuples, as made
+        by fetch_pages
+    fetched_at: float
+        time of the crawl
+
+    Yields
+    -------
+    tuple
+        the pages, unchanged
+    '''
+    for page in pages:
+        city_id, location, offset, total, businesses = page
+        if businesses is not None:
+            params = normalize_search(CRAWL_TERM, location)
+            store_search_page(conn, params, offset, total, businesses, fetched_at)
+            conn.executemany("INSERT OR REPLACE INTO crawl_positions VALUES (?, ?, ?)",
+                             ((business['id'], search_key(params), offset + position)
+                              for position, business in enumerate(businesses)
+                              if isinstance(business, dict) and business.get('id')))
+        yield page
+
+def covers(stored, query):
+    ''' tell whether every result of query is among the results of a
+        stored search: the same term, place and order, with the same or
+        wider category, price and radius filters
+
+    Parameters
+    ----------
+    stored: dict
+        params of the stored search, without offset and limit
+    query: dict
+        params of the new search, without offset and limit
+
+    Returns
+    -------
+    bool
+        True when the complete results of stored contain query's
+    '''
+    for name in ('term', 'location', 'latitude', 'longitude', 'sort_by'):
+        if stored.get(name) != query.get(name):
+            return False
+    for name in ('categories', 'price'):
+        if stored.get(name) and not (query.get(name)
+                                     and set(query[name].split(',')) <= set(stored[name].split(','))):
+            return False
+    if stored.get('radius') != query.get('radius'):
+        return ('latitude' in query and stored.get('radius') is not None
+                and query.get('radius') is not None and query['radius'] <= stored['radius'])
+    return True
+
+def stored_search_ids(conn, params, offset, limit, fresh_after):
+    ''' answer a search from the searches stored in the database: from
+        its own stored results when they hold the requested positions,
+        or else by filtering the complete results of a stored search
+        that covers it. Categories are matched on the category aliases
+        of each business, so parent categories of the API do not match.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        an open connection
+    params: dict
+        params made by normalize_search, without offset and limit
+    offset: int
+        position of the first business
+    limit: int
+        number of businesses
+    fresh_after: float
+        only use searches fetched after this time
+
+    Returns
+    -------
+    list
+        the business ids in result order, or None when the database
+        cannot answer the search
+    '''
+    key = search_key(params)
+    row = conn.execute("SELECT total FROM searches WHERE key=? AND fetched_at>?", (key, fresh_after)).fetchone()
+    if row is not None:
+        end = min(offset + limit, row[0], YELP_MAX_RESULTS)
+        positions = conn.execute("SELECT COUNT(*) FROM search_results WHERE search_key=?"
+                                 " AND position>=? AND position<?", (key, offset, end)).fetchone()[0]
+        if positions >= end - offset:
+            return [row[0] for row in conn.execute(
+                "SELECT business_id FROM search_results WHERE search_key=? AND position>=? AND position<?"
+                " AND business_id IS NOT NULL ORDER BY position", (key, offset, end))]
+    query = json.loads(key)
+    for stored_key, total in conn.execute(
+            "SELECT key, total FROM searches WHERE fetched_at>? AND key!=? AND total<=?"
+            " AND json_extract(key, '$.term') IS ? AND json_extract(key, '$.location') IS ?",
+            (fresh_after, key, YELP_MAX_RESULTS, query.get('term'), query.get('location'))).fetchall():
+        stored = json.loads(stored_key)
+        if not covers(stored, query) or conn.execute(
+                "SELECT COUNT(*) FROM search_results WHERE search_key=?", (stored_key,)).fetchone()[0] < total:
+            continue
+        command = ("SELECT r.business_id FROM search_results AS r"
+                   " LEFT JOIN business_details AS d ON d.id = r.business_id"
+                   " WHERE r.search_key = ? AND r.business_id IS NOT NULL")
+        values = [stored_key]
+        if query.get('categories') != stored.get('categories') and query.get('categories'):
+            command += (" AND EXISTS (SELECT 1 FROM restaurant_categories AS rc"
+                        " JOIN categories AS c ON c.id = rc.category_id"
+                        " WHERE rc.restaurant_id = r.business_id AND c.alias IN (SELECT value FROM json_each(?)))")
+            values.append(json.dumps(query['categories'].split(',')))
+        if query.get('price') != stored.get('price') and query.get('price'):
+            command += " AND length(d.price) IN (SELECT value FROM json_each(?))"
+            values.append(json.dumps([int(level) for level in query['price'].split(',')]))
+        ids = [row[0] for row in conn.execute(command + " ORDER BY r.position", values)]
+        coordinates = {row[0]: row[1:] for row in conn.execute(
+            "SELECT id, Latitude, Longitude FROM known_restaurants WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(ids),))}
+        ids = [business_id for business_id in ids if business_id in coordinates]
+        if query.get('radius') != stored.get('radius'):
+            ids = [business_id for business_id in ids if coordinates[business_id][0] is not None
+                   and haversine_km(query['latitude'], query['longitude'],
+                                    *coordinates[business_id]) * 1000 <= query['radius']]
+        return ids[offset:offset + limit]
+    return None
+
+def write_searched_rows(conn, rows):
+    ''' store the businesses of a search page that are not active
+        restaurants in searched_restaurants
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection
+    rows: iterable
+        restaurant rows made by restaurant_row with no city id
+
+    Returns
+    -------
+    None
+    '''
+    batch = {row[0]: row for row in rows}
+    active = {row[0] for row in conn.execute(
+        "SELECT id FROM restaurants WHERE removed_at IS NULL AND id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(batch)),))}
+    new = [row for business_id, row in batch.items() if business_id not in active]
+    fetched_at = time.time()
+    conn.executemany(insert_searched_restaurants, [
+        (row[0], conn.execute(nearest_city, {'city': row[9], 'lat': row[6], 'lon': row[7]}).fetchone()[0])
+        + row[2:restaurant_row_columns] + (fetched_at,) for row in new])
+    write_restaurant_categories(conn, [(row[0], row[restaurant_row_columns]) for row in new])
+    conn.executemany(upsert_business_details, [row[restaurant_row_columns + 1] for row in new])
+
+def fetch_search(params, offset, limit, fresh_after):
+    ''' fetch the pages of a search that hold the requested positions
+        and store them: their result lists, and the businesses that are
+        not in the database yet. The writer connection is only taken to
+        store each page, never while a request is in flight.
+
+    Parameters
+    ----------
+    params: dict
+        params made by normalize_search, without offset and limit
+    offset: int
+        position of the first business
+    limit: int
+        number of businesses
+    fresh_after: float
+        stored results of the search fetched before this are dropped
+
+    Returns
+    -------
+    list
+        the business ids in result order
+    '''
+    key = search_key(params)
+    filters = {name: value for name, value in params.items() if name not in ('term', 'location')}
+    rejects = collections.Counter()
+    with get_manager().writer() as conn, conn:
+        conn.execute("DELETE FROM search_results WHERE search_key IN"
+                     " (SELECT key FROM searches WHERE key=? AND fetched_at<=?)", (key, fresh_after))
+        conn.execute("DELETE FROM searches WHERE key=? AND fetched_at<=?", (key, fresh_after))
+    page, end = offset, offset + limit
+    while page < end:
+        size = min(YELP_PAGE_LIMIT, end - page)
+        result = get_restaurants(params.get('location'), params.get('term'), page, size, **filters)
+        if not isinstance(result, dict) or 'businesses' not in result:
+            print(f"Search failed: {result.get('error') if isinstance(result, dict) else result}")
+            break
+        end = min(end, result.get('total', 0), YELP_MAX_RESULTS)
+        with get_manager().writer() as conn, conn:
+            store_search_page(conn, params, page, result.get('total', 0), result['businesses'], time.time())
+            write_searched_rows(conn, restaurant_rows(
+                [(None, params.get('location'), page, result.get('total', 0), result['businesses'])], rejects))
+        page += size
+    if rejects:
+        print(f"{sum(rejects.values())} businesses rejected: "
+              + ", ".join(f"{count} {reason}" for reason, count in rejects.most_common()))
+    return [row[0] for row in get_read_connection().execute(
+        "SELECT business_id FROM search_results WHERE search_key=? AND position>=? AND position<?"
+        " AND business_id IS NOT NULL ORDER BY position", (key, offset, offset + limit))]
+
+def find_restaurants(term=None, location=None, latitude=None, longitude=None, categories=None, price=None,
+                     radius=None, sort_by=None, offset=0, limit=10, max_age=None):
+    ''' search restaurants with any term and filters, like the search
+        API. The search is answered from the database when a stored
+        search holds its results (the same search, or a wider one whose
+        complete results can be filtered down), and otherwise fetched
+        and stored for the next time. Lookups use the read-only
+        connection of the thread; see fetch_search for the writes.
+
+    Parameters
+    ----------
+    term, location, latitude, longitude, categories, price, radius, sort_by:
+        the search, see normalize_search
+    offset: int
+        position of the first restaurant
+    limit: int
+        the most restaurants to return
+    max_age: float
+        seconds stored searches are used for, CACHE_TTL['responses']
+        by default
+
+    Returns
+    -------
+    tuple
+        (list of dicts of found_fields in result order,
+         'database' or 'api' for where the results came from)
+    '''
+    params = normalize_search(term, location, latitude, longitude, categories, price, radius, sort_by)
+    del params['limit']
+    if offset < 0 or limit < 1 or offset + limit > YELP_MAX_RESULTS:
+        raise ValueError(f"The API returns the first {YELP_MAX_RESULTS} results of a search at most")
+    fresh_after = time.time() - (CACHE_TTL['responses'] if max_age is None else max_age)
+    ids = stored_search_ids(get_read_connection(), params, offset, limit, fresh_after)
+    source = 'database'
+    if ids is None:
+        ids = fetch_search(params, offset, limit, fresh_after)
+        source = 'api'
+    rows = {row[0]: row for row in get_read_connection().execute(
+        "SELECT b.id, b.name, b.categories, b.rating, d.price, b.review_count, b.Latitude, b.Longitude,"
+        " b.address, b.CityName, b.StateName FROM known_restaurants AS b LEFT JOIN business_details AS d"
+        " ON d.id = b.id WHERE b.id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))}
+    return [dict(zip(found_fields, rows[business_id])) for business_id in ids if business_id in rows], source
+
+def find_many(terms, locations, points=(), offset=0, limit=10, max_age=None, **filters):
+    ''' run every combination of terms and places as one search each.
+        Combinations that normalize to the same search run once.
+
+    Parameters
+    ----------
+    terms: list
+        search terms, [None] for no term
+    locations: list
+        places to search
+    points: list
+        (latitude, longitude) pairs to search around as well
+    offset, limit, max_age:
+        see find_restaurants
+    filters: dict
+        categories, price, radius or sort_by, see normalize_search
+
+    Returns
+    -------
+    tuple
+        (dict of (term, place): (results, source) for every distinct
+         search, counts of 'searches', 'duplicates', 'database' and 'api')
+    '''
+    places = [{'location': location} for location in locations] \
+        + [{'latitude': latitude, 'longitude': longitude} for latitude, longitude in points]
+    results = {}
+    seen = set()
+    counts = {'searches': 0, 'duplicates': 0, 'database': 0, 'api': 0}
+    for term in terms:
+        for place in places:
+            counts['searches'] += 1
+            key = search_key(normalize_search(term, **place, **filters))
+            if key in seen:
+                counts['duplicates'] += 1
+                continue
+            seen.add(key)
+            found, source = find_restaurants(term, **place, offset=offset, limit=limit, max_age=max_age, **filters)
+            results[(term, place.get('location') or (place.get('latitude'), place.get('longitude')))] = found, source
+            counts[source] += 1
+    return results, counts
+
+def print_find_results(results, counts):
+    ''' print what find_many found
+
+    Parameters
+    ----------
+    results: dict
+        (term, place): (results, source), see find_many
+    counts: dict
+        the counts of find_many
+
+    Returns
+    -------
+    None
+    '''
+    for (term, place), (found, source) in results.items():
+        print('-' * 47)
+        print(f"{term or 'anything'} in {place}: {len(found)} restaurants (from the {source})")
+        for row in found:
+            print(f"  {row['name']} ({row['categories']}, {row['CityName']}) rating {row['rating']}"
+                  + (f" {row['price']}" if row['price'] else ""))
+    print('-' * 47)
+    print(f"{counts['searches']} searches, {counts['duplicates']} duplicates: "
+          f"{counts['database']} answered from the database, {counts['api']} from the API")
+
+def build_database(max_results=YELP_PAGE_LIMIT, refresh_cities=True, clean=False, n_cities=100,
+                   batch_size=INGEST_BATCH_SIZE):
+    ''' build or refresh the database: scrape the cities from Wikipedia,
+        then fetch the restaurants of every city and sync them
+
+    Parameters
+    ----------
+    max_results: int
+        the most businesses to fetch for each city (see sync_restaurants)
+    refresh_cities: bool
+        scrape the cities again; when False the cities already in the
+        database are kept and only the restaurants are refreshed
+    clean: bool
+        drop both tables first instead of syncing into them
+    n_cities: int
+        how many of the most populous cities to load when scraping
+    batch_size: int
+        restaurant rows written per transaction (see sync_restaurants)
+
+    Returns
+    -------
+    None
+    '''
+    with get_manager().writer() as conn:
+        cur = conn.cursor()
+        if clean:
+            cur.execute(drop_restaurants)
+            cur.execute(drop_cities)
+            cur.execute("DROP TABLE IF EXISTS city_stats")
+            cur.execute("DROP TABLE IF EXISTS restaurants_rtree")
+            cur.execute("DROP TABLE IF EXISTS restaurants_fts_terms")
+            cur.execute("DROP TABLE IF EXISTS restaurants_fts")
+            cur.execute("DROP TABLE IF EXISTS category_city_counts")
+            cur.execute("DROP TABLE IF EXISTS restaurant_categories")
+            cur.execute("DROP TABLE IF EXISTS categories")
+            cur.execute("DROP TABLE IF EXISTS business_details")
+            cur.execute("DROP TABLE IF EXISTS search_results")
+            cur.execute("DROP TABLE IF EXISTS searches")
+            cur.execute("DROP TABLE IF EXISTS crawl_positions")
+            cur.execute("DROP VIEW IF EXISTS known_restaurants")
+            cur.execute("DROP TABLE IF EXISTS searched_restaurants")
+            conn.commit()
+        migrate_database(conn)
+        if refresh_cities:
+            store_cities(conn, build_city_information_list(n_cities, conn))
+        City_list=cur.execute('SELECT id, CityName FROM cities WHERE rank IS NOT NULL ORDER BY rank').fetchall()
+        counts=sync_restaurants(conn, City_list, max_results=max_results, batch_size=batch_size)
+        prune_figure_cache(get_data_version(conn))
+    print(f"{len(City_list)} cities synced to {DBNAME}: "
+          + ", ".join(f"{count} {name}" for name, count in counts.items()))
+    print_cache_stats()
+
+def store_cities(conn, city_list):
+    ''' store a scraped city list: every city keeps its id, gets the
+        rank it has in the list, and the cities that are no longer
+        listed lose their rank, so they are not crawled any more but
+        their restaurants still point at them
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        a writable connection to a migrated database
+    city_list: list
+        (rank, CityName, StateName, Latitude, Longitude) rows, as made
+        by parse_city_table
+
+    Returns
+    -------
+    None
+    '''
+    with conn:
+        conn.execute("UPDATE cities SET rank=NULL")
+        conn.executemany(upsert_cities, city_list)
+        relink_cities(conn)
+
+def get_city_list():
+    ''' get the names of the cities stored in the database,
+        ordered by population rank
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    list
+        A list of city names
+    '''
+    return [row[0] for row in get_read_connection().execute(
+        'SELECT CityName FROM cities WHERE rank IS NOT NULL ORDER BY rank')]
+
+# columns get_info_form_database may select, filter or sort on
+restaurant_columns = (
+    'id', 'cityid', 'name', 'categories', 'rating', 'Phone', 'Latitude', 'Longitude',
+    'review_count', 'CityName', 'StateName', 'zipcode', 'address', 'fetched_at', 'removed_at',
+)
+_local = threading.local()
+
+def get_read_connection():
+    ''' get the long-lived read-only connection of the current thread.
+        Reusing one connection keeps SQLite's prepared statement cache
+        warm, so repeated queries skip both connecting and parsing.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+        the open read-only connection
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.dbname != DBNAME:
+        conn = get_connection(readonly=True)
+        _local.conn = conn
+        _local.dbname = DBNAME
+    return conn
+
+def check_column(column):
+    ''' make sure a column name is one of restaurant_columns
+
+    Parameters
+    ----------
+    column: str
+        the column name
+
+    Returns
+    -------
+    str
+        the column name
+
+    Raises
+    ------
+    ValueError
+        when the column is not a restaurants column
+    '''
+    if column not in restaurant_columns:
+        raise ValueError(f"Unknown column: {column}")
+    return column
+
+def build_info_query(info, params=None, ranges=None, order_by=None, limit=None):
+    ''' build the SELECT statement used by get_info_form_database.
+        Column names are checked against restaurant_columns and every
+        value is a bound parameter, so the same query text is reused
+        for every city.
+
+    Parameters
+    ----------
+    info: list
+        a list of columns want to query
+    params: dict
+        A dictionary of column:value pairs; a list, tuple or set value
+        matches any of its items (IN)
+    ranges: dict
+        A dictionary of column:(low, high) pairs, either bound may be None
+    order_by: str or list
+        column(s) to sort by, prefix a column with '-' to sort descending
+    limit: int
+        the most rows to return
+
+    Returns
+    -------
+    tuple
+        the SQL command and the list of values to bind
+    '''
+    real_info = ", ".join("b.{}".format(check_column(column)) for column in info)
+    command = f'SELECT {real_info} FROM restaurants as b WHERE b.removed_at IS NULL'
+    values = []
+    for key, value in (params or {}).items():
+        check_column(key)
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            command += f' AND b.{key} IN ({", ".join("?" * len(value))})'
+            values.extend(value)
+        else:
+            command += f' AND b.{key} = ?'
+            values.append(value)
+    for key, (low, high) in (ranges or {}).items():
+        check_column(key)
+        if low is not None:
+            command += f' AND b.{key} >= ?'
+            values.append(low)
+        if high is not None:
+            command += f' AND b.{key} <= ?'
+            values.append(high)
+    if order_by:
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        terms = []
+        for column in order_by:
+            if column.startswith('-'):
+                terms.append(f'b.{check_column(column[1:])} DESC')
+            else:
+                terms.append(f'b.{check_column(column)}')
+        command += ' ORDER BY ' + ", ".join(terms)
+    if limit is not None:
+        command += ' LIMIT ?'
+        values.append(int(limit))
+    return command, values
+
+@trace('sql')
+def get_info_form_database(info, params=None, ranges=None, order_by=None, limit=None):
+    ''' get all restaurant information from the database
+
+    Parameters
+    ----------
+    info: list
+        a list of strings want to query
+    params: dict
+        A dictionary of param:value pairs (see build_info_query)
+    ranges: dict
+        A dictionary of column:(low, high) pairs
+    order_by: str or list
+        column(s) to sort by, '-column' sorts descending
+    limit: int
+        the most rows to return
+
+    Returns
+    -------
+    list
+        A list of all the restaurant information queried
+    '''
+    command, values = build_info_query(info, params, ranges, order_by, limit)
+    return get_read_connection().execute(command, values).fetchall()
+
+# the queries behind the menu charts, checked by check_query_plans
+chart_queries = {
+    'kde_rating': (["name", "CityName", "categories", "rating"], {"CityName": "Chicago"}),
+    'print_average_rating': (['rating'], {"CityName": "Chicago"}),
+    'plot_review_count_distribution': (['review_count', 'name'], {"CityName": "Chicago"}),
+    'map_cities': (["name", "CityName", "review_count", "Latitude", "Longitude", "rating"], {"CityName": "Chicago"}),
+    'restaurants_by_city_id': (['name', 'rating'], {"cityid": 1}),
+    'restaurants_by_rating': (['name'], {"rating": 4.5}),
+    'restaurants_by_category': (['name'], {"categories": "Pizza"}),
+}
+
+def check_query_plans(conn=None):
+    ''' run EXPLAIN QUERY PLAN on every chart and lookup query and
+        make sure each one searches the restaurants table through an
+        index; a scan fails even over a covering index, since it still
+        reads every row
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        an open connection, a read-only one is opened when None
+
+    Returns
+    -------
+    dict
+        query name: list of plan details
+
+    Raises
+    ------
+    AssertionError
+        when a query scans the restaurants table
+    '''
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection(readonly=True)
+    plans = {}
+    for name, (info, params) in chart_queries.items():
+        command, values = build_info_query(info, params)
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + command, values)]
+        plans[name] = plan
+        for detail in plan:
+            if detail.startswith("SCAN"):
+                raise AssertionError(f"{name} scans the table: {detail}")
+    if own_conn:
+        conn.close()
+    return plans
+
+###COLUMNAR SNAPSHOT###
+# fields of the snapshot array; CityName, StateName and categories hold
+# codes into the vocabularies of the snapshot instead of strings
+snapshot_fields = [
+    ('id', 'U{id_width}'), ('cityid', 'i4'), ('name', 'U{name_width}'), ('categories', 'i4'),
+    ('rating', 'f4'), ('Latitude', 'f8'), ('Longitude', 'f8'), ('review_count', 'i4'),
+    ('CityName', 'i4'), ('StateName', 'i4'),
+]
+encoded_fields = ('CityName', 'StateName', 'categories')
+SNAPSHOT = None
+
+class RestaurantSnapshot:
+    '''a read-only columnar copy of the active restaurants.
+    Rows are kept in one NumPy structured array sorted by city, so the
+    restaurants of a city are one contiguous slice (a view, not a copy).
+    City, state and category strings are dictionary-encoded.
+
+    Instance Attributes
+    -------------------
+    rows: numpy.ndarray
+        the structured array, memory-mapped when loaded from disk
+
+    vocab: dict
+        field name: list of the strings its codes stand for
+
+    city_offsets: dict
+        city name: (start, stop) of its slice of rows
+
+    data_version: int
+        the database data version the snapshot was built from
+    '''
+    def __init__(self, rows, vocab, data_version):
+        self.rows=rows
+        self.vocab=vocab
+        self.data_version=data_version
+        self.city_offsets={}
+        if len(rows):
+            import numpy as np
+
+            codes=np.asarray(rows['CityName'])
+            starts=np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+            stops=np.r_[starts[1:], len(codes)]
+            for start, stop in zip(starts, stops):
+                self.city_offsets[vocab['CityName'][codes[start]]]=(int(start), int(stop))
+
+    def city(self, city_name):
+        ''' the rows of one city as a view of the snapshot
+
+        Parameters
+        ----------
+        city_name: str
+            name of a city
+
+        Returns
+        -------
+        numpy.ndarray
+            the city's rows (empty when the city is unknown)
+        '''
+        start, stop=self.city_offsets.get(city_name, (0, 0))
+        return self.rows[start:stop]
+
+    def column(self, rows, field):
+        ''' a column of some rows, with encoded fields decoded to strings
+
+        Parameters
+        ----------
+        rows: numpy.ndarray
+            rows of the snapshot, e.g. from city()
+        field: str
+            the field name
+
+        Returns
+        -------
+        numpy.ndarray or list
+            the column
+        '''
+        if field in encoded_fields:
+            vocab=self.vocab[field]
+            return [vocab[code] for code in rows[field]]
+        return rows[field]
+
+def snapshot_paths():
+    ''' the .npy and .json sidecar files of the snapshot of DBNAME
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    tuple
+        (array file, metadata file)
+    '''
+    return f"{DBNAME}.restaurants.npy", f"{DBNAME}.restaurants.json"
+
+def build_snapshot():
+    ''' read the active restaurants once into a RestaurantSnapshot
+        and write it to the .npy/.json sidecar files
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    RestaurantSnapshot
+        the new snapshot
+    '''
+    import numpy as np
+
+    conn=get_read_connection()
+    data_version=get_data_version(conn)
+    names=[name for name, _ in snapshot_fields]
+    records=conn.execute(
+        f"SELECT {', '.join(names)} FROM restaurants WHERE removed_at IS NULL"
+        " ORDER BY CityName, rating DESC").fetchall()
+    vocab={field: [] for field in encoded_fields}
+    codes={field: {} for field in encoded_fields}
+    positions={name: number for number, name in enumerate(names)}
+    encoded=[]
+    for record in records:
+        record=list(record)
+        for field in encoded_fields:
+            value=record[positions[field]] or ''
+            if value not in codes[field]:
+                codes[field][value]=len(vocab[field])
+                vocab[field].append(value)
+            record[positions[field]]=codes[field][value]
+        for field in ('rating', 'Latitude', 'Longitude'):
+            if record[positions[field]] is None:
+                record[positions[field]]=float('nan')
+        if record[positions['review_count']] is None:
+            record[positions['review_count']]=0
+        encoded.append(tuple(record))
+    # sized from the data, so no id or name is cut short
+    id_width=max([len(record[positions['id']]) for record in encoded] + [1])
+    name_width=max([len(record[positions['name']]) for record in encoded] + [1])
+    dtype=[(name, kind.format(id_width=id_width, name_width=name_width)) for name, kind in snapshot_fields]
+    rows=np.array(encoded, dtype=dtype)
+    array_path, meta_path=snapshot_paths()
+    np.save(array_path, rows)
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'data_version': data_version, 'vocab': vocab}, meta_file)
+    return RestaurantSnapshot(rows, vocab, data_version)
+
+def load_snapshot(rebuild=False):
+    ''' load the restaurants snapshot into SNAPSHOT, memory-mapping the
+        sidecar file when it matches the database and rebuilding it
+        otherwise. The chart helpers use SNAPSHOT once it is loaded.
+
+    Parameters
+    ----------
+    rebuild: bool
+        rebuild the sidecar even when it is up to date
+
+    Returns
+    -------
+    RestaurantSnapshot
+        the loaded snapshot
+    '''
+    import numpy as np
+
+    global SNAPSHOT
+    array_path, meta_path=snapshot_paths()
+    data_version=get_data_version(get_read_connection())
+    snapshot=None
+    if not rebuild and os.path.exists(array_path) and os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta=json.load(meta_file)
+        if meta['data_version'] == data_version:
+            snapshot=RestaurantSnapshot(np.load(array_path, mmap_mode='r'), meta['vocab'], data_version)
+    if snapshot is None:
+        snapshot=build_snapshot()
+    SNAPSHOT=snapshot
+    return snapshot
+
+def get_city_columns(params, columns):
+    ''' get some columns of the restaurants matching params, sliced
+        from SNAPSHOT when it is loaded, still matches the data version
+        of the database and params is a single city, otherwise queried
+        from the database
+
+    Parameters
+    ----------
+    params: dict
+        A dictionary of param:value pairs
+    columns: list
+        the columns wanted
+
+    Returns
+    -------
+    dict
+        column: sequence of values
+    '''
+    if SNAPSHOT is not None and list(params) == ['CityName'] and isinstance(params['CityName'], str) \
+            and SNAPSHOT.data_version == get_data_version(get_read_connection()):
+        rows=SNAPSHOT.city(params['CityName'])
+        return {column: SNAPSHOT.column(rows, column) for column in columns}
+    info_list=get_info_form_database(columns, params)
+    return {column: [row[number] for row in info_list] for number, column in enumerate(columns)}
+
+###RATING DENSITY (KDE)###
+# every density curve is evaluated on the same grid of ratings
+kde_grid_range = (0.5, 5.5)
+kde_grid_points = 201
+# the most (city, grid point, sample) cells evaluated in one array
+kde_block_cells = 4_000_000
+_kde_cache = {}
+
+def kde_grid():
+    ''' the fixed grid of ratings the density curves are evaluated on
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    numpy.ndarray
+        kde_grid_points ratings from kde_grid_range[0] to kde_grid_range[1]
+    '''
+    import numpy as np
+
+    return np.linspace(kde_grid_range[0], kde_grid_range[1], kde_grid_points)
+
+def kde_bandwidths(values, weights, method='scott'):
+    ''' select a Gaussian kernel bandwidth for every row of weighted
+        samples, using the same rules as scipy.stats.gaussian_kde
+
+    Parameters
+    ----------
+    values: numpy.ndarray
+        a 2-D array with the distinct samples of one curve per row
+    weights: numpy.ndarray
+        how many times each value occurs, 0 for padding
+    method: str
+        'scott' (std * n ** -1/5) or 'silverman' (std * (3n/4) ** -1/5)
+
+    Returns
+    -------
+    numpy.ndarray
+        the bandwidth of every row
+    '''
+    import numpy as np
+
+    n = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (weights * values).sum(axis=1) / n
+        std = np.sqrt((weights * (values - mean[:, None]) ** 2).sum(axis=1) / (n - 1))
+        if method == 'scott':
+            factor = n ** (-1 / 5)
+        elif method == 'silverman':
+            factor = (n * 3 / 4) ** (-1 / 5)
+        else:
+            raise ValueError(f"Unknown bandwidth method: {method}")
+        bandwidth = std * factor
+    # a city whose restaurants all share one rating still gets a narrow bump
+    return np.where(np.isfinite(bandwidth) & (bandwidth > 0), bandwidth, 0.1)
+
+def batch_kde(sample_lists, method='scott', grid=None):
+    ''' evaluate the Gaussian kernel density of many sample lists at
+        once. Each list is reduced to its distinct values and their
+        counts (ratings only take a few values), the lists are padded
+        into one array, and every curve is computed with array
+        operations, a block of rows at a time so memory stays bounded.
+
+    Parameters
+    ----------
+    sample_lists: list
+        one list of ratings per curve
+    method: str
+        bandwidth rule, 'scott' or 'silverman'
+    grid: numpy.ndarray
+        points to evaluate the densities at, kde_grid() when None
+
+    Returns
+    -------
+    numpy.ndarray
+        a (len(sample_lists), len(grid)) array of densities
+    '''
+    import numpy as np
+
+    if grid is None:
+        grid = kde_grid()
+    distinct = [np.unique(np.asarray(samples, dtype=float), return_counts=True)
+                for samples in sample_lists]
+    width = max([len(row_values) for row_values, _ in distinct] + [1])
+    values = np.zeros((len(sample_lists), width))
+    weights = np.zeros((len(sample_lists), width))
+    for row, (row_values, counts) in enumerate(distinct):
+        values[row, :len(row_values)] = row_values
+        weights[row, :len(row_values)] = counts
+    bandwidth = kde_bandwidths(values, weights, method)
+    n = weights.sum(axis=1)
+    density = np.zeros((len(sample_lists), len(grid)))
+    block = max(1, kde_block_cells // (len(grid) * width))
+    for start in range(0, len(sample_lists), block):
+        stop = start + block
+        h = bandwidth[start:stop, None, None]
+        z = (grid[None, :, None] - values[start:stop, None, :]) / h
+        kernel = np.exp(-0.5 * z * z) * weights[start:stop, None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            density[start:stop] = kernel.sum(axis=2) / (n[start:stop, None] * bandwidth[start:stop, None] * np.sqrt(2 * np.pi))
+    density[n == 0] = 0.0
+    return density
+
+@trace('kde')
+def city_rating_curves(method='scott'):
+    ''' the rating density curve of every city, computed in one batch
+        from a single query (or from SNAPSHOT when it is loaded) and
+        cached until the data version changes
+
+    Parameters
+    ----------
+    method: str
+        bandwidth rule, 'scott' or 'silverman'
+
+    Returns
+    -------
+    dict
+        city name: (grid, density) pairs of numpy arrays
+    '''
+    conn = get_read_connection()
+    key = (DBNAME, get_data_version(conn), method)
+    if key not in _kde_cache:
+        ratings = {}
+        if SNAPSHOT is not None and SNAPSHOT.data_version == key[1]:
+            for city_name, (start, stop) in SNAPSHOT.city_offsets.items():
+                ratings[city_name] = SNAPSHOT.rows['rating'][start:stop]
+        else:
+            for city_name, rating in conn.execute(
+                    "SELECT CityName, rating FROM restaurants WHERE removed_at IS NULL"):
+                ratings.setdefault(city_name, []).append(rating)
+        city_names = list(ratings)
+        grid = kde_grid()
+        density = batch_kde([ratings[name] for name in city_names], method, grid)
+        _kde_cache.clear()
+        _kde_cache[key] = {name: (grid, density[row]) for row, name in enumerate(city_names)}
+    return _kde_cache[key]
+
+def benchmark_kde(repeat=3):
+    ''' time the density curves of every city, the old way (one
+        figure_factory.create_distplot per city) against the batched
+        NumPy engine, and print the results. Newer plotly releases no
+        longer ship create_distplot; the old path is then timed with
+        the per-city scipy gaussian_kde evaluation it was built on, or,
+        when scipy cannot be imported, with the same Scott-bandwidth
+        evaluation written in NumPy, still one city at a time.
+
+    Parameters
+    ----------
+    repeat: int
+        how many times to run each path, the best time is kept
+
+    Returns
+    -------
+    dict
+        best time in seconds of 'per_city' and 'batch_kde'
+    '''
+    import numpy as np
+
+    ratings = {}
+    for city_name, rating in get_read_connection().execute(
+            "SELECT CityName, rating FROM restaurants WHERE removed_at IS NULL"):
+        ratings.setdefault(city_name, []).append(rating)
+    # the old path needs at least two different ratings
+    sample_lists = [values for values in ratings.values() if len(set(values)) > 1]
+
+    def best_of(function):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    timings = {'per_city': None, 'batch_kde': None}
+    try:
+        import plotly.figure_factory as ff
+        if hasattr(ff, 'create_distplot'):
+            # create_distplot imports scipy only when called; fail here instead
+            importlib.import_module('scipy.stats')
+            def per_city():
+                for values in sample_lists:
+                    ff.create_distplot([values], ['rating'], show_hist=False, show_rug=False)
+        else:
+            from scipy.stats import gaussian_kde
+            def per_city():
+                for values in sample_lists:
+                    gaussian_kde(values)(np.linspace(min(values), max(values), 500))
+    except ImportError as error:
+        # e.g. the local secrets.py hides the standard library module scipy imports
+        print(f"Cannot import the scipy per-city path ({error}); timing the same per-city loop in NumPy")
+        def per_city():
+            for values in sample_lists:
+                data = np.asarray(values, dtype=float)
+                bandwidth = data.std(ddof=1) * len(data) ** (-1 / 5)
+                grid = np.linspace(data.min(), data.max(), 500)
+                np.exp(-0.5 * ((grid[:, None] - data[None, :]) / bandwidth) ** 2).sum(axis=1) \
+                    / (len(data) * bandwidth * math.sqrt(2 * math.pi))
+    timings['per_city'] = best_of(per_city)
+    timings['batch_kde'] = best_of(lambda: batch_kde(sample_lists))
+    print(f"{len(sample_lists)} cities")
+    for name, elapsed in timings.items():
+        if elapsed is not None:
+            print(f"{name}: {elapsed * 1000:.1f} ms")
+    if timings['per_city']:
+        print(f"speedup: {timings['per_city'] / timings['batch_kde']:.1f}x")
+    return timings
+
+###FIGURE CACHE###
+FIGURE_DIR = 'figures'
+# bump when a figure builder changes, so old cached figures are not reused
+FIGURE_FORMAT = 2
+figure_page = '''<html>
+<head><meta charset="utf-8"><title>{title}</title><script src="{plotlyjs}"></script></head>
+<body style="margin:0">
+<div id="figure" style="height:100vh;width:100%"></div>
+<script>
+var figure = {figure};
+Plotly.newPlot("figure", figure.data, figure.layout, {{"responsive": true}});
+</script>
+</body>
+</html>
+'''
+
+def figure_key(chart, params, data_version):
+    ''' the content address of a figure: the chart, its parameters and
+        the data version it was built from
+
+    Parameters
+    ----------
+    chart: str
+        name of the chart, e.g. 'kde'
+    params: dict
+        the parameters of the chart, e.g. {'CityName': 'Chicago'}
+    data_version: int
+        the data version of the database
+
+    Returns
+    -------
+    str
+        '<data version>-<hash>', the file name of the figure without
+        extension
+    '''
+    text = json.dumps([FIGURE_FORMAT, DBNAME, chart, params], sort_keys=True, default=str)
+    return f"{data_version}-{hashlib.sha1(text.encode()).hexdigest()}"
+
+def cached_figure(chart, params, build, data_version=None):
+    ''' the JSON of a figure, read from FIGURE_DIR when the same chart
+        with the same parameters was already built at this data
+        version, otherwise built with build() and stored there
+
+    Parameters
+    ----------
+    chart: str
+        name of the chart
+    params: dict
+        the parameters of the chart
+    build: function
+        builds the figure; returns None when there is nothing to plot
+    data_version: int
+        the data version, looked up when None
+
+    Returns
+    -------
+    str
+        the figure JSON, or None when build() returned None
+    '''
+    if data_version is None:
+        data_version = get_data_version(get_read_connection())
+    path = os.path.join(FIGURE_DIR, figure_key(chart, params, data_version) + '.json')
+    if os.path.exists(path):
+        TRACER.record('figure', calls=1, hits=1)
+        with open(path, encoding='utf-8') as file:
+            return file.read()
+    with trace('figure'):
+        TRACER.note(misses=1)
+        fig = build()
+        if fig is None:
+            return None
+        figure_json = fig.to_json()
+        TRACER.note(bytes=len(figure_json))
+    os.makedirs(FIGURE_DIR, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(figure_json)
+    os.replace(temp_path, path)
+    return figure_json
+
+def plotlyjs_asset(directory):
+    ''' write the plotly.js bundle of the installed plotly into
+        directory once, for every chart page to share
+
+    Parameters
+    ----------
+    directory: str
+        where to keep the bundle
+
+    Returns
+    -------
+    str
+        the path of the bundle
+    '''
+    from importlib.metadata import version
+
+    path = os.path.join(directory, f"plotly-{version('plotly')}.min.js")
+    if not os.path.exists(path):
+        from plotly.offline import get_plotlyjs
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(get_plotlyjs())
+        os.replace(temp_path, path)
+    return path
+
+@trace('figure_write')
+def write_figure_page(figure_json, filename, title, asset_dir=FIGURE_DIR, auto_open=False):
+    ''' write a small html page that draws a figure JSON with the shared
+        plotly.js bundle instead of embedding the bundle
+
+    Parameters
+    ----------
+    figure_json: str
+        the figure JSON
+    filename: str
+        the html file to write
+    title: str
+        the page title
+    asset_dir: str
+        the directory of the shared plotly.js bundle
+    auto_open: bool
+        open the page in a browser
+
+    Returns
+    -------
+    str
+        filename
+    '''
+    asset = plotlyjs_asset(asset_dir)
+    directory = os.path.dirname(os.path.abspath(filename))
+    plotlyjs = os.path.relpath(os.path.abspath(asset), directory).replace(os.sep, '/')
+    page = figure_page.format(title=title, plotlyjs=plotlyjs, figure=figure_json.replace('</', '<\\/'))
+    TRACER.note(bytes=len(page))
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(page)
+    if auto_open:
+        import webbrowser
+        webbrowser.open('file://' + os.path.abspath(filename))
+    return filename
+
+def prune_figure_cache(data_version):
+    ''' delete the cached figures of other data versions
+
+    Parameters
+    ----------
+    data_version: int
+        the data version to keep
+
+    Returns
+    -------
+    int
+        number of files deleted
+    '''
+    if not os.path.isdir(FIGURE_DIR):
+        return 0
+    deleted = 0
+    for name in os.listdir(FIGURE_DIR):
+        if name.endswith('.json') and not name.startswith(f"{data_version}-"):
+            os.remove(os.path.join(FIGURE_DIR, name))
+            deleted += 1
+    return deleted
+
+def kde_figure(grid, density):
+    ''' build the kernel rating distribution figure of a density curve
+
+    Parameters
+    ----------
+    grid: sequence
+        the rating grid
+    density: sequence
+        the density at each grid point
+
+    Returns
+    -------
+    fig
+        the kernel rating distribution figure
+    '''
+    import plotly.graph_objects as go
+
+    fig = go.Figure(go.Scatter(x=grid, y=density, mode='lines', name='rating'))
+    fig.update_xaxes(title_text="rating", ticks="inside")
+    fig.update_yaxes(title_text="Kernel Density", ticks="inside")
+    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
+                      template="ggplot2",
+                      title={'text': "Kernel Rating Distribution"})
+    return fig
+
+def kde_rating(user_city, filename="rating_distribution.html", auto_open=True):
+    ''' show kernel rating distribution of all restaurants in a city 
+
+    Parameters
+    ----------
+    user_city: str
+        name of a city
+    filename: str
+        the html file to write
+    auto_open: bool
+        open the file in a browser
+
+    Return
+    ----------
+    The html file of the kernel rating distribution of all restaurants in a city : str
+    '''
+    def build():
+        curve = city_rating_curves().get(user_city)
+        return None if curve is None else kde_figure(*curve)
+
+    figure_json = cached_figure('kde', {'CityName': user_city}, build)
+    if figure_json is None:
+        print('No restaurants found.')
+        print('-' * 47)
+        return None
+    print("Plotting")
+    print('-' * 47)
+    return write_figure_page(figure_json, filename, report_charts['kde'][1], auto_open=auto_open)
+
+def print_average_rating(params):
+    ''' Caculate the average rating of all restaurants in a city 
+
+    Parameters
+    ----------
+    params: dict
+        A dictionary of param:value pairs
+
+    Return
+    ----------
+    The average rating of all restaurants in a city: str
+    '''
+    if list(params) == ['CityName'] and isinstance(params['CityName'], str):
+        stats = get_city_stats(params['CityName'])
+        average = stats['mean'] if stats else None
+    else:
+        info_list = get_info_form_database(['rating'], params)
+        average = sum(float(rating[0]) for rating in info_list) / len(info_list) if info_list else None
+    if average is None:
+        print('No restaurants found.')
+        print('-' * 47)
+        return
+    print(f'The average rating is {average}')
+    print('-' * 47)
+
+def rating_figure(rating_list, grid, density):
+    ''' build the rating distribution figure: histogram, density curve
+        and rug of the ratings
+
+    Parameters
+    ----------
+    rating_list: list
+        the ratings
+    grid: sequence
+        the rating grid
+    density: sequence
+        the density at each grid point
+
+    Returns
+    -------
+    fig
+        the rating distribution figure
+    '''
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    fig.add_trace(go.Histogram(x=rating_list, name='Rating', histnorm='probability density',
+                               xbins=dict(start=0.75, end=5.25, size=0.5), opacity=0.7))
+    fig.add_trace(go.Scatter(x=grid, y=density, mode='lines', name='Rating'))
+    fig.add_trace(go.Scatter(x=rating_list, y=[0] * len(rating_list), mode='markers',
+                             marker=dict(symbol='line-ns-open'), showlegend=False))
+    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
+                      template="ggplot2",
+                      title={'text': "Rating Distribution"})
+    return fig
+
+def plot_rating_distribution(params, filename="rating.html", auto_open=True):
+    ''' show the rating distribution of all restaurants in a city 
+
+    Parameters
+    ----------
+    params: dict
+        A dictionary of param:value pairs
+    filename: str
+        the html file to write
+    auto_open: bool
+        open the file in a browser
+
+    Return
+    ----------
+    The html file of the rating distribution of all restaurants in a city : str
+    '''
+    def build():
+        rating_list = [float(rating) for rating in get_city_columns(params, ['rating'])['rating']]
+        if not rating_list:
+            return None
+        if list(params) == ['CityName'] and isinstance(params['CityName'], str) \
+                and params['CityName'] in city_rating_curves():
+            grid, density = city_rating_curves()[params['CityName']]
+        else:
+            grid = kde_grid()
+            density = batch_kde([rating_list], grid=grid)[0]
+        return rating_figure(rating_list, grid, density)
+
+    figure_json = cached_figure('rating', params, build)
+    if figure_json is None:
+        print('No restaurants found.')
+        print('-' * 47)
+        return None
+    print("Plotting")
+    print('-' * 47)
+    return write_figure_page(figure_json, filename, report_charts['rating'][1], auto_open=auto_open)
+
+def review_count_figure(name_list, review_count_list):
+    ''' build the review count distribution figure
+
+    Parameters
+    ----------
+    name_list: list
+        the restaurant names
+    review_count_list: list
+        the review count of each restaurant
+
+    Returns
+    -------
+    fig
+        the review count distribution figure
+    '''
+    import plotly.graph_objects as go
+
+    bar_data = go.Bar(x=name_list, y=review_count_list)
+    basic_layout = go.Layout(title="Review count Distribution")
+    fig = go.Figure(data=bar_data, layout=basic_layout)
+    fig.update_layout(font=dict(family='Calibri', color='black'),
+                      template="ggplot2",
+                      title={'text': "Review count Distribution"})
+    return fig
+
+def plot_review_count_distribution(params, filename="scatter.html", auto_open=True):
+    ''' show the review count distribution of all restaurants in a city 
+
+    Parameters
+    ----------
+    params: dict
+        A dictionary of param:value pairs
+    filename: str
+        the html file to write
+    auto_open: bool
+        open the file in a browser
+
+    Return
+    ----------
+    The html file of the review count distribution of all restaurants in a city : str
+    '''
+    def build():
+        columns = get_city_columns(params, ['review_count', 'name'])
+        review_count_list = [float(review_count) for review_count in columns['review_count']]
+        name_list = list(columns['name'])
+        return review_count_figure(name_list, review_count_list)
+
+    figure_json = cached_figure('reviews', params, build)
+    print("Plotting")
+    print('-' * 47)
+    return write_figure_page(figure_json, filename, report_charts['reviews'][1], auto_open=auto_open)
+
+# the columns map_figure needs, in this order
+map_columns = ["name", "CityName", "review_count", "Latitude", "Longitude", "rating"]
+# up to this many restaurants are drawn one marker each; above it the
+# map shows clusters for each of MAP_ZOOM_LEVELS instead
+MAP_POINT_LIMIT = 1000
+MAP_ZOOM_LEVELS = (4, 7, 10, 13)
+# finer zoom levels are left out of a map once a level has more clusters
+MAP_MAX_MARKERS = 20000
+US_CENTER = (39.5, -98.35)
+
+def map_cell_degrees(zoom):
+    ''' the size of a cluster cell at a map zoom level, about 1/16 of a
+        map tile, so clusters stay apart on screen
+
+    Parameters
+    ----------
+    zoom: int
+        map zoom level
+
+    Returns
+    -------
+    float
+        cell size in degrees
+    '''
+    return 22.5 / 2 ** zoom
+
+def cluster_points(latitude, longitude, rating, cell_degrees):
+    ''' group restaurants into square grid cells
+
+    Parameters
+    ----------
+    latitude: sequence
+        latitudes of the restaurants
+    longitude: sequence
+        longitudes of the restaurants
+    rating: sequence
+        ratings of the restaurants
+    cell_degrees: float
+        cell size in degrees
+
+    Returns
+    -------
+    tuple
+        numpy arrays of the cluster centroid latitude, longitude, the
+        number of restaurants and their mean rating
+    '''
+    import numpy as np
+
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    rating = np.asarray(rating, dtype=float)
+    cells = np.stack([np.floor(latitude / cell_degrees), np.floor(longitude / cell_degrees)], axis=1)
+    _, inverse, count = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    def mean(values):
+        return np.bincount(inverse, weights=values) / count
+
+    return mean(latitude), mean(longitude), count, mean(rating)
+
+def located_columns(columns):
+    ''' drop the restaurants without coordinates (NULL in the database,
+        NaN in the snapshot) from some columns
+
+    Parameters
+    ----------
+    columns: dict
+        column: sequence of values, with Latitude and Longitude
+
+    Returns
+    -------
+    dict
+        the same columns, only the restaurants with both coordinates
+    '''
+    keep = [lat is not None and lon is not None and lat == lat and lon == lon
+            for lat, lon in zip(columns["Latitude"], columns["Longitude"])]
+    if all(keep):
+        return columns
+    return {column: [value for value, kept in zip(values, keep) if kept]
+            for column, values in columns.items()}
+
+def map_layout(center, zoom):
+    ''' the mapbox layout of the restaurant maps
+
+    Parameters
+    ----------
+    center: tuple
+        (latitude, longitude) of the map center
+    zoom: int
+        map zoom level
+
+    Returns
+    -------
+    dict
+        the layout
+    '''
+    import plotly.graph_objects as go
+
+    return dict(
+        autosize=True,
+        hovermode='closest',
+        mapbox=go.layout.Mapbox(
+            accesstoken=MAPBOX_TOKEN,
+            bearing=0,
+            center=go.layout.mapbox.Center(lat=center[0],
+                                           lon=center[1]),
+            pitch=0,
+            zoom=zoom),
+        plot_bgcolor="slategrey",
+        paper_bgcolor="lightyellow",
+        width=1200,
+        height=700
+    )
+
+def cluster_map_figure(latitude, longitude, rating, zoom=10, center=None):
+    ''' build a map with one trace of clusters for each of
+        MAP_ZOOM_LEVELS and buttons switching between them; a marker
+        shows the number of restaurants of its cell and is colored by
+        their mean rating. Zoom levels with more than MAP_MAX_MARKERS
+        clusters are left out, except the coarsest one.
+
+    Parameters
+    ----------
+    latitude: sequence
+        latitudes of the restaurants
+    longitude: sequence
+        longitudes of the restaurants
+    rating: sequence
+        ratings of the restaurants
+    zoom: int
+        the zoom level shown first
+    center: tuple
+        (latitude, longitude) of the map center, the mean position of
+        the restaurants when None
+
+    Returns
+    -------
+    fig
+        the restaurant map
+    '''
+    import numpy as np
+    import plotly.graph_objects as go
+
+    if center is None:
+        center = (float(np.mean(latitude)), float(np.mean(longitude)))
+    levels = {}
+    for level in MAP_ZOOM_LEVELS:
+        clusters = cluster_points(latitude, longitude, rating, map_cell_degrees(level))
+        if levels and len(clusters[0]) > MAP_MAX_MARKERS:
+            break
+        levels[level] = clusters
+    first = min(levels, key=lambda level: abs(level - zoom))
+    fig = go.Figure()
+    for level, (lat, lon, count, mean_rating) in levels.items():
+        fig.add_trace(go.Scattermapbox(
+            lat=lat.round(5),
+            lon=lon.round(5),
+            mode='markers',
+            marker=go.scattermapbox.Marker(size=np.clip(6 + 3 * np.log2(count), 6, 40).round(1),
+                                           color=mean_rating.round(2),
+                                           opacity=0.6,
+                                           colorbar=dict(title="mean rating"),
+                                           colorscale="sunset",
+                                           cmin=1, cmax=5),
+            text=[f"{n} restaurants, mean rating {r:.2f}" for n, r in zip(count, mean_rating)],
+            name=f"zoom {level}",
+            visible=level == first,
+        ))
+    buttons = [dict(label=f"Zoom {level}", method='update',
+                    args=[{'visible': [other == level for other in levels]},
+                          {'mapbox.zoom': level}])
+               for level in levels]
+    fig.update_layout(map_layout(center, first))
+    fig.update_layout(updatemenus=[dict(type='buttons', direction='right', x=0, y=1.08,
+                                        xanchor='left', buttons=buttons,
+                                        active=list(levels).index(first))],
+                      showlegend=False)
+    return fig
+
+def map_figure(columns, zoom=10, center=None):
+    ''' build the restaurant map of some restaurants: one marker per
+        restaurant up to MAP_POINT_LIMIT restaurants, clusters above;
+        restaurants without coordinates are left out
+
+    Parameters
+    ----------
+    columns: dict
+        map_columns: sequence of values
+    zoom: int
+        the zoom level shown first
+    center: tuple
+        (latitude, longitude) of the map center, the mean position of
+        the restaurants when None
+
+    Returns
+    -------
+    fig
+        the restaurant map, None when there are no restaurants
+    '''
+    import plotly.graph_objects as go
+
+    columns = located_columns(columns)
+    if len(columns["Latitude"]) > MAP_POINT_LIMIT:
+        return cluster_map_figure(columns["Latitude"], columns["Longitude"], columns["rating"], zoom, center)
+    text_list = []
+    lat_list = []
+    lon_list = []
+    rating_list = []
+    for bu in zip(*(columns[column] for column in map_columns)):
+        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[5]))
+        lat_list.append(float(bu[3]))
+        lon_list.append(float(bu[4]))
+        rating_list.append(float(bu[5]))
+    if not lat_list:
+        return None
+    if center is None:
+        center = (sum(lat_list) / len(lat_list), sum(lon_list) / len(lon_list))
+    fig = go.Figure(
+        go.Scattermapbox(
+            lat=lat_list,
+            lon=lon_list,
+            mode='markers',
+            marker=go.scattermapbox.Marker(size=15, color=rating_list,
+                                           opacity=0.5,
+                                           #symbol='star'
+                                           colorbar=dict(title="ratings"),
+                                           colorscale="sunset"),
+            text=text_list,
+        ))
+
+    fig.update_layout(map_layout(center, zoom))
+    return fig
+
+def map_cities(user_city, filename="map.html", auto_open=True):
+    ''' show the restaurant map in a city, or of every city
+
+    Parameters
+    ----------
+    user_city: str
+        name of a city, None for a map of all the restaurants
+    filename: str
+        the html file to write
+    auto_open: bool
+        open the file in a browser
+
+    Return
+    ----------
+    The html file of the restaurant map: str
+    '''
+    if user_city is None:
+        figure_json = cached_figure('map', {"CityName": None},
+                                    lambda: map_figure(get_city_columns({}, map_columns), 4, US_CENTER))
+    else:
+        figure_json = cached_figure('map', {"CityName": user_city},
+                                    lambda: map_figure(get_city_columns({"CityName": user_city}, map_columns)))
+    if figure_json is None:
+        print('No restaurants found.')
+        print('-' * 47)
+        return None
+    print("----------------- Generating map -----------------")
+    print(" ")
+    return write_figure_page(figure_json, filename, report_charts['map'][1], auto_open=auto_open)
+
+def export_geojson(filename, city_name=None, zoom=None):
+    ''' write restaurants as a compact GeoJSON FeatureCollection: one
+        Point per restaurant, or per cluster of a zoom level; restaurants
+        without coordinates are left out
+
+    Parameters
+    ----------
+    filename: str
+        the GeoJSON file to write
+    city_name: str
+        only export this city, None for all the restaurants
+    zoom: int
+        export the clusters of this zoom level instead of restaurants
+
+    Returns
+    -------
+    int
+        number of features written
+    '''
+    params = {} if city_name is None else {"CityName": city_name}
+    if zoom is None:
+        fields = ["id", "name", "CityName", "rating", "review_count", "Latitude", "Longitude"]
+        columns = located_columns(get_city_columns(params, fields))
+        features = [{"type": "Feature",
+                     "geometry": {"type": "Point", "coordinates": [round(float(lon), 5), round(float(lat), 5)]},
+                     "properties": {"id": id_, "name": name, "city": city,
+                                    "rating": float(rating), "review_count": int(review_count or 0)}}
+                    for id_, name, city, rating, review_count, lat, lon in zip(*(columns[f] for f in fields))]
+    else:
+        columns = located_columns(get_city_columns(params, ["Latitude", "Longitude", "rating"]))
+        features = []
+        if len(columns["Latitude"]):
+            for lat, lon, count, mean_rating in zip(*cluster_points(
+                    columns["Latitude"], columns["Longitude"], columns["rating"], map_cell_degrees(zoom))):
+                features.append({"type": "Feature",
+                                 "geometry": {"type": "Point", "coordinates": [round(float(lon), 5),
+                                                                               round(float(lat), 5)]},
+                                 "properties": {"count": int(count), "mean_rating": round(float(mean_rating), 2)}})
+    with open(filename, 'w', encoding='utf-8') as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file,
+                  separators=(',', ':'), default=json_default)
+    return len(features)
+
+###BATCH REPORTS###
+# chart name of the report command: (file name, description)
+report_charts = {
+    'kde': ('rating_distribution.html', 'Kernel rating distribution'),
+    'rating': ('rating.html', 'Rating distribution'),
+    'reviews': ('scatter.html', 'Review count distribution'),
+    'map': ('map.html', 'Restaurant map'),
+}
+REPORT_WORKERS = os.cpu_count() or 1
+
+def city_slug(city_name):
+    ''' a file system friendly name of a city
+
+    Parameters
+    ----------
+    city_name: str
+        name of a city
+
+    Returns
+    -------
+    str
+        lowercase ascii letters, digits and dashes
+    '''
+    return re.sub(r'[^a-z0-9]+', '-', city_name.lower()).strip('-') or 'city'
 
-###CREATE restaurant DATABASE###
-conn = sqlite3.connect(DBNAME)
-cur = conn.cursor()
-drop_restaurants = '''
-    DROP TABLE IF EXISTS 'restaurants';
-'''
-create_restaurants = '''
-    CREATE TABLE IF NOT EXISTS 'restaurants' (
-        'id' TEXT PRIMARY KEY,
-        'cityid' INTEGER NOT NULL,
-        'name'  TEXT NOT NULL,
-        'categories'  TEXT,
-        'rating'  REAL,
-        'Phone' TEXT,
-        'Latitude'  REAL,
-        'Longitude'  REAL,
-        'review_count'  INTEGER,
-        'CityName'  TEXT,
-        'StateName'  TEXT,
-        'zipcode'  REAL,
-        FOREIGN KEY (cityid) REFERENCES cities (id)
-    );
-'''
-cur.execute(drop_restaurants)
-cur.execute(create_restaurants)
-insert_restaurants = '''
-    INSERT OR IGNORE INTO restaurants
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-'''
-for i in City_list:
-    for c in get_all_restaurant(i):
-        cur.execute(insert_restaurants,c)
-conn.commit()
+def load_report_data(city_names, charts):
+    ''' load everything the report charts of some cities need with one
+        query over the restaurants (or from SNAPSHOT when it is loaded)
+        and one batch of density curves
 
-def get_info_form_database(info, params=None):
-    ''' get all restaurant information from the database
+    Parameters
+    ----------
+    city_names: list
+        names of the cities
+    charts: list
+        names of report_charts
+
+    Returns
+    -------
+    dict
+        city name: {'columns': map_columns: list of values,
+                    'curve': (grid, density) or None}
+    '''
+    data = {}
+    if SNAPSHOT is not None and SNAPSHOT.data_version == get_data_version(get_read_connection()):
+        for city_name in city_names:
+            rows = SNAPSHOT.city(city_name)
+            if len(rows):
+                data[city_name] = {'columns': {column: list(SNAPSHOT.column(rows, column))
+                                               for column in map_columns}}
+    else:
+        for row in get_info_form_database(map_columns, {'CityName': list(city_names)}):
+            columns = data.setdefault(row[1], {'columns': {column: [] for column in map_columns}})['columns']
+            for column, value in zip(map_columns, row):
+                columns[column].append(value)
+    curves = city_rating_curves() if {'kde', 'rating'} & set(charts) else {}
+    for city_name, city_data in data.items():
+        city_data['curve'] = curves.get(city_name)
+    return data
+
+def render_city_report(city_name, city_data, charts, out_dir, data_version):
+    ''' write the report charts of a city, building only the figures
+        missing from the figure cache; runs in a worker process of
+        write_report
 
     Parameters
     ----------
-    info: list
-        a list of strings want to query
-    params: dict
-        A dictionary of param:value pairs
+    city_name: str
+        name of a city
+    city_data: dict
+        the city's entry of load_report_data
+    charts: list
+        names of report_charts
+    out_dir: str
+        the report directory
+    data_version: int
+        the data version city_data was loaded at
 
     Returns
     -------
     list
-        A list of all the restaurant information queried
+        (chart name, path relative to out_dir) of the files written
     '''
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
-
-    real_info = ""
-    for i in range(len(info)):
-        real_info += "b.{}".format(info[i]) + ", "
-    real_info = real_info[:-2]
-    command = f'SELECT {real_info} FROM restaurants as b'
-    if params is not None:
-        keys = list(params.keys())
-        for key in keys:
-            if keys.index(key) == 0:
-                command += f' WHERE {key}="{params[key]}"'
-            else:
-                command += f' AND {key}="{params[key]}"'
-    command += ";"
-    result = cur.execute(command).fetchall()
-    conn.close()
+    columns = city_data['columns']
 
-    return result
+    def build_rating():
+        rating_list = [float(rating) for rating in columns['rating']]
+        if city_data['curve'] is not None:
+            grid, density = city_data['curve']
+        else:
+            grid = kde_grid()
+            density = batch_kde([rating_list], grid=grid)[0]
+        return rating_figure(rating_list, grid, density)
 
-def kde_rating(user_city):
-    ''' show kernel rating distribution of all restaurants in a city 
+    builders = {
+        'kde': lambda: None if city_data['curve'] is None else kde_figure(*city_data['curve']),
+        'rating': build_rating,
+        'reviews': lambda: review_count_figure(list(columns['name']),
+                                               [float(count) for count in columns['review_count']]),
+        'map': lambda: map_figure(columns),
+    }
+    slug = city_slug(city_name)
+    os.makedirs(os.path.join(out_dir, slug), exist_ok=True)
+    written = []
+    for chart in charts:
+        figure_json = cached_figure(chart, {'CityName': city_name}, builders[chart], data_version)
+        if figure_json is None:
+            continue
+        path = os.path.join(slug, report_charts[chart][0])
+        write_figure_page(figure_json, os.path.join(out_dir, path),
+                          f"{city_name}: {report_charts[chart][1]}", asset_dir=out_dir)
+        written.append((chart, path))
+    return written
+
+def write_report(city_names, charts, out_dir, max_workers=REPORT_WORKERS):
+    ''' write the charts of many cities into out_dir without opening
+        them. The data is loaded once, then the figures are built and
+        written in parallel by a process pool; an index.html links
+        every chart. All pages share one plotly.js bundle in out_dir.
 
     Parameters
     ----------
-    user_city: str
-        name of a city
+    city_names: list
+        names of the cities
+    charts: list
+        names of report_charts
+    out_dir: str
+        the report directory, created if needed
+    max_workers: int
+        number of worker processes
 
-    Return
+    Returns
+    -------
+    dict
+        city name: list of (chart name, path relative to out_dir)
+    '''
+    unknown = [chart for chart in charts if chart not in report_charts]
+    if unknown:
+        raise ValueError(f"unknown chart(s) {', '.join(unknown)}; choose from {', '.join(report_charts)}")
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    data_version = get_data_version(get_read_connection())
+    plotlyjs_asset(out_dir)
+    data = load_report_data(city_names, charts)
+    for city_name in city_names:
+        if city_name not in data:
+            print(f"{city_name}: no restaurants found, skipped")
+    report = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(render_city_report, city_name, data[city_name], charts, out_dir,
+                               data_version): city_name
+                   for city_name in city_names if city_name in data}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            city_name = futures[future]
+            report[city_name] = future.result()
+            print(f"[{done}/{len(futures)}] {city_name}: {len(report[city_name])} charts")
+    with open(os.path.join(out_dir, 'index.html'), 'w', encoding='utf-8') as index:
+        index.write("<html><head><meta charset='utf-8'><title>Restaurant report</title></head><body>\n")
+        for city_name in city_names:
+            if city_name in report:
+                links = ", ".join(f"<a href='{path}'>{report_charts[chart][1]}</a>"
+                                  for chart, path in report[city_name])
+                index.write(f"<p><b>{city_name}</b>: {links}</p>\n")
+        index.write("</body></html>\n")
+    charts_written = sum(len(written) for written in report.values())
+    print(f"{charts_written} charts of {len(report)} cities written to {out_dir} "
+          f"in {time.perf_counter() - start:.1f} s")
+    return report
+
+
+
+###HTTP SERVICE###
+SERVICE_POOL_SIZE = 8
+SERVICE_CACHE_SIZE = 1024
+# rows /query and /search return without a limit, and the most they return
+SERVICE_DEFAULT_LIMIT = 100
+SERVICE_MAX_LIMIT = 1000
+
+class ResponseCache:
+    ''' a thread-safe LRU cache of encoded responses with hit and miss
+        counters
+    '''
+    def __init__(self, max_entries=SERVICE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+def normalize_query(path, query):
+    ''' the cache key of a request: the path without a trailing slash
+        and the query parameters sorted, stripped and without blanks,
+        so equivalent URLs share one cache entry
+
+    Parameters
     ----------
-    The kernel rating distribution of all restaurants in a city : fig
+    path: str
+        the URL path
+    query: str
+        the URL query string
+
+    Returns
+    -------
+    tuple
+        (path, ((name, (values...)), ...))
     '''
-    text_list = []
-    ra_list = []
-    for bu in get_info_form_database(["name","CityName", "categories","rating"], {"CityName": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[3]))
-        ra_list.append(bu[3])
-    fig = ff.create_distplot([ra_list], ['rating'], bin_size=.2, 
-                             show_hist=False, show_rug=False)
-    fig.update_xaxes(title_text="rating", ticks="inside")
-    fig.update_yaxes(title_text="Kernel Density", ticks="inside")
-    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
-                      template="ggplot2",
-                      title={'text': "Kernel Rating Distribution"})
-    print("Plotting")
-    print('-' * 47)
-    fig.write_html("rating_distribution.html", auto_open=True)
-    return fig
+    params = urllib.parse.parse_qs(query)
+    items = []
+    for name, values in sorted(params.items()):
+        values = tuple(sorted({value.strip() for value in values if value.strip()}))
+        if values:
+            items.append((name.strip(), values))
+    return path.rstrip('/') or '/', tuple(items)
 
-def print_average_rating(params):
-    ''' Caculate the average rating of all restaurants in a city 
+def query_param(params, name, default=None, required=False):
+    ''' the single value of a normalized query parameter
 
     Parameters
     ----------
     params: dict
-        A dictionary of param:value pairs
+        name: tuple of values
+    name: str
+        the parameter name
+    default: object
+        returned when the parameter is missing
+    required: bool
+        raise when the parameter is missing
 
-    Return
-    ----------
-    The average rating of all restaurants in a city: str
+    Returns
+    -------
+    str
+        the value
+
+    Raises
+    ------
+    ValueError
+        when a required parameter is missing
     '''
-    info_list = get_info_form_database(['rating'], params)
-    average = sum(float(rating[0]) for rating in info_list) / len(info_list)
-    print(f'The average rating is {average}')
-    print('-' * 47)
+    values = params.get(name)
+    if not values:
+        if required:
+            raise ValueError(f"Missing parameter: {name}")
+        return default
+    return values[0]
 
-def plot_rating_distribution(params):
-    ''' show the rating distribution of all restaurants in a city 
+def limit_param(params, default=SERVICE_DEFAULT_LIMIT):
+    ''' the limit parameter of a request, capped at SERVICE_MAX_LIMIT
+        so one request cannot return the whole table
 
     Parameters
     ----------
     params: dict
-        A dictionary of param:value pairs
+        name: tuple of values
+    default: int
+        the limit when the parameter is missing
 
-    Return
+    Returns
+    -------
+    int
+        the limit
+
+    Raises
+    ------
+    ValueError
+        when the limit is not a number from 1 to SERVICE_MAX_LIMIT
+    '''
+    limit = int(query_param(params, 'limit', default))
+    if not 1 <= limit <= SERVICE_MAX_LIMIT:
+        raise ValueError(f"limit goes from 1 to {SERVICE_MAX_LIMIT}: {limit}")
+    return limit
+
+def api_cities(params):
+    return get_city_list()
+
+def api_restaurants(params):
+    return [dict(zip(('name', 'categories', 'rating'), row))
+            for row in get_restaurant_list(query_param(params, 'city', required=True))]
+
+def api_query(params):
+    ''' get_info_form_database over HTTP: info=col1,col2, order_by,
+        limit (see limit_param), column=value filters (repeat a column
+        to match any of several values) and min_column / max_column ranges
+    '''
+    info = query_param(params, 'info', 'name,rating').split(',')
+    order_by = query_param(params, 'order_by')
+    limit = limit_param(params)
+    filters = {}
+    ranges = {}
+    for name, values in params.items():
+        if name in ('info', 'order_by', 'limit'):
+            continue
+        if name[:4] in ('min_', 'max_'):
+            low, high = ranges.get(name[4:], (None, None))
+            bound = float(values[0])
+            ranges[name[4:]] = (bound, high) if name[:4] == 'min_' else (low, bound)
+        else:
+            filters[name] = list(values) if len(values) > 1 else values[0]
+    rows = get_info_form_database(info, filters, ranges,
+                                  order_by.split(',') if order_by else None, limit)
+    return [dict(zip(info, row)) for row in rows]
+
+def api_stats(params):
+    stats = get_city_stats(query_param(params, 'city', required=True))
+    if stats is not None:
+        stats['average_rating'] = stats['mean']
+    return stats
+
+def api_restaurant(params):
+    return find_restaurant_detail(query_param(params, 'name'), query_param(params, 'city'),
+                                  query_param(params, 'id'))
+
+def api_map(params):
+    columns = get_city_columns({'CityName': query_param(params, 'city', required=True)}, map_columns)
+    return {column: list(values) for column, values in columns.items()}
+
+def api_search(params):
+    rows = search_restaurants(query_param(params, 'q', required=True), query_param(params, 'city'),
+                              limit_param(params, 10))
+    return [dict(zip(('name', 'CityName', 'categories', 'rating', 'id'), row)) for row in rows]
+
+# URL path: function of the normalized query parameters returning JSON data
+service_routes = {
+    '/cities': api_cities,
+    '/restaurants': api_restaurants,
+    '/query': api_query,
+    '/stats': api_stats,
+    '/restaurant': api_restaurant,
+    '/map': api_map,
+    '/search': api_search,
+}
+
+def json_default(value):
+    ''' JSON encoding of numpy values from the snapshot '''
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    ''' answers GET requests of service_routes with JSON. Responses are
+        cached per normalized query and data version and carry an ETag;
+        a matching If-None-Match gets 304 Not Modified.
+    '''
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes; without this, keep-alive
+    # clients wait on delayed ACKs for every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path, items = normalize_query(url.path, url.query)
+        if path == '/metrics':
+            body = TRACER.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        route = service_routes.get(path)
+        if route is None:
+            self.send_json(404, {'error': f'Unknown path: {path}', 'paths': list(service_routes)})
+            return
+        with self.server.connections.reader() as conn:
+            key = (get_data_version(conn), path, items)
+            cached = self.server.cache.get(key)
+            if cached is None:
+                try:
+                    result = route(dict(items))
+                except (ValueError, sqlite3.Error) as error:
+                    self.send_json(400, {'error': str(error)})
+                    return
+                if result is None:
+                    self.send_json(404, {'error': 'Not found'})
+                    return
+                body = json.dumps(result, default=json_default).encode()
+                cached = ('"' + hashlib.sha1(body).hexdigest()[:20] + '"', body)
+                self.server.cache.put(key, cached)
+                status = 'MISS'
+            else:
+                status = 'HIT'
+        etag, body = cached
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Cache', status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+class QueryService(http.server.ThreadingHTTPServer):
+    ''' the read-only HTTP/JSON service, one thread per connection,
+        with its own pool of read-only connections and a ResponseCache
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, pool_size=SERVICE_POOL_SIZE, cache_size=SERVICE_CACHE_SIZE, quiet=False):
+        super().__init__(address, ServiceHandler)
+        self.connections = ConnectionManager(DBNAME, pool_size)
+        self.cache = ResponseCache(cache_size)
+        self.quiet = quiet
+
+    def server_close(self):
+        super().server_close()
+        self.connections.close()
+
+def serve_http(host='127.0.0.1', port=8000, pool_size=SERVICE_POOL_SIZE, cache_size=SERVICE_CACHE_SIZE):
+    ''' run the HTTP/JSON service until interrupted
+
+    Parameters
     ----------
-    The rating distribution of all restaurants in a city : fig
+    host: str
+        the address to listen on
+    port: int
+        the port to listen on
+    pool_size: int
+        number of pooled read-only connections
+    cache_size: int
+        number of responses kept in the LRU cache
+
+    Returns
+    -------
+    None
     '''
-    info_list = get_info_form_database(['rating'], params)
-    rating_list = [float(rating[0]) for rating in info_list]
-    fig = ff.create_distplot([rating_list], ['Rating'], bin_size=0.5)
-    fig.update_layout(font=dict(size=20, family='Calibri', color='black'),
-                      template="ggplot2",
-                      title={'text': "Rating Distribution"})
-    print("Plotting")
-    print('-' * 47)
-    fig.write_html("rating.html", auto_open=True)
+    service = QueryService((host, port), pool_size, cache_size)
+    print(f"Serving {', '.join(service_routes)} on http://{host}:{service.server_address[1]}/")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
 
-def plot_review_count_distribution(params):
-    ''' show the review count distribution of all restaurants in a city 
+def load_test_paths():
+    ''' the request mix of load_test: list, stats, map and a sorted
+        query of every city, plus the city list
 
     Parameters
     ----------
-    params: dict
-        A dictionary of param:value pairs
+    None
 
-    Return
+    Returns
+    -------
+    list
+        URL paths with query strings
+    '''
+    paths = ['/cities']
+    for city_name in get_city_list():
+        city = urllib.parse.quote(city_name)
+        paths.append(f'/restaurants?city={city}')
+        paths.append(f'/stats?city={city}')
+        paths.append(f'/map?city={city}')
+        paths.append(f'/query?info=name,rating,review_count&CityName={city}&order_by=-rating&limit=10')
+    return paths
+
+def load_test(base_url=None, n_requests=2000, concurrency=16):
+    ''' send n_requests GET requests from concurrency threads, each with
+        a keep-alive session, and print the throughput and latency
+        percentiles. Without base_url a service is started in-process
+        on a free port.
+
+    Parameters
     ----------
-    The review count distribution of all restaurants in a city : fig
+    base_url: str
+        the service to test, e.g. http://127.0.0.1:8000
+    n_requests: int
+        total number of requests
+    concurrency: int
+        number of client threads
+
+    Returns
+    -------
+    dict
+        requests, errors, seconds, rps, p50, p95, p99 and max (ms)
     '''
-    info_list = get_info_form_database(['review_count','name'], params)
-    review_count_list = [float(review_count[0]) for review_count in info_list]
-    name_list=[name[1] for name in info_list]
+    paths = load_test_paths()
+    service = None
+    if base_url is None:
+        service = QueryService(('127.0.0.1', 0), quiet=True)
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{service.server_address[1]}'
+    sessions = threading.local()
 
-    bar_data = go.Bar(x=name_list, y=review_count_list)
-    basic_layout = go.Layout(title="Review count Distribution")
-    fig = go.Figure(data=bar_data, layout=basic_layout)
-    fig.update_layout(font=dict(family='Calibri', color='black'),
-                      template="ggplot2",
-                      title={'text': "Review count Distribution"})
-    print("Plotting")
-    print('-' * 47)
-    fig.write_html("scatter.html", auto_open=True)
+    def fetch(number):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            ok = sessions.session.get(base_url + paths[number % len(paths)], timeout=30).status_code < 500
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency * 1000 for latency, _ in results)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    summary = {
+        'requests': n_requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'seconds': elapsed,
+        'rps': n_requests / elapsed,
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': latencies[-1],
+    }
+    print(f"{n_requests} requests, {concurrency} clients, {summary['errors']} errors in {elapsed:.2f} s "
+          f"({summary['rps']:.0f} requests/s)")
+    print(f"latency ms: p50 {summary['p50']:.1f}, p95 {summary['p95']:.1f}, "
+          f"p99 {summary['p99']:.1f}, max {summary['max']:.1f}")
+    if service is not None:
+        print(f"response cache: {service.cache.hits} hits, {service.cache.misses} misses")
+        service.shutdown()
+        service.server_close()
+    return summary
+
+
+
+###REPLAY AND BENCHMARKS###
+REPLAY_PORT = 8800
+WIKI_CITIES_PATH = urllib.parse.urlsplit(WIKI_CITIES_URL).path
+BENCH_CITIES = 20
+BENCH_SCALES = (1, 10, 100)
+# matches a construct_unique_key key of a crawl page: a get_restaurants
+# search of a location for CRAWL_TERM with no other filter, so the
+# searches of find (other terms, categories, price, radius or a point)
+# are not taken for locations
+recorded_key_pattern = re.compile(re.escape(SEARCH_PATH) + r'_limit_(\d+)'
+                                  r'_location_((?:(?!_(?:longitude|price|radius|sort_by)_).)*?)'
+                                  r'(?:_offset_(\d+))?_term_' + re.escape(CRAWL_TERM) + '$')
+
+class ReplayFixtures:
+    '''the recorded responses the replay server answers with.
+    Search pages come from the responses cache, or, for locations that
+    were never cached, are rebuilt from the restaurants in the database;
+    the city page comes from the pages cache, or is rebuilt from the
+    cities table.
+
+    Locations are kept casefolded, the way normalize_search sends them.
+
+    Instance Attributes
+    -------------------
+    businesses: dict
+        location: list of recorded businesses, in offset order
+
+    totals: dict
+        location: the total the API reported for it
+
+    page: string
+        the Wikipedia city page
+    '''
+    def __init__(self, cache=None, pages=None, dbname=None):
+        cache=CACHE_DICT if cache is None else cache
+        pages=CACHE_URL if pages is None else pages
+        dbname=DBNAME if dbname is None else dbname
+        recorded={}
+        for key in cache.keys():
+            match=recorded_key_pattern.search(key)
+            if match is None or SEARCH_PATH not in key:
+                continue
+            value=cache.get(key)
+            if isinstance(value, dict) and 'businesses' in value:
+                recorded.setdefault(match.group(2).casefold(), {})[int(match.group(3) or 0)]=value
+        self.businesses={}
+        self.totals={}
+        for location, by_offset in recorded.items():
+            self.businesses[location]=[business for offset in sorted(by_offset)
+                                       for business in by_offset[offset]['businesses']]
+            self.totals[location]=by_offset[min(by_offset)].get('total', len(self.businesses[location]))
+        self.page=pages.get(WIKI_CITIES_URL)
+        if os.path.exists(dbname):
+            self._load_database(dbname)
+
+    def _load_database(self, dbname):
+        conn=sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+        columns=[row[1] for row in conn.execute("PRAGMA table_info('restaurants')")]
+        active="WHERE removed_at IS NULL" if 'removed_at' in columns else ""
+        for row in conn.execute("SELECT id, name, categories, rating, Phone, Latitude, Longitude, review_count,"
+                                f" CityName, StateName, zipcode FROM restaurants {active} ORDER BY rowid"):
+            location=(row[8] or '').casefold()
+            if location in self.totals:
+                continue
+            self.businesses.setdefault(location, []).append({
+                'id': row[0], 'name': row[1],
+                'categories': [{'alias': re.sub(r'\W+', '', row[2].lower()), 'title': row[2]}],
+                'rating': row[3], 'phone': row[4],
+                'coordinates': {'latitude': row[5], 'longitude': row[6]},
+                'review_count': row[7],
+                'location': {'city': row[8], 'state': row[9],
+                             'zip_code': f'{int(row[10]):05d}' if isinstance(row[10], (int, float)) else row[10]},
+            })
+        for location, businesses in self.businesses.items():
+            self.totals.setdefault(location, len(businesses))
+        if self.page is None:
+            ranked='rank' in [row[1] for row in conn.execute("PRAGMA table_info('cities')")]
+            rows=conn.execute(f"SELECT {'rank' if ranked else 'id'}, CityName, StateName, Latitude, Longitude"
+                              f" FROM cities {'WHERE rank IS NOT NULL' if ranked else ''} ORDER BY 1").fetchall()
+            self.page=("<html><body><table class='wikitable sortable'><tr><th>Rank</th><th>City</th>"
+                       "<th>State</th><th>Location</th></tr>"
+                       + "".join(f"<tr><td>{rank}</td><td><a>{city}</a></td><td><a>{state}</a></td>"
+                                 f"<td><span class='geo'>{lat}; {lon}</span></td></tr>"
+                                 for rank, city, state, lat, lon in rows)
+                       + "</table></body></html>")
+        conn.close()
+
+    def locations(self, n=None):
+        ''' the recorded locations, the ones with most businesses first '''
+        ordered=sorted(self.businesses, key=lambda location: (-len(self.businesses[location]), location))
+        return ordered[:n]
+
+    def search(self, location, offset=0, limit=YELP_PAGE_LIMIT):
+        ''' a search page for location, which may be a synthetic copy
+        '<location>~<n>' of a recorded one: its businesses get their id
+        suffixed with ~n and slightly moved, so every copy adds new rows
+
+        Parameters
+        ----------
+        location: string
+            the location parameter of the request
+        offset: int
+            position of the first business
+        limit: int
+            number of businesses
+
+        Returns
+        -------
+        dict
+            the API dict, or None when the location was not recorded
+        '''
+        base, _, copy=location.casefold().partition('~')
+        if base not in self.businesses:
+            return None
+        businesses=self.businesses[base][offset:offset + limit]
+        if copy:
+            shift=(int(copy) * 7919 % 1000 - 500) * 1e-5
+            businesses=[dict(business, id=f"{business['id']}~{copy}",
+                             coordinates={'latitude': business['coordinates']['latitude'] + shift,
+                                          'longitude': business['coordinates']['longitude'] - shift})
+                        for business in businesses]
+        return {'businesses': businesses, 'total': self.totals[base]}
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    ''' answers Yelp searches and the Wikipedia city page from the
+        server's ReplayFixtures
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url=urllib.parse.urlsplit(self.path)
+        params=dict(urllib.parse.parse_qsl(url.query))
+        if url.path == SEARCH_PATH:
+            result=self.server.fixtures.search(params.get('location', ''), int(params.get('offset', 0)),
+                                               int(params.get('limit', YELP_PAGE_LIMIT)))
+            if result is None:
+                self.send_body(400, 'application/json', json.dumps(
+                    {'error': {'code': 'LOCATION_NOT_FOUND', 'description': 'Not recorded'}}))
+            else:
+                self.send_body(200, 'application/json', json.dumps(result))
+        elif url.path == WIKI_CITIES_PATH and self.server.fixtures.page is not None:
+            self.send_body(200, 'text/html; charset=utf-8', self.server.fixtures.page)
+        else:
+            self.send_body(404, 'application/json', json.dumps({'error': {'code': 'NOT_FOUND'}}))
 
+    def send_body(self, code, content_type, text):
+        body=text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-def map_cities(user_city):
-    ''' show the restaurant map in a city
+    def log_message(self, format, *args):
+        pass
+
+def start_replay_server(port=0, fixtures=None):
+    ''' start the replay server on a background thread
 
     Parameters
     ----------
-    user_city: str
-        name of a city
+    port: int
+        the port to listen on, 0 for any free port
+    fixtures: ReplayFixtures
+        the responses to replay, loaded from the caches and the
+        database when None
 
-    Return
+    Returns
+    -------
+    ThreadingHTTPServer
+        the running server; its url attribute is its base URL
+    '''
+    server=http.server.ThreadingHTTPServer(('127.0.0.1', port), ReplayHandler)
+    server.daemon_threads=True
+    server.fixtures=ReplayFixtures() if fixtures is None else fixtures
+    server.url=f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_stage(timings, stage, rows=None):
+    ''' time a benchmark stage: use as "with bench_stage(timings, name):"
+        and set timings[name]['rows'] inside when it is known
+    '''
+    @contextlib.contextmanager
+    def timer():
+        timings[stage]={'rows': rows}
+        start=time.perf_counter()
+        yield timings[stage]
+        timings[stage]['seconds']=time.perf_counter() - start
+    return timer()
+
+def benchmark_pipeline(scales=BENCH_SCALES, n_cities=BENCH_CITIES, out=None):
+    ''' time every stage of the pipeline offline, at several synthetic
+        data sizes. A replay server answers the requests; at scale k
+        every recorded city is fetched k times as synthetic copies, so
+        the database holds k times the restaurants. Each scale runs in
+        its own temporary database, caches and figure directory; the
+        real ones are not touched.
+
+    Parameters
     ----------
-    The restaurant map: fig
+    scales: tuple
+        the data sizes, as multiples of the recorded data
+    n_cities: int
+        how many recorded cities to use
+    out: str
+        a JSON file to append the results to, for tracking them over time
+
+    Returns
+    -------
+    dict
+        scale: stage: {'seconds', 'rows'}
     '''
-    text_list = []
-    lat_list = []
-    lon_list = []
-    rating_list = []
-    for bu in get_info_form_database(["name", "CityName", "review_count", "Latitude", "Longitude", "rating"], {"CityName": user_city}):
-        text_list.append("{} ({}): {}, rating: {}".format(bu[0], bu[1], bu[2], bu[5]))
-        lat_list.append(bu[3])
-        lon_list.append(bu[4])
-        rating_list.append(bu[5])
-    ave_lat = sum(lat_list) / len(lat_list)
-    ave_lon = sum(lon_list) / len(lon_list)
-    fig = go.Figure(
-        go.Scattermapbox(
-            lat=lat_list,
-            lon=lon_list,
-            mode='markers',
-            marker=go.scattermapbox.Marker(size=15, color=rating_list,
-                                           opacity=0.5,
-                                           #symbol='star'
-                                           colorbar=dict(title="ratings"),
-                                           colorscale="sunset"),
-            text=text_list,
-        ))
+    global DBNAME, BASIC_URL, CACHE_DICT, FIGURE_DIR, RATE_LIMITER, SNAPSHOT
+    import tempfile
+    # plotly builds its figure classes lazily, so build one of each
+    # up front and the figures stage does not count that time
+    import plotly.graph_objects
+    for trace_type in (plotly.graph_objects.Scatter, plotly.graph_objects.Histogram,
+                       plotly.graph_objects.Bar, plotly.graph_objects.Scattermapbox):
+        plotly.graph_objects.Figure(trace_type()).to_json()
 
-    layout = dict(
-        autosize=True,
-        hovermode='closest',
-        mapbox=go.layout.Mapbox(
-            accesstoken=MAPBOX_TOKEN,
-            bearing=0,
-            center=go.layout.mapbox.Center(lat=ave_lat,
-                                           lon=ave_lon),
-            pitch=0,
-            zoom=10),
-        plot_bgcolor="slategrey",
-        paper_bgcolor="lightyellow",
-        width=1200,
-        height=700
-    )
+    fixtures=ReplayFixtures()
+    cities=fixtures.locations(n_cities)
+    if not cities:
+        print("Nothing recorded to replay: build the database or fill the cache first.")
+        return {}
+    server=start_replay_server(0, fixtures)
+    saved=(DBNAME, BASIC_URL, CACHE_DICT, FIGURE_DIR, RATE_LIMITER, SNAPSHOT)
+    results={}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for scale in scales:
+                DBNAME=os.path.join(directory, f"bench-{scale}.db")
+                CACHE_DICT=SQLiteCache(os.path.join(directory, f"cache-{scale}.sqlite"), 'responses')
+                FIGURE_DIR=os.path.join(directory, f"figures-{scale}")
+                BASIC_URL=server.url
+                RATE_LIMITER=RateLimiter(1e9)
+                SNAPSHOT=None
+                _kde_cache.clear()
+                timings=results[scale]={}
+                with bench_stage(timings, 'scrape') as stage:
+                    city_list=parse_city_table(fixtures.page)
+                    stage['rows']=len(city_list)
+                with get_manager().writer() as conn:
+                    migrate_database(conn)
+                    listed={row[1].casefold() for row in city_list}
+                    for city in cities:
+                        if city not in listed:
+                            city_list.append((len(city_list) + 1, city, '', 0.0, 0.0))
+                    store_cities(conn, city_list)
+                    city_ids={name.casefold(): city_id
+                              for city_id, name in conn.execute("SELECT id, CityName FROM cities")}
+                    locations=[(city_ids[city], city if copy == 0 else f"{city}~{copy}")
+                               for copy in range(scale) for city in cities]
+                    with bench_stage(timings, 'ingest') as stage, contextlib.redirect_stdout(io.StringIO()):
+                        counts=sync_restaurants(conn, locations)
+                        stage['rows']=counts['inserted']
+                    # the replayed locations are casefolded, the charts want the stored city names
+                    sample=[row[0] for row in conn.execute(
+                        "SELECT CityName FROM restaurants WHERE removed_at IS NULL"
+                        " GROUP BY CityName ORDER BY COUNT(*) DESC, CityName LIMIT 10")]
+                with bench_stage(timings, 'queries') as stage:
+                    rows=0
+                    for city in sample:
+                        rows+=len(get_restaurant_list(city))
+                        columns=get_city_columns({'CityName': city}, map_columns)
+                        rows+=len(columns['name'])
+                        get_city_stats(city)
+                        search_restaurants(columns['name'][0][:3], city)
+                        restaurants_near(columns['Latitude'][0], columns['Longitude'][0], 10)
+                    stage['rows']=rows
+                with bench_stage(timings, 'stats') as stage:
+                    with get_manager().writer() as conn, conn:
+                        refresh_city_stats(conn)
+                    _kde_cache.clear()
+                    stage['rows']=len(city_rating_curves())
+                with bench_stage(timings, 'figures') as stage:
+                    data=load_report_data(sample, list(report_charts))
+                    figures=0
+                    for city in sample:
+                        columns=data[city]['columns']
+                        grid, density=data[city]['curve']
+                        ratings=[float(rating) for rating in columns['rating']]
+                        for fig in (kde_figure(grid, density), rating_figure(ratings, grid, density),
+                                    review_count_figure(list(columns['name']), list(columns['review_count'])),
+                                    map_figure(columns)):
+                            fig.to_json()
+                            figures+=1
+                    stage['rows']=figures
+                CACHE_DICT.close()
+                print(f"scale {scale}x: " + ", ".join(f"{name} {timing['seconds']:.2f} s ({timing['rows']} rows)"
+                                                      for name, timing in timings.items()))
+                conn=getattr(_local, 'conn', None)
+                if conn is not None:
+                    conn.close()
+                    _local.conn=None
+                get_manager().close()
+    finally:
+        DBNAME, BASIC_URL, CACHE_DICT, FIGURE_DIR, RATE_LIMITER, SNAPSHOT=saved
+        _kde_cache.clear()
+        server.shutdown()
+        server.server_close()
+    print(f"{'stage':<10}" + "".join(f"{str(scale) + 'x':>12}" for scale in results))
+    for name in ('scrape', 'ingest', 'queries', 'stats', 'figures'):
+        print(f"{name:<10}" + "".join(f"{results[scale][name]['seconds']:>11.3f}s" for scale in results))
+    if out:
+        history=load_json_cache(out) if os.path.exists(out) else {}
+        history.setdefault('runs', []).append({'time': time.time(), 'cities': len(cities), 'results': results})
+        save_cache(history, out)
+        print(f"Results appended to {out}")
+    return results
 
-    fig.update_layout(layout)
-    print("----------------- Generating map -----------------")
-    print(" ")
-    fig.write_html("map.html", auto_open=True)
 
-    return fig
+
+def finish_run(args, profiler=None):
+    ''' export the traces and the profile of a command when it ends
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        the command line arguments
+    profiler: cProfile.Profile
+        the running profiler, or None
+
+    Returns
+    -------
+    None
+    '''
+    command = args.command or 'menu'
+    if args.trace:
+        TRACER.write_json(args.trace, command=command)
+    if args.metrics:
+        TRACER.write_prometheus(args.metrics)
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile of '{command}' saved to {args.profile}")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
 
 
 
 if __name__ == "__main__":
-    City_list=[]
-    for city in build_city_information_list():
-        City_list.append(city[1])
+    parser = argparse.ArgumentParser(description="Restaurant information of the 100 most populous US cities.")
+    subparsers = parser.add_subparsers(dest="command")
+    build_parser = subparsers.add_parser("build", help="scrape the cities and fetch all restaurants")
+    refresh_parser = subparsers.add_parser("refresh", help="fetch the restaurants of the stored cities again")
+    for sub in (build_parser, refresh_parser):
+        sub.add_argument("--max-results", type=int, default=YELP_PAGE_LIMIT,
+                         help="restaurants to fetch per city (up to 1000)")
+        sub.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE,
+                         help="restaurant rows written per transaction")
+    build_parser.add_argument("--cities", type=int, default=100,
+                              help="how many of the most populous cities to load")
+    build_parser.add_argument("--clean", action="store_true",
+                              help="drop the tables first instead of syncing into them")
+    refresh_parser.add_argument("--max-age", type=float, default=None,
+                                help="revalidate cached API responses older than this many seconds")
+    cache_parser = subparsers.add_parser("cache", help="show the size and counters of the request caches")
+    cache_parser.add_argument("--purge-stale", action="store_true", help="delete the entries older than their TTL")
+    subparsers.add_parser("migrate", help="bring the schema of the database up to date")
+    subparsers.add_parser("check", help="check that the chart queries use the indexes")
+    subparsers.add_parser("bench-kde", help="time the rating density curves of every city")
+    search_parser = subparsers.add_parser("search", help="search restaurants by name, category, city or zip code")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--city", default=None, help="only search this city")
+    search_parser.add_argument("--limit", type=int, default=10)
+    category_parser = subparsers.add_parser("category", help="top cities and restaurants of a category")
+    category_parser.add_argument("category")
+    category_parser.add_argument("--city", default=None, help="only list restaurants of this city")
+    category_parser.add_argument("--n", type=int, default=10)
+    subparsers.add_parser("snapshot", help="write the columnar restaurants snapshot next to the database")
+    find_parser = subparsers.add_parser("find", help="search restaurants through the API with any term and filters")
+    find_parser.add_argument("--term", action="append", default=[],
+                             help="search term, repeat it to run several terms")
+    find_parser.add_argument("--location", action="append", default=[],
+                             help="place to search, repeat it to run several places")
+    find_parser.add_argument("--point", action="append", default=[], metavar="LAT,LON",
+                             help="point to search around, repeat it to run several points")
+    find_parser.add_argument("--category", default=None, help="category aliases, e.g. pizza,sushi")
+    find_parser.add_argument("--price", default=None, help="price levels, e.g. 1,2 or $$")
+    find_parser.add_argument("--radius", type=int, default=None, help="search radius in meters (up to 40000)")
+    find_parser.add_argument("--sort-by", default=None, choices=search_sorts)
+    find_parser.add_argument("--limit", type=int, default=10)
+    find_parser.add_argument("--offset", type=int, default=0)
+    find_parser.add_argument("--max-age", type=float, default=None,
+                             help="seconds stored searches are used for (default one day)")
+    near_parser = subparsers.add_parser("near", help="find the restaurants nearest to a point")
+    near_parser.add_argument("latitude", type=float)
+    near_parser.add_argument("longitude", type=float)
+    near_parser.add_argument("--k", type=int, default=10, help="how many restaurants to show")
+    near_parser.add_argument("--radius", type=float, default=None, help="search radius in km")
+    report_parser = subparsers.add_parser("report", help="write the charts of many cities without opening them")
+    report_parser.add_argument("--cities", default="all",
+                               help="comma separated city names, or 'all' for every stored city")
+    report_parser.add_argument("--charts", default=",".join(report_charts),
+                               help=f"comma separated charts from {', '.join(report_charts)}")
+    report_parser.add_argument("--out", default="report", help="output directory")
+    report_parser.add_argument("--workers", type=int, default=REPORT_WORKERS, help="number of worker processes")
+    serve_parser = subparsers.add_parser("serve", help="run the read-only HTTP/JSON query service")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--pool-size", type=int, default=SERVICE_POOL_SIZE,
+                              help="number of pooled read-only connections")
+    serve_parser.add_argument("--cache-size", type=int, default=SERVICE_CACHE_SIZE,
+                              help="number of responses kept in the LRU cache")
+    loadtest_parser = subparsers.add_parser("loadtest", help="load test the HTTP/JSON query service")
+    loadtest_parser.add_argument("--url", default=None,
+                                 help="the service to test; by default one is started in-process")
+    loadtest_parser.add_argument("--requests", type=int, default=2000)
+    loadtest_parser.add_argument("--concurrency", type=int, default=16)
+    map_parser = subparsers.add_parser("map", help="write the restaurant map of a city or of all cities")
+    map_parser.add_argument("--city", default=None, help="map this city; all cities when omitted")
+    map_parser.add_argument("--out", default="map.html", help="the html file to write")
+    map_parser.add_argument("--geojson", default=None, help="also export the restaurants to this GeoJSON file")
+    map_parser.add_argument("--zoom", type=int, default=None,
+                            help="export the clusters of this zoom level to the GeoJSON file instead")
+    replay_parser = subparsers.add_parser("replay", help="serve the recorded Yelp and Wikipedia responses locally")
+    replay_parser.add_argument("--port", type=int, default=REPLAY_PORT)
+    bench_parser = subparsers.add_parser("bench", help="time the whole pipeline offline at several data sizes")
+    bench_parser.add_argument("--scales", default=",".join(str(scale) for scale in BENCH_SCALES),
+                              help="comma separated multiples of the recorded data")
+    bench_parser.add_argument("--cities", type=int, default=BENCH_CITIES, help="how many recorded cities to use")
+    bench_parser.add_argument("--out", default=None, help="a JSON file to append the results to")
+    parser.add_argument("--trace", default=None, metavar="FILE",
+                        help="append the per-stage timings of this run to a JSON lines file")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="write the per-stage timings of this run as a Prometheus text file")
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="profile this run with cProfile, dump the stats to FILE and print the top functions")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="load the columnar snapshot and serve the charts from it")
+    args = parser.parse_args()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(finish_run, args, profiler if args.profile else None)
+    if args.command == "build":
+        build_database(args.max_results, clean=args.clean, n_cities=args.cities, batch_size=args.batch_size)
+        exit()
+    elif args.command == "refresh":
+        if args.max_age is not None:
+            CACHE_TTL['responses']=args.max_age
+        build_database(args.max_results, refresh_cities=False, batch_size=args.batch_size)
+        exit()
+    if args.command == "cache":
+        print_cache_stats(args.purge_stale)
+        exit()
+    if not os.path.exists(DBNAME):
+        print(f"{DBNAME} not found. Run 'python final_project.py build' first.")
+        exit()
+    if args.command == "migrate":
+        with get_manager().writer() as conn:
+            migrate_database(conn)
+        print(f"{DBNAME} is up to date (schema version {SCHEMA_VERSION}).")
+        exit()
+    conn = get_connection(readonly=True)
+    schema_version = get_schema_version(conn)
+    conn.close()
+    if schema_version != SCHEMA_VERSION:
+        print(f"{DBNAME} was made by an older version of this program."
+              " Run 'python final_project.py migrate' (or build) first.")
+        exit()
+    if args.snapshot and args.command != "snapshot":
+        load_snapshot()
+    if args.command == "snapshot":
+        snapshot = load_snapshot(rebuild=True)
+        print(f"Saved {len(snapshot.rows)} restaurants of {len(snapshot.city_offsets)} cities to {snapshot_paths()[0]}")
+        exit()
+    if args.command == "search":
+        for number, match in enumerate(search_restaurants(args.query, args.city, args.limit), start=1):
+            print(number, match[:4])
+        exit()
+    if args.command == "category":
+        print(f"Top cities for {args.category}:")
+        for number, row in enumerate(top_cities_for_category(args.category, args.n), start=1):
+            print(number, (row[0], row[1], round(row[2], 2)))
+        print('-' * 47)
+        print(f"Top restaurants for {args.category}:")
+        for number, row in enumerate(top_restaurants_for_category(args.category, args.n, args.city), start=1):
+            print(number, row[:4])
+        exit()
+    if args.command == "report":
+        city_names = get_city_list() if args.cities == "all" else \
+            [city.strip() for city in args.cities.split(",") if city.strip()]
+        charts = [chart.strip() for chart in args.charts.split(",") if chart.strip()]
+        try:
+            write_report(city_names, charts, args.out, args.workers)
+        except ValueError as error:
+            print(f"[Error] {error}")
+        exit()
+    if args.command == "serve":
+        serve_http(args.host, args.port, args.pool_size, args.cache_size)
+        exit()
+    if args.command == "loadtest":
+        load_test(args.url, args.requests, args.concurrency)
+        exit()
+    if args.command == "map":
+        map_cities(args.city, args.out, auto_open=False)
+        if args.geojson:
+            features = export_geojson(args.geojson, args.city, args.zoom)
+            print(f"{features} features written to {args.geojson}")
+        exit()
+    if args.command == "replay":
+        server = start_replay_server(args.port)
+        print(f"Replaying {len(server.fixtures.businesses)} locations on {server.url}")
+        print("Point the program at it with:")
+        print(f"    YELP_API_URL={server.url} WIKI_CITIES_URL={server.url}{WIKI_CITIES_PATH} python final_project.py ...")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        exit()
+    if args.command == "bench":
+        benchmark_pipeline(tuple(int(scale) for scale in args.scales.split(",")), args.cities, args.out)
+        exit()
+    if args.command == "find":
+        try:
+            points = [tuple(float(value) for value in point.split(",")) for point in args.point]
+            if not args.location and not points:
+                raise ValueError("Give at least one --location or --point")
+            results, counts = find_many(args.term or [None], args.location, points, args.offset, args.limit,
+                                        args.max_age, categories=args.category, price=args.price,
+                                        radius=args.radius, sort_by=args.sort_by)
+        except ValueError as error:
+            print(f"[Error] {error}")
+            exit()
+        print_find_results(results, counts)
+        exit()
+    if args.command == "near":
+        print_restaurants_near(args.latitude, args.longitude, args.k, args.radius)
+        exit()
+    if args.command == "check":
+        for name, plan in check_query_plans().items():
+            print(f"{name}: {'; '.join(plan)}")
+        exit()
+    if args.command == "bench-kde":
+        benchmark_kde()
+        exit()
+    City_list=get_city_list()
     print(" ")
     print("Welcome! This program provides you all the restaurant informations you want in the 100 most populous cities!")
     print("Let's start now!")
@@ -692,6 +5612,7 @@ if __name__ == "__main__":
         print('-'*47)
         print("1.Choose a city to see the rating distribution.")
         print("2.Choose a city to see all the restaurants here.")
+        print("3.Find the restaurants near a location.")
         print('-'*47)
         user_choice=input("Enter a number to get information or 'exit':")
         if user_choice.lower()=='exit':
@@ -765,11 +5686,15 @@ if __name__ == "__main__":
                                 elif int(user_input) == 4:
                                     print(" ")
                                     restaurant_input=input("Please enter a restaurant to see the details:")
-                                    restaurant_list=[]
-                                    for i in get_restaurant_list(city_input1):
-                                        restaurant_list.append(i[0])
-                                    if restaurant_input in restaurant_list:
-                                        get_restaurant_detail(restaurant_input,city_input1)
+                                    matches=search_restaurants(restaurant_input, city_input1) or search_restaurants(restaurant_input)
+                                    if matches:
+                                        exact=[m for m in matches if m[0].lower() == restaurant_input.strip().lower()]
+                                        if not exact and len(matches) > 1:
+                                            print(" ")
+                                            print("Closest matches:")
+                                            for number, match in enumerate(matches, start=1):
+                                                print(number, match[:4])
+                                        get_restaurant_detail(None, None, business_id=(exact or matches)[0][4])
                                         user_input4=input("Please enter any key to return or 'exit':")
                                         print(" ")
                                         if user_input4 == 'exit':
@@ -805,12 +5730,24 @@ if __name__ == "__main__":
                         print('[Error] Please enter a proper city from above!')
                         print(" ")
                         continue
+            elif int(user_choice) == 3:
+                print(" ")
+                location_input=input("Please enter a location as 'latitude, longitude' (e.g. 41.88, -87.63):")
+                radius_input=input("Please enter a search radius in km, or press enter for the 10 nearest:")
+                try:
+                    latitude, longitude=[float(part) for part in location_input.split(',')]
+                    radius=float(radius_input) if radius_input.strip() else None
+                except ValueError:
+                    print('[Error] Please enter the location as two numbers!')
+                    continue
+                print(" ")
+                print_restaurants_near(latitude, longitude, k=None if radius else 10, radius_km=radius)
             else:
                 print(" ")
-                print('[Error] Please enter a proper number (1 or 2)!')
+                print('[Error] Please enter a proper number (1 or 2 or 3)!')
                 print(" ")
                 continue
         else:
             print(" ")
-            print('[Error] Invalid input! Please enter a proper number (1 or 2) or exit!')
+            print('[Error] Invalid input! Please enter a proper number (1 or 2 or 3) or exit!')
             print(" ")
\ No newline at end of file
@@ -0,0 +1,61 @@
+import os
+import secrets
+import sys
+import tempfile
+
+import pytest
+
+# final_project reads its keys from the local secrets.py; without one the
+# standard library module is found, so give it dummy keys for the tests
+for name in ('API_KEY', 'MAPBOX_TOKEN'):
+    if not hasattr(secrets, name):
+        setattr(secrets, name, 'test')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# final_project opens its response caches in the working directory on import
+os.chdir(tempfile.mkdtemp(prefix='final_project_tests_'))
+
+import final_project  # noqa: E402
+
+
+def business(business_id, city, rating=4.0, latitude=41.0, longitude=-87.0):
+    return {
+        'id': business_id,
+        'name': f'Restaurant {business_id}',
+        'categories': [{'alias': 'pizza', 'title': 'Pizza'}],
+        'rating': rating,
+        'phone': '+15550000000',
+        'coordinates': {'latitude': latitude, 'longitude': longitude},
+        'review_count': 10,
+        'location': {'city': city, 'state': 'IL', 'zip_code': '60601'},
+    }
+
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    fixtures = final_project.ReplayFixtures(cache={}, pages={}, dbname=str(tmp_path / 'none.db'))
+    fixtures.businesses = {
+        'testville': [business(f'T-{n}', 'Testville') for n in range(120)],
+        'otherton': [business(f'O-{n}', 'Otherton', latitude=40.0) for n in range(30)],
+    }
+    fixtures.totals = {location: len(found) for location, found in fixtures.businesses.items()}
+    server = final_project.start_replay_server(0, fixtures)
+    cache = final_project.SQLiteCache(str(tmp_path / 'cache.sqlite'), 'responses')
+    monkeypatch.setattr(final_project, 'BASIC_URL', server.url)
+    monkeypatch.setattr(final_project, 'CACHE_DICT', cache)
+    monkeypatch.setattr(final_project, 'RATE_LIMITER', final_project.RateLimiter(1e9))
+    monkeypatch.setattr(final_project, 'DBNAME', str(tmp_path / 'sync.db'))
+    with final_project.get_manager().writer() as conn:
+        final_project.migrate_database(conn)
+        final_project.store_cities(conn, [(1, 'Testville', 'Illinois', 41.0, -87.0),
+                                          (2, 'Otherton', 'Illinois', 40.0, -87.0)])
+    yield fixtures
+    conn = getattr(final_project._local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        final_project._local.conn = None
+    final_project.get_manager().close()
+    cache.close()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,60 @@
+import pytest
+import requests
+
+import final_project
+
+
+class Response:
+    def __init__(self, status_code, value=None):
+        self.status_code = status_code
+        self.ok = 200 <= status_code < 300
+        self.value = value
+        self.headers = {}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = final_project.SQLiteCache(str(tmp_path / 'cache.sqlite'), 'responses')
+    yield cache
+    cache.close()
+
+
+def fetch_value(cache, fetch, ttl=60):
+    return final_project.cached_fetch(cache, 'key', fetch, lambda response: response.value, ttl)
+
+
+def test_fresh_entry_is_not_fetched_again(cache):
+    assert fetch_value(cache, lambda conditional: Response(200, 'first')) == 'first'
+    assert fetch_value(cache, lambda conditional: Response(200, 'second')) == 'first'
+    assert cache.counters['hits'] == 1
+
+
+def test_stale_entry_is_served_when_the_server_fails(cache):
+    fetch_value(cache, lambda conditional: Response(200, 'first'))
+    assert fetch_value(cache, lambda conditional: Response(429, 'throttled'), ttl=0) == 'first'
+
+    def unreachable(conditional):
+        raise requests.ConnectionError('down')
+
+    assert fetch_value(cache, unreachable, ttl=0) == 'first'
+    assert cache.counters['served stale'] == 2
+
+
+def test_missing_entry_still_raises(cache):
+    def unreachable(conditional):
+        raise requests.ConnectionError('down')
+
+    with pytest.raises(requests.ConnectionError):
+        fetch_value(cache, unreachable)
+
+
+def test_hits_are_written_in_batches_and_kept_for_eviction(tmp_path):
+    cache = final_project.SQLiteCache(str(tmp_path / 'lru.sqlite'), 'responses', max_bytes=25)
+    cache.store('a', 'x' * 8)
+    cache.store('b', 'x' * 8)
+    assert cache.lookup('a').value == 'x' * 8
+    assert cache._accessed
+    cache.store('c', 'x' * 8)
+    assert not cache._accessed
+    assert sorted(cache.keys()) == ['a', 'c']
+    cache.close()
@@ -0,0 +1,54 @@
+import pytest
+
+import final_project
+
+
+def category_counts(conn):
+    return sorted(conn.execute(
+        "SELECT c.title, cc.CityName, cc.count, cc.mean_rating"
+        " FROM category_city_counts AS cc JOIN categories AS c ON c.id = cc.category_id"))
+
+
+@pytest.fixture
+def synced(replay):
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+    return replay
+
+
+def test_rollups_after_sync(synced):
+    assert final_project.top_cities_for_category('pizza') == [('Testville', 120, 4.0), ('Otherton', 30, 4.0)]
+    assert final_project.top_cities_for_category('Pizza', n=1) == [('Testville', 120, 4.0)]
+    assert final_project.top_cities_for_category('sushi') == []
+    assert len(final_project.top_restaurants_for_category('pizza', n=50, city_name='Otherton')) == 30
+
+
+def test_rollups_follow_updates_and_removals(synced, tmp_path, monkeypatch):
+    for business in synced.businesses['testville'][:10]:
+        business['categories'] = [{'alias': 'tacos', 'title': 'Tacos'},
+                                  {'alias': 'pizza', 'title': 'Pizza'}]
+        business['rating'] = 5.0
+    synced.businesses['testville'][10]['categories'] = [{'alias': 'tacos', 'title': 'Tacos'}]
+    synced.businesses['otherton'] = synced.businesses['otherton'][10:]
+    synced.totals['otherton'] -= 10
+    monkeypatch.setattr(final_project, 'CACHE_DICT',
+                        final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+    with final_project.get_manager().writer() as conn:
+        counts = final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+        assert counts['updated'] == 11 and counts['removed'] == 10
+        incremental = category_counts(conn)
+        with conn:
+            final_project.refresh_city_stats(conn)
+        assert category_counts(conn) == incremental
+    final_project.CACHE_DICT.close()
+
+    tacos = final_project.top_cities_for_category('tacos')
+    assert [(city, count) for city, count, _ in tacos] == [('Testville', 11)]
+    assert tacos[0][2] == pytest.approx((10 * 5.0 + 4.0) / 11)
+    pizza = final_project.top_cities_for_category('pizza')
+    assert [(city, count) for city, count, _ in pizza] == [('Testville', 119), ('Otherton', 20)]
+    best = final_project.top_restaurants_for_category('pizza', n=10)
+    assert {row[-1] for row in best} == {f'T-{n}' for n in range(10)}
+    others = {row[-1] for row in final_project.top_restaurants_for_category('pizza', n=200, city_name='Otherton')}
+    assert others == {f'O-{n}' for n in range(10, 30)}
+    assert sorted(final_project.get_restaurant_categories('T-0')) == ['Pizza', 'Tacos']
@@ -0,0 +1,45 @@
+import sqlite3
+
+import final_project
+
+
+def linked_names(conn):
+    return set(conn.execute("SELECT b.CityName, c.CityName FROM restaurants AS b"
+                            " LEFT JOIN cities AS c ON c.id = b.cityid"))
+
+
+def test_cities_keep_their_id_when_ranks_swap(replay):
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')])
+        assert linked_names(conn) == {('Testville', 'Testville'), ('Otherton', 'Otherton')}
+
+        final_project.store_cities(conn, [(1, 'Otherton', 'Illinois', 40.0, -87.0),
+                                          (2, 'Testville', 'Illinois', 41.0, -87.0)])
+        assert dict(conn.execute("SELECT CityName, id FROM cities")) == {'Testville': 1, 'Otherton': 2}
+        assert linked_names(conn) == {('Testville', 'Testville'), ('Otherton', 'Otherton')}
+        assert final_project.get_city_list() == ['Otherton', 'Testville']
+
+        final_project.store_cities(conn, [(1, 'Otherton', 'Illinois', 40.0, -87.0)])
+        assert final_project.get_city_list() == ['Otherton']
+        assert linked_names(conn) == {('Testville', 'Testville'), ('Otherton', 'Otherton')}
+
+
+def test_migration_keeps_old_ids_and_relinks_orphans(tmp_path, monkeypatch):
+    dbname = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(dbname)
+    conn.execute("CREATE TABLE cities (id INTEGER PRIMARY KEY, CityName TEXT NOT NULL, StateName TEXT NOT NULL,"
+                 " Latitude REAL NOT NULL, Longitude REAL NOT NULL)")
+    conn.executemany("INSERT INTO cities VALUES (?, ?, ?, ?, ?)",
+                     [(1, 'Testville', 'Illinois', 41.0, -87.0), (2, 'Otherton', 'Illinois', 40.0, -87.0)])
+    conn.execute(final_project.create_restaurants)
+    conn.executemany("INSERT INTO restaurants (id, cityid, name, rating, CityName, Latitude, Longitude)"
+                     " VALUES (?, ?, ?, 4.0, ?, ?, ?)",
+                     [('A', 1, 'A', 'Testville', 41.0, -87.0), ('B', 7, 'B', 'Otherton', 40.0, -87.0)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(final_project, 'DBNAME', dbname)
+    with final_project.get_manager().writer() as conn:
+        final_project.migrate_database(conn)
+        assert conn.execute("SELECT id, rank FROM cities ORDER BY id").fetchall() == [(1, 1), (2, 2)]
+        assert conn.execute("SELECT id, cityid FROM restaurants ORDER BY id").fetchall() == [('A', 1), ('B', 2)]
+    final_project.get_manager().close()
@@ -0,0 +1,55 @@
+import pytest
+
+import final_project
+
+
+def all_stats(conn):
+    return sorted(conn.execute("SELECT * FROM city_stats"))
+
+
+@pytest.fixture
+def synced(replay):
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+    return replay
+
+
+def test_stats_after_sync(synced):
+    stats = final_project.get_city_stats('Testville')
+    assert stats['count'] == 120
+    assert stats['mean'] == pytest.approx(4.0)
+    assert stats['variance'] == pytest.approx(0.0)
+    assert stats['rating_histogram'][final_project.rating_buckets.index(4.0)] == 120
+    assert stats['top_categories'] == [['Pizza', 120]]
+    assert final_project.get_city_stats('Otherton')['count'] == 30
+    assert final_project.get_city_stats('Nowhere') is None
+
+
+def test_dirty_cities_are_refreshed(synced, tmp_path, monkeypatch):
+    for business in synced.businesses['testville'][:20]:
+        business['rating'] = 2.0
+    synced.businesses['testville'] = synced.businesses['testville'][:100]
+    synced.totals['testville'] = 100
+    synced.businesses['otherton'] = []
+    synced.totals['otherton'] = 0
+    monkeypatch.setattr(final_project, 'CACHE_DICT',
+                        final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+    with final_project.get_manager().writer() as conn:
+        counts = final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+        assert counts['updated'] == 20 and counts['removed'] == 50
+        assert conn.execute("SELECT COUNT(*) FROM sync_dirty").fetchone()[0] == 0
+        incremental = all_stats(conn)
+        with conn:
+            final_project.refresh_city_stats(conn)
+        assert all_stats(conn) == incremental
+    final_project.CACHE_DICT.close()
+
+    stats = final_project.get_city_stats('Testville')
+    assert stats['count'] == 100
+    assert stats['mean'] == pytest.approx((20 * 2.0 + 80 * 4.0) / 100)
+    assert stats['variance'] == pytest.approx(0.8 * 0.2 * 2.0 ** 2)
+    histogram = stats['rating_histogram']
+    assert histogram[final_project.rating_buckets.index(2.0)] == 20
+    assert histogram[final_project.rating_buckets.index(4.0)] == 80
+    assert final_project.get_city_stats('Otherton') is None
+    assert final_project.top_cities_for_category('pizza') == [('Testville', 100, pytest.approx(3.6))]
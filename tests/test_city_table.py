@@ -0,0 +1,60 @@
+import pytest
+from bs4 import BeautifulSoup
+
+import final_project
+
+GEO = '<span class="geo-dec">{}</span><span class="geo">{}</span>'
+
+ROWS_WITH_RANK = '''
+<tr><th>Rank</th><th>City</th><th>State</th><th>Population</th><th>Location</th></tr>
+<tr><td>1</td><td><a href="/wiki/New_York_City">New York</a>[d]</td><td><a>New York</a></td>
+    <td>8,804,190</td><td>{}</td></tr>
+<tr><td>2</td><td><a href="/wiki/Los_Angeles">Los Angeles</a></td><td><a>California</a></td>
+    <td>3,898,747</td><td>{}</td></tr>
+<tr><td>3</td><td>Nowhere</td><td>Nevada</td><td>1</td><td>unknown</td></tr>
+'''.format(GEO.format('40.66°N 73.94°W', '40.6635; -73.9387'),
+           GEO.format('34.02°N 118.41°W', '34.0194; -118.4108'))
+
+ROWS_WITHOUT_RANK = '''
+<tr><th>City</th><th>State</th><th>Population</th><th>Location</th></tr>
+<tr><th><a href="/wiki/New_York_City">New York</a><sup>[d]</sup></th><td><a>New York</a></td>
+    <td>8,804,190</td><td>{}</td></tr>
+<tr><th><a href="/wiki/Los_Angeles">Los Angeles</a></th><td>California</td>
+    <td>3,898,747</td><td>{}</td></tr>
+'''.format(GEO.format('40.66°N 73.94°W', '40.6635; -73.9387'),
+           '<span class="geo-dec">34.02°N 118.41°W</span>')
+
+
+def page(rows):
+    return ('<html><body><p>intro</p><table class="wikitable"><tr><td>1</td><td>a</td><td>b</td></tr></table>'
+            f'<table class="wikitable sortable">{rows}</table>'
+            '<table class="wikitable sortable"><tr><td>9</td><td>Later</td><td>Table</td>'
+            f'<td>{GEO.format("1°N 1°E", "1; 1")}</td></tr></table></body></html>')
+
+
+def cell(html):
+    return BeautifulSoup(f'<table><tr><td>{html}</td></tr></table>', 'html.parser').td
+
+
+def test_parse_coordinates():
+    assert final_project.parse_coordinates(cell(GEO.format('40.66°N 73.94°W', '40.6635; -73.9387'))) \
+        == (40.6635, -73.9387)
+    assert final_project.parse_coordinates(cell('<span class="geo-dec">33.9°S 151.2°E</span>')) \
+        == pytest.approx((-33.9, 151.2))
+    assert final_project.parse_coordinates(cell('<span class="geo-dec">21.3°N 157.8°W</span>')) \
+        == pytest.approx((21.3, -157.8))
+    assert final_project.parse_coordinates(cell('unknown')) == (None, None)
+
+
+@pytest.mark.parametrize('rows', [ROWS_WITH_RANK, ROWS_WITHOUT_RANK], ids=['rank', 'no rank'])
+def test_parse_city_table(rows):
+    cities = final_project.parse_city_table(page(rows))
+    assert cities[0] == (1, 'New York', 'New York', 40.6635, -73.9387)
+    assert cities[1][:3] == (2, 'Los Angeles', 'California')
+    assert cities[1][3:] == pytest.approx((34.0194, -118.4108), abs=0.01)
+    assert len(cities) == 2
+
+
+def test_parse_city_table_without_table():
+    with pytest.raises(ValueError):
+        final_project.parse_city_table('<html><table class="wikitable"></table></html>')
@@ -0,0 +1,31 @@
+import collections
+
+import final_project
+
+
+def test_hours_are_formatted():
+    hours = [{'open': [{'day': 0, 'start': '1100', 'end': '2200'},
+                       {'day': 6, 'start': '0900', 'end': '1400'}]}]
+    assert final_project.format_hours(hours) == 'Mon 11:00-22:00, Sun 09:00-14:00'
+
+
+def test_bad_periods_are_skipped():
+    hours = [{'open': [{'day': 0, 'start': '1100'},
+                       {'day': 9, 'start': '1100', 'end': '2200'},
+                       {'day': '1', 'start': '1100', 'end': '2200'},
+                       {'day': 2, 'start': 1100, 'end': '2200'},
+                       None,
+                       {'day': 3, 'start': '0800', 'end': '1200'}]}]
+    assert final_project.format_hours(hours) == 'Thu 08:00-12:00'
+    for hours in (None, [], [None], [{}], [{'open': None}], {'open': []}):
+        assert final_project.format_hours(hours) == ''
+
+
+def test_partial_hours_do_not_reject_the_business(replay):
+    replay.businesses['otherton'][0]['hours'] = [{'open': [{'day': 1}]}]
+    rejects = collections.Counter()
+    pages = [(2, 'Otherton', 0, 1, replay.businesses['otherton'][:1])]
+    rows = list(final_project.restaurant_rows(pages, rejects))
+    assert len(rows) == 1
+    assert rows[0][-1][0] == 'O-0'
+    assert not rejects
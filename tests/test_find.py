@@ -0,0 +1,68 @@
+import threading
+
+import final_project
+
+
+def test_find_restaurants_stores_the_search(replay):
+    found, source = final_project.find_restaurants('food', 'Testville', limit=60)
+    assert source == 'api'
+    assert [row['id'] for row in found] == [f'T-{n}' for n in range(60)]
+
+    found, source = final_project.find_restaurants('food', 'Testville', offset=10, limit=20)
+    assert source == 'database'
+    assert [row['id'] for row in found] == [f'T-{n}' for n in range(10, 30)]
+
+    found, source = final_project.find_restaurants(' FOOD ', 'testVILLE', limit=5)
+    assert source == 'database'
+    assert len(found) == 5
+
+
+def test_find_restaurants_does_not_hold_the_writer_while_fetching(replay, monkeypatch):
+    get_restaurants = final_project.get_restaurants
+    manager = final_project.get_manager()
+
+    def check_writer_is_free(*args, **kwargs):
+        free = []
+
+        def try_writer():
+            if manager._writer_lock.acquire(blocking=False):
+                manager._writer_lock.release()
+                free.append(True)
+
+        thread = threading.Thread(target=try_writer)
+        thread.start()
+        thread.join()
+        assert free
+        return get_restaurants(*args, **kwargs)
+
+    monkeypatch.setattr(final_project, 'get_restaurants', check_writer_is_free)
+    found, source = final_project.find_restaurants('food', 'Otherton')
+    assert source == 'api'
+    assert len(found) == 10
+
+
+def test_searched_restaurants_open_in_detail_but_stay_out_of_charts(replay):
+    found, source = final_project.find_restaurants('food', 'Otherton', limit=5)
+    assert source == 'api'
+    detail = final_project.find_restaurant_detail(business_id=found[0]['id'])
+    assert detail['name'] == found[0]['name']
+    assert final_project.find_restaurant_detail('Restaurant O-1', 'Otherton')['id'] == 'O-1'
+    assert final_project.get_restaurant_list('Otherton') == []
+
+    with final_project.get_manager().writer() as conn:
+        counts = final_project.sync_restaurants(conn, [(2, 'Otherton')])
+        assert counts['inserted'] == 30
+        assert conn.execute("SELECT COUNT(*) FROM searched_restaurants").fetchone()[0] == 0
+    assert len(final_project.get_restaurant_list('Otherton')) == 30
+    assert final_project.find_restaurant_detail(business_id='O-0')['name'] == 'Restaurant O-0'
+
+
+def test_migration_moves_searched_rows_out_of_restaurants(replay):
+    with final_project.get_manager().writer() as conn:
+        with conn:
+            conn.execute("INSERT INTO restaurants (id, cityid, name, CityName, fetched_at, removed_at)"
+                         " VALUES ('S-1', 2, 'Searched', 'Otherton', 5.0, 5.0)")
+            conn.execute("UPDATE meta SET value=1 WHERE key='schema_version'")
+        final_project.migrate_database(conn)
+        assert conn.execute("SELECT COUNT(*) FROM restaurants WHERE id='S-1'").fetchone()[0] == 0
+        assert conn.execute("SELECT name FROM searched_restaurants WHERE id='S-1'").fetchone() == ('Searched',)
@@ -0,0 +1,46 @@
+import pytest
+
+import final_project
+
+EVIL = "Chicago' OR 1=1 --"
+
+
+@pytest.mark.parametrize('arguments', [
+    {'info': ['name; DROP TABLE restaurants']},
+    {'info': ['name'], 'params': {'1=1 OR CityName': 'x'}},
+    {'info': ['name'], 'ranges': {'rating) OR (1': (1, 2)}},
+    {'info': ['name'], 'order_by': 'rating DESC'},
+    {'info': ['name'], 'order_by': ['-name', '-(SELECT 1)']},
+    {'info': ['name'], 'order_by': '--rating'},
+])
+def test_unknown_columns_are_rejected(arguments):
+    with pytest.raises(ValueError):
+        final_project.build_info_query(**arguments)
+
+
+def test_bad_limit_is_rejected():
+    with pytest.raises(ValueError):
+        final_project.build_info_query(['name'], limit='5; DROP TABLE restaurants')
+
+
+def test_values_are_always_bound():
+    command, values = final_project.build_info_query(
+        ['name', 'rating'], {'CityName': EVIL, 'categories': ['Pizza', EVIL, 'Thai']},
+        ranges={'rating': (3.5, None), 'review_count': (None, 100)},
+        order_by=['-rating', 'name'], limit='7')
+    assert EVIL not in command and 'Pizza' not in command and '3.5' not in command and '7' not in command
+    assert command.count('?') == len(values)
+    assert values == [EVIL, 'Pizza', EVIL, 'Thai', 3.5, 100, 7]
+    assert 'b.categories IN (?, ?, ?)' in command
+    assert 'b.rating >= ?' in command and 'b.review_count <= ?' in command
+    assert command.endswith(' ORDER BY b.rating DESC, b.name LIMIT ?')
+
+
+def test_bound_values_do_not_match_more_rows(replay):
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')])
+    assert final_project.get_info_form_database(['name'], {'CityName': "Testville' OR 1=1 --"}) == []
+    rows = final_project.get_info_form_database(['name'], {'CityName': ['Testville', 'Otherton']},
+                                                ranges={'rating': (4.0, 4.0)}, order_by='-name', limit=3)
+    assert len(rows) == 3
+    assert rows == sorted(rows, reverse=True)
@@ -0,0 +1,53 @@
+import pytest
+
+import final_project
+
+
+def rtree_ids(conn):
+    return {row[0] for row in conn.execute("SELECT business_id FROM restaurants_rtree")}
+
+
+@pytest.fixture
+def spread(replay):
+    for number, business in enumerate(replay.businesses['testville']):
+        business['coordinates'] = {'latitude': 41.0 + number * 0.001, 'longitude': -87.0}
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville')], max_results=200)
+    return replay
+
+
+def test_nearest_and_radius(spread):
+    nearest = final_project.restaurants_near(41.0, -87.0, k=3)
+    assert [row[-1] for row in nearest] == ['T-0', 'T-1', 'T-2']
+    assert nearest[0][0] == pytest.approx(0.0)
+    within = final_project.restaurants_near(41.0, -87.0, k=None, radius_km=0.25)
+    assert [row[-1] for row in within] == ['T-0', 'T-1', 'T-2']
+    assert all(row[0] <= 0.25 for row in within)
+    assert len(final_project.restaurants_near(41.0, -87.0, k=2, radius_km=0.25)) == 2
+    far = final_project.restaurants_near(41.5, -87.0, k=1)
+    assert far[0][-1] == 'T-119'
+
+
+def test_k_none_needs_a_radius(spread):
+    with pytest.raises(ValueError):
+        final_project.restaurants_near(41.0, -87.0, k=None)
+
+
+def test_rtree_follows_updates_and_removals(spread, tmp_path, monkeypatch):
+    with final_project.get_manager().writer() as conn:
+        assert rtree_ids(conn) == {f'T-{n}' for n in range(120)}
+        spread.businesses['testville'] = spread.businesses['testville'][1:]
+        spread.totals['testville'] -= 1
+        spread.businesses['testville'][0]['coordinates'] = {'latitude': 42.0, 'longitude': -88.0}
+        monkeypatch.setattr(final_project, 'CACHE_DICT',
+                            final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+        counts = final_project.sync_restaurants(conn, [(1, 'Testville')], max_results=200)
+        assert counts['removed'] == 1 and counts['updated'] == 1
+        assert 'T-0' not in rtree_ids(conn)
+        assert conn.execute("SELECT minLat, minLon FROM restaurants_rtree WHERE business_id='T-1'").fetchone() \
+            == pytest.approx((42.0, -88.0))
+        with conn:
+            conn.execute("DELETE FROM restaurants WHERE id='T-2'")
+        assert 'T-2' not in rtree_ids(conn)
+        final_project.CACHE_DICT.close()
+    assert final_project.restaurants_near(42.0, -88.0, k=1)[0][-1] == 'T-1'
@@ -0,0 +1,44 @@
+import pytest
+
+import final_project
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(final_project, 'DBNAME', str(tmp_path / 'plans.db'))
+    with final_project.get_manager().writer() as conn:
+        final_project.migrate_database(conn)
+    yield final_project.DBNAME
+    final_project.get_manager().close()
+
+
+def test_chart_queries_use_indexes(database):
+    plans = final_project.check_query_plans()
+    assert set(plans) == set(final_project.chart_queries)
+    for plan in plans.values():
+        assert plan
+
+
+def test_full_scan_is_reported(database, monkeypatch):
+    monkeypatch.setitem(final_project.chart_queries, 'by_phone', (['name'], {'Phone': '555'}))
+    with pytest.raises(AssertionError, match='by_phone'):
+        final_project.check_query_plans()
+
+
+def test_scan_over_a_covering_index_is_reported(database, monkeypatch):
+    conn = final_project.get_connection(readonly=True)
+    command, values = final_project.build_info_query(['name'], {'review_count': 5})
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + command, values)]
+    conn.close()
+    assert any('COVERING INDEX' in detail for detail in plan)
+    monkeypatch.setitem(final_project.chart_queries, 'by_review_count', (['name'], {'review_count': 5}))
+    with pytest.raises(AssertionError, match='by_review_count'):
+        final_project.check_query_plans()
+
+
+def test_prefix_index_is_dropped(database):
+    with final_project.get_manager().writer() as conn:
+        with conn:
+            conn.execute("CREATE INDEX idx_restaurants_city ON restaurants (CityName, removed_at, rating)")
+        final_project.migrate_database(conn)
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name='idx_restaurants_city'").fetchone() is None
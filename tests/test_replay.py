@@ -0,0 +1,29 @@
+import final_project
+
+
+def search_key(location, term, **filters):
+    params = final_project.normalize_search(term, location, **filters)
+    return final_project.construct_unique_key(final_project.BASIC_URL + final_project.SEARCH_PATH, params)
+
+
+def test_find_searches_are_not_replayed_as_crawl_pages(tmp_path):
+    crawl = {'businesses': [{'id': 'F1'}, {'id': 'F2'}], 'total': 2}
+    cache = {
+        search_key('Chicago', 'food'): crawl,
+        search_key('Chicago', 'thai'): {'businesses': [{'id': 'T1'}], 'total': 1},
+        search_key('Chicago', 'food', categories='pizza'): {'businesses': [{'id': 'P1'}], 'total': 1},
+        search_key('Chicago', 'food', price='1,2'): {'businesses': [{'id': 'C1'}], 'total': 1},
+    }
+    fixtures = final_project.ReplayFixtures(cache=cache, pages={}, dbname=str(tmp_path / 'none.db'))
+    assert fixtures.businesses == {'chicago': crawl['businesses']}
+    assert fixtures.totals == {'chicago': 2}
+
+
+def test_crawl_offsets_are_joined_in_order(tmp_path):
+    cache = {
+        search_key('Chicago', 'food', offset=50): {'businesses': [{'id': 'B'}], 'total': 51},
+        search_key('Chicago', 'food'): {'businesses': [{'id': 'A'}], 'total': 51},
+    }
+    fixtures = final_project.ReplayFixtures(cache=cache, pages={}, dbname=str(tmp_path / 'none.db'))
+    assert [business['id'] for business in fixtures.businesses['chicago']] == ['A', 'B']
+    assert fixtures.search('CHICAGO', 0, 1) == {'businesses': [{'id': 'A'}], 'total': 51}
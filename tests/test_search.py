@@ -0,0 +1,55 @@
+import pytest
+
+import final_project
+
+
+def fts_ids(conn):
+    return {row[0] for row in conn.execute("SELECT business_id FROM restaurants_fts")}
+
+
+@pytest.fixture
+def named(replay):
+    replay.businesses['testville'][5]['name'] = 'Giordano Deep Dish'
+    replay.businesses['otherton'][3]['name'] = 'Lula Cafe'
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+    return replay
+
+
+def resync(replay, tmp_path, monkeypatch):
+    monkeypatch.setattr(final_project, 'CACHE_DICT',
+                        final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+    with final_project.get_manager().writer() as conn:
+        counts = final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+    final_project.CACHE_DICT.close()
+    return counts
+
+
+def test_prefix_and_city(named):
+    assert [row[-1] for row in final_project.search_restaurants('giord')] == ['T-5']
+    assert [row[-1] for row in final_project.search_restaurants('deep di')] == ['T-5']
+    assert final_project.search_restaurants('giord', city_name='Otherton') == []
+    assert len(final_project.search_restaurants('pizza', city_name='Otherton', limit=100)) == 30
+    assert final_project.search_restaurants('...') == []
+
+
+def test_typo_fallback(named):
+    assert [row[-1] for row in final_project.search_restaurants('giordamo')] == ['T-5']
+    assert [row[-1] for row in final_project.search_restaurants('lula cafr')] == ['O-3']
+
+
+def test_index_follows_updates_and_removals(named, tmp_path, monkeypatch):
+    named.businesses['testville'][5]['name'] = 'Portillos'
+    named.businesses['otherton'] = [b for b in named.businesses['otherton'] if b['id'] != 'O-3']
+    named.totals['otherton'] -= 1
+    counts = resync(named, tmp_path, monkeypatch)
+    assert counts['updated'] == 1 and counts['removed'] == 1
+    assert [row[-1] for row in final_project.search_restaurants('portil')] == ['T-5']
+    assert final_project.search_restaurants('giordano') == []
+    assert final_project.search_restaurants('lula') == []
+    with final_project.get_manager().writer() as conn:
+        assert fts_ids(conn) == {row[0] for row in conn.execute(
+            "SELECT id FROM restaurants WHERE removed_at IS NULL")}
+        assert 'O-3' not in fts_ids(conn)
+        terms = {row[0] for row in conn.execute("SELECT term FROM restaurants_fts_terms")}
+        assert 'portillos' in terms and 'giordano' not in terms and 'lula' not in terms
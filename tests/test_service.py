@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+import requests
+
+import final_project
+
+
+@pytest.fixture
+def service(replay):
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(1, 'Testville'), (2, 'Otherton')], max_results=200)
+    server = final_project.QueryService(('127.0.0.1', 0), quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_limit_has_a_default_and_a_cap(service):
+    assert len(requests.get(service + '/query').json()) == final_project.SERVICE_DEFAULT_LIMIT
+    assert len(requests.get(service + '/query?limit=5').json()) == 5
+    for limit in (0, final_project.SERVICE_MAX_LIMIT + 1, 'all'):
+        assert requests.get(service + f'/query?limit={limit}').status_code == 400
+    assert requests.get(service + f'/search?q=restaurant&limit={final_project.SERVICE_MAX_LIMIT + 1}') \
+        .status_code == 400
+
+
+def test_errors_map_to_400_and_404(service):
+    assert requests.get(service + '/nowhere').status_code == 404
+    assert requests.get(service + '/restaurant?id=missing').status_code == 404
+    assert requests.get(service + '/restaurants').status_code == 400
+    response = requests.get(service + '/query?info=name,password')
+    assert response.status_code == 400
+    assert 'password' in response.json()['error']
+
+
+def test_etag_and_cache(service):
+    url = service + '/restaurants?city=Testville'
+    first = requests.get(url)
+    assert first.status_code == 200 and first.headers['X-Cache'] == 'MISS'
+    second = requests.get(service + '/restaurants/?city=Testville&unused=')
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.headers['ETag'] == first.headers['ETag']
+    not_modified = requests.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert not_modified.status_code == 304 and not_modified.content == b''
+
+
+def test_cache_follows_the_data_version(service, replay, tmp_path, monkeypatch):
+    url = service + '/restaurants?city=Otherton'
+    first = requests.get(url)
+    replay.businesses['otherton'][0] = dict(replay.businesses['otherton'][0], rating=1.0)
+    monkeypatch.setattr(final_project, 'CACHE_DICT',
+                        final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, [(2, 'Otherton')])
+    final_project.CACHE_DICT.close()
+    changed = requests.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200 and changed.headers['X-Cache'] == 'MISS'
+    assert changed.headers['ETag'] != first.headers['ETag']
+    assert {'name': 'Restaurant O-0', 'categories': 'Pizza', 'rating': 1.0} in changed.json()
@@ -0,0 +1,38 @@
+import numpy as np
+
+import final_project
+
+
+def test_snapshot_round_trip(replay, tmp_path, monkeypatch):
+    monkeypatch.setattr(final_project, 'SNAPSHOT', None)
+    long_id = 'a-very-long-yelp-business-id-that-goes-past-thirty-two-characters~12'
+    replay.businesses['testville'][0]['id'] = long_id
+    cities = [(1, 'Testville'), (2, 'Otherton')]
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, cities, max_results=200)
+        ids = {row[0] for row in conn.execute("SELECT id FROM restaurants")}
+
+    built = final_project.load_snapshot()
+    assert set(built.rows['id']) == ids
+    assert long_id in set(built.rows['id'])
+
+    loaded = final_project.load_snapshot()
+    assert isinstance(loaded.rows, np.memmap)
+    assert loaded.data_version == built.data_version
+    columns = final_project.get_city_columns({'CityName': 'Testville'}, ['id', 'name', 'rating'])
+    assert isinstance(columns['id'], np.ndarray)
+    assert len(columns['id']) == 120 and long_id in set(columns['id'])
+
+    replay.businesses['otherton'][0] = dict(replay.businesses['otherton'][0], rating=1.0)
+    monkeypatch.setattr(final_project, 'CACHE_DICT',
+                        final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses'))
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, cities, max_results=200)
+    final_project.CACHE_DICT.close()
+    columns = final_project.get_city_columns({'CityName': 'Otherton'}, ['id', 'rating'])
+    assert isinstance(columns['id'], list)
+    assert dict(zip(columns['id'], columns['rating']))['O-0'] == 1.0
+
+    rebuilt = final_project.load_snapshot()
+    assert rebuilt.data_version > built.data_version
+    assert not isinstance(rebuilt.rows, np.memmap)
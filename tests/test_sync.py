@@ -0,0 +1,53 @@
+import final_project
+
+
+def test_fetch_pages_follows_offsets(replay):
+    pages = list(final_project.fetch_pages([(1, 'Testville'), (2, 'Otherton')], max_results=200))
+    offsets = sorted((city_id, offset) for city_id, _, offset, _, _ in pages)
+    assert offsets == [(1, 0), (1, 50), (1, 100), (2, 0)]
+    for city_id, location, offset, total, businesses in pages:
+        assert total == len(replay.businesses[location.casefold()])
+        assert [b['id'] for b in businesses] == \
+            [b['id'] for b in replay.businesses[location.casefold()][offset:offset + 50]]
+
+
+def test_sync_restaurants(replay, tmp_path, monkeypatch):
+    cities = [(1, 'Testville'), (2, 'Otherton')]
+    with final_project.get_manager().writer() as conn:
+        counts = final_project.sync_restaurants(conn, cities, max_results=200, batch_size=40)
+        assert counts['inserted'] == 150
+        assert counts['removed'] == 0
+        assert dict(conn.execute("SELECT cityid, COUNT(*) FROM restaurants GROUP BY cityid")) == {1: 120, 2: 30}
+
+        counts = final_project.sync_restaurants(conn, cities, max_results=200)
+        assert counts['unchanged'] == 150
+        assert counts['inserted'] == counts['updated'] == counts['removed'] == 0
+
+        replay.businesses['testville'] = replay.businesses['testville'][1:]
+        replay.totals['testville'] -= 1
+        replay.businesses['otherton'][0] = dict(replay.businesses['otherton'][0], rating=2.5)
+        fresh = final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses')
+        monkeypatch.setattr(final_project, 'CACHE_DICT', fresh)
+        counts = final_project.sync_restaurants(conn, cities, max_results=200)
+        assert counts['updated'] == 1
+        assert counts['removed'] == 1
+        removed = conn.execute("SELECT id FROM restaurants WHERE removed_at IS NOT NULL").fetchall()
+        assert removed == [('T-0',)]
+        fresh.close()
+
+
+def test_shorter_list_removes_the_tail(replay, tmp_path, monkeypatch):
+    cities = [(1, 'Testville'), (2, 'Otherton')]
+    with final_project.get_manager().writer() as conn:
+        final_project.sync_restaurants(conn, cities, max_results=200)
+        replay.businesses['testville'] = replay.businesses['testville'][:100]
+        replay.totals['testville'] = 100
+        replay.businesses['otherton'] = []
+        replay.totals['otherton'] = 0
+        fresh = final_project.SQLiteCache(str(tmp_path / 'fresh.sqlite'), 'responses')
+        monkeypatch.setattr(final_project, 'CACHE_DICT', fresh)
+        counts = final_project.sync_restaurants(conn, cities, max_results=200)
+        assert counts['removed'] == 50
+        removed = {row[0] for row in conn.execute("SELECT id FROM restaurants WHERE removed_at IS NOT NULL")}
+        assert removed == {f'T-{n}' for n in range(100, 120)} | {f'O-{n}' for n in range(30)}
+        fresh.close()